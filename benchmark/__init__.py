@@ -0,0 +1,2 @@
+# Benchmark offline: server OpenRouter simulato, corpus sintetici ed esecuzioni misurate.
+# Da lanciare dalla radice del progetto, es. python -m benchmark.run_benchmark
@@ -0,0 +1,137 @@
+"""
+Corpus sintetici (HTML, Markdown, Word, PDF) con un numero dato di blocchi di testo.
+
+    python -m benchmark.corpus corpus/ --blocchi 10 100 1000 10000 --formati html md docx pdf
+
+Una parte dei blocchi contiene frasi critiche: nomi presenti in CRITICAL_PATTERNS,
+frasi che iniziano con "io e" e dati personali che solo il modello (o il server
+simulato) riconosce. Con lo stesso seed il corpus generato è sempre identico.
+"""
+import argparse
+import io
+import os
+import random
+
+FORMATI = ("html", "md", "docx", "pdf")
+
+SOGGETTI = ("Il progetto", "La squadra", "Il cliente", "Il documento", "Il sistema", "La riunione", "Il fornitore", "Il rapporto")
+VERBI = ("descrive", "richiede", "prevede", "analizza", "conferma", "aggiorna", "riassume", "propone")
+OGGETTI = ("le attività del trimestre", "una nuova procedura", "i costi di gestione", "il piano di consegna",
+           "le verifiche di qualità", "i requisiti tecnici", "il calendario dei lavori", "le risorse disponibili")
+COMPLEMENTI = ("entro la fine del mese", "con il supporto dell'ufficio tecnico", "secondo le linee guida interne",
+               "in accordo con la direzione", "dopo la revisione finale", "per tutte le sedi")
+FRASI_CRITICHE = (
+    "Io e Ilias Contreas abbiamo seguito personalmente la trattativa.",
+    "Io e il mio collega abbiamo preparato la proposta per il cliente.",
+    "Ho scritto a Contreas per confermare la data della consegna.",
+    "Il mio numero di telefono personale è 333 123 4567.",
+    "L'indirizzo di casa del referente è via Roma 12, Milano.",
+    "Il codice fiscale del titolare è RSSMRA80A01F205X.",
+)
+
+def genera_blocchi(n, seed=0, quota_critici=0.1):
+    """n frasi o brevi paragrafi, di cui circa quota_critici critici."""
+    rnd = random.Random(seed)
+    blocchi = []
+    for i in range(n):
+        if rnd.random() < quota_critici:
+            blocchi.append(rnd.choice(FRASI_CRITICHE))
+            continue
+        frasi = [
+            f"{rnd.choice(SOGGETTI)} {rnd.choice(VERBI)} {rnd.choice(OGGETTI)} {rnd.choice(COMPLEMENTI)}."
+            for _ in range(rnd.randint(1, 3))
+        ]
+        # Un numero progressivo rende i blocchi distinti (la deduplica non li scarta)
+        blocchi.append(f"{' '.join(frasi)} Punto {i + 1}.")
+    return blocchi
+
+def genera_html(blocchi, seed=0):
+    """Documento HTML con titoli, paragrafi, elenchi, tabelle e contenitori annidati."""
+    from html import escape
+    rnd = random.Random(seed)
+    parti = ["<!DOCTYPE html><html><head><title>Corpus di prova</title></head><body>"]
+    i = 0
+    while i < len(blocchi):
+        struttura = rnd.random()
+        if struttura < 0.15:
+            parti.append(f"<h2>{escape(blocchi[i])}</h2>")
+            i += 1
+        elif struttura < 0.3:
+            voci = blocchi[i:i + rnd.randint(2, 5)]
+            parti.append("<ul>" + "".join(f"<li>{escape(voce)}</li>" for voce in voci) + "</ul>")
+            i += len(voci)
+        elif struttura < 0.4:
+            celle = blocchi[i:i + 4]
+            parti.append("<table><tr>" + "".join(f"<td>{escape(cella)}</td>" for cella in celle) + "</tr></table>")
+            i += len(celle)
+        elif struttura < 0.5:
+            parole = escape(blocchi[i]).split(" ", 2)
+            parti.append(f"<div class=\"box\"><p><span>{' '.join(parole[:2])}</span> <b>{''.join(parole[2:])}</b></p></div>")
+            i += 1
+        else:
+            parti.append(f"<p>{escape(blocchi[i])}</p>")
+            i += 1
+    parti.append("</body></html>")
+    return "\n".join(parti).encode("utf-8")
+
+def genera_md(blocchi, seed=0):
+    rnd = random.Random(seed)
+    parti = []
+    i = 0
+    while i < len(blocchi):
+        if rnd.random() < 0.15:
+            parti.append(f"## {blocchi[i]}")
+            i += 1
+        elif rnd.random() < 0.2:
+            voci = blocchi[i:i + rnd.randint(2, 5)]
+            parti.append("\n".join(f"- {voce}" for voce in voci))
+            i += len(voci)
+        else:
+            parti.append(blocchi[i])
+            i += 1
+    return "\n\n".join(parti).encode("utf-8")
+
+def genera_docx(blocchi, seed=0):
+    from docx import Document
+    doc = Document()
+    for blocco in blocchi:
+        doc.add_paragraph(blocco)
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+def genera_pdf(blocchi, seed=0):
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.add_page()
+    pdf.set_font("Helvetica", size=10)
+    for blocco in blocchi:
+        pdf.multi_cell(0, 5, blocco, new_x="LMARGIN", new_y="NEXT")
+        pdf.ln(4)  # spazio tra paragrafi: ogni blocco resta un blocco di testo separato
+    return bytes(pdf.output())
+
+GENERATORI = {"html": genera_html, "md": genera_md, "docx": genera_docx, "pdf": genera_pdf}
+
+def genera_documento(formato, n_blocchi, seed=0, quota_critici=0.1):
+    """Contenuto (bytes) di un documento sintetico del formato indicato."""
+    return GENERATORI[formato](genera_blocchi(n_blocchi, seed, quota_critici), seed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera corpus sintetici per i benchmark.")
+    parser.add_argument("cartella", help="Cartella di destinazione")
+    parser.add_argument("--blocchi", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--formati", nargs="+", choices=FORMATI, default=list(FORMATI))
+    parser.add_argument("--quota-critici", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    os.makedirs(args.cartella, exist_ok=True)
+    for formato in args.formati:
+        for n in args.blocchi:
+            path = os.path.join(args.cartella, f"corpus_{n}.{formato}")
+            with open(path, "wb") as f:
+                f.write(genera_documento(formato, n, args.seed, args.quota_critici))
+            print(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Server locale compatibile con l'API chat/completions di OpenAI/OpenRouter, per misurare
+l'app senza consumare quota e senza dipendere dalla rete.
+
+    python -m benchmark.mock_openrouter --port 8765 --latenza 0.3 --errori 0.05
+    OPENROUTER_BASE_URL=http://127.0.0.1:8765/api/v1 streamlit run testapp.py
+
+Riconosce i prompt dell'app e risponde nel formato atteso: verdetti JSON prestabiliti
+(critico se il testo contiene una delle PAROLE_CRITICHE, oppure per una quota
+deterministica dei blocchi), riscritture e conversioni in plurale fittizie. Supporta
+lo streaming (SSE con l'utilizzo di token nell'ultimo evento), una latenza configurabile
+e una quota di errori 429 (con Retry-After) o 500.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from revisione import BATCH_ANALYZE_PROMPT, BATCH_REWRITE_PROMPT, PLURAL_CHUNK_PROMPT
+
+PAROLE_CRITICHE = ("io e", "telefono", "indirizzo", "codice fiscale", "iban", "contreas")
+
+# Sostituzioni della conversione in plurale simulata
+PLURALE = {"io": "noi", "Io": "Noi", "ho": "abbiamo", "sono": "siamo", "mi": "ci", "mio": "nostro", "mia": "nostra"}
+
+def _prefisso(template):
+    return template[:60]
+
+def _payload(prompt, marker):
+    """Primo valore JSON che segue marker nel prompt."""
+    start = prompt.index(marker) + len(marker)
+    return json.JSONDecoder().raw_decode(prompt, start)[0]
+
+class ConfigurazioneMock:
+    def __init__(self, latenza=0.2, variazione=0.05, errori=0.0, stato_errore=429, retry_after=0.2,
+                 quota_critici=0.05, frammento=24, seed=0):
+        self.latenza = latenza
+        self.variazione = variazione
+        self.errori = errori
+        self.stato_errore = stato_errore
+        self.retry_after = retry_after
+        self.quota_critici = quota_critici
+        self.frammento = frammento
+        self.seed = seed
+
+class MockOpenRouter:
+    """Server simulato in un thread; start() restituisce la base_url da passare al client."""
+
+    def __init__(self, configurazione=None, host="127.0.0.1", port=0):
+        self.configurazione = configurazione or ConfigurazioneMock()
+        self._random = random.Random(self.configurazione.seed)
+        self._lock = threading.Lock()
+        self.richieste = 0
+        self.errori = 0
+        mock = self
+
+        class Handler(_Handler):
+            server_mock = mock
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _estrai(self):
+        """(latenza, errore da simulare) per la prossima richiesta."""
+        c = self.configurazione
+        with self._lock:
+            self.richieste += 1
+            latenza = max(0.0, self._random.gauss(c.latenza, c.variazione))
+            errore = self._random.random() < c.errori
+            if errore:
+                self.errori += 1
+        return latenza, errore
+
+    def critico(self, testo):
+        testo_minuscolo = testo.lower()
+        if any(parola in testo_minuscolo for parola in PAROLE_CRITICHE):
+            return True
+        impronta = int(hashlib.md5(testo.encode("utf-8")).hexdigest()[:8], 16)
+        return impronta % 10000 < self.configurazione.quota_critici * 10000
+
+    def verdetto(self, testo):
+        if self.critico(testo):
+            return {"classificazione": "Critico", "motivazione": "Dati personali (risposta simulata)."}
+        return {"classificazione": "Non critico", "motivazione": ""}
+
+    def risposta(self, prompt):
+        """Testo della risposta al prompt, nel formato che l'app si aspetta."""
+        if prompt.startswith(_prefisso(BATCH_ANALYZE_PROMPT)):
+            return json.dumps([
+                {"id": blocco["id"], "classificazione": self.verdetto(blocco["testo"])["classificazione"]}
+                for blocco in _payload(prompt, "Blocchi:\n")
+            ], ensure_ascii=False)
+        if prompt.startswith(_prefisso(BATCH_REWRITE_PROMPT)):
+            return json.dumps([
+                {"id": elemento["id"], "testo": f"Frase riformulata in tono {elemento['tono'].lower()}."}
+                for elemento in _payload(prompt, "Elementi:\n")
+            ], ensure_ascii=False)
+        if prompt.startswith(_prefisso(PLURAL_CHUNK_PROMPT)):
+            parti = _payload(prompt, "Elementi:\n")
+            return json.dumps([re.sub(r"\b\w+\b", lambda m: PLURALE.get(m.group(), m.group()), parte) for parte in parti], ensure_ascii=False)
+        testo = re.search(r"\nTesto: (.*)\nSuccessivo:", prompt, re.S)
+        if testo and "Analizza il blocco" in prompt:
+            return json.dumps(self.verdetto(testo.group(1)), ensure_ascii=False)
+        if testo:
+            return "Frase riformulata."
+        return "ok"
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_mock = None
+
+    def log_message(self, format, *args):
+        pass  # niente log per richiesta: falserebbe le misure
+
+    def _invia_json(self, stato, corpo, intestazioni=()):
+        dati = json.dumps(corpo, ensure_ascii=False).encode("utf-8")
+        self.send_response(stato)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(dati)))
+        for nome, valore in intestazioni:
+            self.send_header(nome, valore)
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def do_POST(self):
+        corpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._invia_json(404, {"error": {"message": "not found"}})
+            return
+        mock = self.server_mock
+        configurazione = mock.configurazione
+        latenza, errore = mock._estrai()
+        time.sleep(latenza)
+        if errore:
+            intestazioni = [("Retry-After", f"{configurazione.retry_after:g}")] if configurazione.stato_errore == 429 else []
+            self._invia_json(configurazione.stato_errore, {"error": {"message": "errore simulato", "code": configurazione.stato_errore}}, intestazioni)
+            return
+        prompt = "".join(m.get("content") or "" for m in corpo.get("messages", []))
+        testo = mock.risposta(prompt)
+        uso = {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": len(testo) // 4 + 1}
+        uso["total_tokens"] = uso["prompt_tokens"] + uso["completion_tokens"]
+        base = {"id": f"mock-{mock.richieste}", "created": int(time.time()), "model": corpo.get("model", "mock")}
+        if not corpo.get("stream"):
+            self._invia_json(200, {
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": testo}, "finish_reason": "stop"}],
+                "usage": uso,
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        passo = max(1, configurazione.frammento)
+        eventi = [
+            {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": testo[i:i + passo]}, "finish_reason": None}]}
+            for i in range(0, len(testo), passo)
+        ]
+        eventi.append({**base, "object": "chat.completion.chunk", "choices": [], "usage": uso})
+        for evento in eventi:
+            self.wfile.write(f"data: {json.dumps(evento, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Server OpenRouter simulato per i benchmark.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latenza", type=float, default=0.2, help="Latenza media di una risposta, in secondi")
+    parser.add_argument("--variazione", type=float, default=0.05, help="Deviazione standard della latenza")
+    parser.add_argument("--errori", type=float, default=0.0, help="Quota di richieste che falliscono (0-1)")
+    parser.add_argument("--stato-errore", type=int, default=429, choices=(429, 500, 503))
+    parser.add_argument("--retry-after", type=float, default=0.2, help="Secondi indicati in Retry-After per i 429")
+    parser.add_argument("--quota-critici", type=float, default=0.05, help="Quota dei blocchi neutri classificati come critici")
+    args = parser.parse_args(argv)
+    configurazione = ConfigurazioneMock(
+        latenza=args.latenza, variazione=args.variazione, errori=args.errori, stato_errore=args.stato_errore,
+        retry_after=args.retry_after, quota_critici=args.quota_critici
+    )
+    mock = MockOpenRouter(configurazione, args.host, args.port)
+    print(f"Server simulato in ascolto su {mock.base_url}")
+    try:
+        mock._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock._server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+Esecuzioni misurate delle stesse funzioni usate dall'interfaccia, contro il server simulato.
+
+    python -m benchmark.run_benchmark --blocchi 10 100 1000 --output risultati.json
+    python -m benchmark.run_benchmark --blocchi 10 100 1000 --confronta risultati.json
+
+Per ogni formato e dimensione del corpus esegue, in ordine: parsing, filtro dei blocchi
+critici (filtra_blocchi_avanzata), riscrittura di tutti i blocchi critici
+(build_modifications), costruzione del documento finale e conversione completa in plurale.
+Come nei job dell'interfaccia, Word e PDF vengono riletti dal file a ogni fase
+(iter_document_blocks), mentre html e md riusano l'albero ottenuto dal parsing.
+Per ciascuna fase riporta tempo, blocchi al secondo, richieste al modello con i percentili
+di latenza (tempo fino alla risposta, o all'inizio dello stream), token, ritentativi e
+memoria: il picco allocato da Python (tracemalloc, in una seconda esecuzione per non
+falsare i tempi) e il picco di memoria residente di un processo che esegue solo quella
+fase (ru_maxrss), che comprende anche lxml e PyMuPDF.
+Ogni fase parte con la cache delle risposte e gli esempi del pre-classificatore vuoti.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from functools import partial
+
+def _servi(configurazione, connessione):
+    """Processo del server simulato: separato, per non contendere il GIL con le misure."""
+    from benchmark.mock_openrouter import MockOpenRouter
+    mock = MockOpenRouter(configurazione)
+    connessione.send(mock.base_url)
+    mock._server.serve_forever()
+
+def avvia_server(configurazione):
+    contesto = multiprocessing.get_context("spawn")
+    ricevi, invia = contesto.Pipe(duplex=False)
+    processo = contesto.Process(target=_servi, args=(configurazione, invia), daemon=True)
+    processo.start()
+    return processo, ricevi.recv()
+
+class ClientCronometrato:
+    """Inoltra le richieste al client reale registrandone la latenza."""
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self.latenze = []
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        inizio = time.perf_counter()
+        try:
+            return self._client.chat.completions.create(**kwargs)
+        finally:
+            with self._lock:
+                self.latenze.append(time.perf_counter() - inizio)
+
+def percentile(valori, p):
+    if not valori:
+        return None
+    if len(valori) == 1:
+        return valori[0]
+    return statistics.quantiles(valori, n=100, method="inclusive")[p - 1]
+
+def leggi_html(r, formato, path):
+    """Blocchi e HTML di un documento html o md, come li conserva la sessione dell'interfaccia dopo l'analisi."""
+    with open(path, encoding="utf-8") as f:
+        blocks, html_content = r.process_file_content(f.read(), formato)
+    return {"blocks": blocks, "html": html_content}
+
+def _blocchi(r, formato, path, documento):
+    # Come i job dell'interfaccia: html e md dall'albero già analizzato, Word e PDF riletti dal file
+    if formato in ("html", "md"):
+        return [block.text for block in documento["blocks"]]
+    return r.iter_document_blocks(path, formato)
+
+def fase_parsing(r, formato, path, documento, dati):
+    """Restituisce il numero di blocchi del documento."""
+    if formato in ("html", "md"):
+        documento.update(leggi_html(r, formato, path))
+        return len(documento["blocks"])
+    return sum(1 for _ in r.iter_document_blocks(path, formato))
+
+def fase_filtro(r, formato, path, documento, dati):
+    """Restituisce le scelte con cui l'utente chiederebbe di riscrivere tutti i blocchi critici."""
+    critici, _, simili = r.filtra_blocchi_avanzata(_blocchi(r, formato, path, documento))
+    scelte = {}
+    for chiave, blocco in critici.items():
+        for indice, testo in [(int(chiave.split("_", 1)[0]), blocco), *simili.get(chiave, [])]:
+            scelte[testo] = {"azione": "Riscrivi", "tono": "Formale", "indice": indice}
+    return scelte
+
+def fase_riscrittura(r, formato, path, documento, scelte):
+    modifiche, _ = r.build_modifications(scelte, _blocchi(r, formato, path, documento))
+    return modifiche
+
+def fase_output(r, formato, path, documento, modifiche):
+    if formato in ("html", "md"):
+        r.process_html_content(documento["html"], modifiche, highlight=True, blocks=documento["blocks"])
+        return
+    if formato == "docx":
+        output = r.build_docx("\n".join(modifiche.get(testo, testo) for testo in r.iter_document_blocks(path, formato)))
+    else:
+        output = r.process_pdf_content_with_overlay(path, modifiche)
+    output.close()
+
+def fase_conversione(r, formato, path, documento, dati):
+    if formato in ("html", "md"):
+        r.convert_html_to_plural(documento["html"])
+    else:
+        r.convert_text_to_plural("\n".join(r.iter_document_blocks(path, formato)))
+
+# Fasi nell'ordine di esecuzione: ciascuna riceve il risultato della precedente
+FASI = {
+    "parsing": fase_parsing,
+    "filtro": fase_filtro,
+    "riscrittura": fase_riscrittura,
+    "output": fase_output,
+    "conversione": fase_conversione,
+}
+
+def _picco_rss_mb():
+    import resource
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss è in KiB su Linux, in byte su macOS
+    return round(picco / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+def _esegui_fase_isolata(base_url, cartella_cache, fase, formato, path, dati, connessione):
+    """Processo che esegue solo la fase indicata e ne invia il picco di memoria residente."""
+    picco = None
+    try:
+        import revisione
+        banco = Banco(revisione, base_url, tempfile.mkdtemp(dir=cartella_cache), memoria=False)
+        banco._azzera()
+        # La fase parte dallo stato che avrebbe la sessione: per html e md l'albero già analizzato
+        documento = leggi_html(revisione, formato, path) if formato in ("html", "md") and fase != "parsing" else {}
+        FASI[fase](revisione, formato, path, documento, dati)
+        picco = _picco_rss_mb()
+    finally:
+        connessione.send(picco)
+
+class Banco:
+    """Stato condiviso delle misure: client cronometrato, cache e scheduler azzerati per ogni fase."""
+
+    def __init__(self, revisione, base_url, cartella_cache, memoria=True):
+        self.revisione = revisione
+        # Il server simulato importa revisione prima che l'indirizzo sia noto
+        revisione.OPENROUTER_BASE_URL = base_url
+        self.base_url = base_url
+        self.cartella_cache = cartella_cache
+        self.memoria = memoria
+        self.client = ClientCronometrato(revisione.get_client())
+        revisione.get_client = lambda: self.client
+        self._esecuzioni = 0
+
+    def _azzera(self):
+        r = self.revisione
+        self._esecuzioni += 1
+        r.LLM_CACHE_PATH = os.path.join(self.cartella_cache, f"cache_{self._esecuzioni}.sqlite3")
+        r.TRIAGE_PATH = os.path.join(self.cartella_cache, f"triage_{self._esecuzioni}.sqlite3")
+        r.get_llm_cache.cache_clear()
+        r.get_preclassificatore.cache_clear()
+        r.get_scheduler.cache_clear()
+        r.get_metrics().reset()
+        self.client.latenze = []
+
+    def picco_rss(self, fase, formato, path, dati):
+        """
+        Picco di memoria residente (MB) di un processo che esegue solo la fase: comprende le
+        allocazioni di lxml e PyMuPDF, che tracemalloc non vede, ma anche interprete e moduli.
+        """
+        # "forkserver": con spawn il figlio nasce da un fork di questo processo, e su Linux
+        # ru_maxrss conserva il picco ereditato anche dopo l'exec
+        contesto = multiprocessing.get_context("forkserver")
+        ricevi, invia = contesto.Pipe(duplex=False)
+        processo = contesto.Process(
+            target=_esegui_fase_isolata, args=(self.base_url, self.cartella_cache, fase, formato, path, dati, invia)
+        )
+        processo.start()
+        # Senza la copia di questo processo, la chiusura del figlio fa terminare recv
+        invia.close()
+        try:
+            return ricevi.recv()
+        except EOFError:
+            return None
+        finally:
+            processo.join()
+
+    def misura(self, fase, formato, path, documento, dati):
+        """Esegue la fase e restituisce (risultato, misure)."""
+        funzione = partial(FASI[fase], self.revisione, formato, path, documento, dati)
+        self._azzera()
+        inizio = time.perf_counter()
+        risultato = funzione()
+        secondi = time.perf_counter() - inizio
+        latenze = sorted(self.client.latenze)
+        llm = self.revisione.get_metrics().snapshot()["llm"].values()
+        misure = {
+            "secondi": round(secondi, 4),
+            "richieste": len(latenze),
+            "p50": percentile(latenze, 50),
+            "p95": percentile(latenze, 95),
+            "p99": percentile(latenze, 99),
+            "token": sum(voce["prompt_tokens"] + voce["completion_tokens"] for voce in llm),
+            "ritentativi": sum(voce["ritentativi"] for voce in llm),
+            "picco_mb": None,
+            "rss_mb": None,
+        }
+        if self.memoria:
+            self._azzera()
+            tracemalloc.start()
+            try:
+                funzione()
+                misure["picco_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            finally:
+                tracemalloc.stop()
+            misure["rss_mb"] = self.picco_rss(fase, formato, path, dati)
+        return risultato, misure
+
+def esegui_formato(banco, formato, path):
+    """Misura le fasi della pipeline su un documento; restituisce {fase: misure}."""
+    risultati = {}
+    documento, dati = {}, None
+    for fase in FASI:
+        risultato, risultati[fase] = banco.misura(fase, formato, path, documento, dati)
+        if fase == "parsing":
+            blocchi = risultato
+        else:
+            dati = risultato
+    for misure in risultati.values():
+        misure["blocchi"] = blocchi
+    return risultati
+
+def carica_corpus(cartella, formato, n, seed):
+    """Percorso del documento sintetico, generato una sola volta in cartella."""
+    from benchmark.corpus import genera_documento
+    os.makedirs(cartella, exist_ok=True)
+    path = os.path.join(cartella, f"corpus_{n}_{seed}.{formato}")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(genera_documento(formato, n, seed))
+    return os.path.abspath(path)
+
+def _ms(valore):
+    return "-" if valore is None else f"{valore * 1000:.0f}"
+
+def _mb(valore):
+    return "-" if valore is None else valore
+
+def _delta(valore, precedente):
+    return "-" if valore is None or not precedente else f"{(valore / precedente - 1) * 100:+.0f}%"
+
+def stampa(righe, baseline=None):
+    riferimento = {(b["formato"], b["dimensione"], b["fase"]): b for b in baseline or []}
+    intestazione = f"{'formato':<7} {'blocchi':>7} {'fase':<12} {'secondi':>8} {'blocchi/s':>10} {'rich.':>6} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'token':>8} {'ritent.':>7} {'picco MB':>9} {'RSS MB':>7}"
+    if riferimento:
+        intestazione += f" {'Δ tempo':>8} {'Δ memoria':>9} {'Δ RSS':>7}"
+    print(intestazione)
+    for riga in righe:
+        testo = (
+            f"{riga['formato']:<7} {riga['blocchi']:>7} {riga['fase']:<12} {riga['secondi']:>8.3f} "
+            f"{riga['blocchi_al_secondo']:>10.0f} {riga['richieste']:>6} {_ms(riga['p50']):>7} {_ms(riga['p95']):>7} "
+            f"{_ms(riga['p99']):>7} {riga['token']:>8} {riga['ritentativi']:>7} {_mb(riga['picco_mb']):>9} {_mb(riga.get('rss_mb')):>7}"
+        )
+        precedente = riferimento.get((riga["formato"], riga["dimensione"], riga["fase"]))
+        if precedente:
+            delta_tempo = (riga["secondi"] / precedente["secondi"] - 1) * 100 if precedente["secondi"] else 0.0
+            delta_memoria = _delta(riga["picco_mb"], precedente.get("picco_mb"))
+            delta_rss = _delta(riga.get("rss_mb"), precedente.get("rss_mb"))
+            testo += f" {delta_tempo:>+7.0f}% {delta_memoria:>9} {delta_rss:>7}"
+        print(testo)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline della pipeline di revisione contro un server OpenRouter simulato.")
+    parser.add_argument("--formati", nargs="+", choices=("html", "md", "docx", "pdf"), default=["html", "md", "docx", "pdf"])
+    parser.add_argument("--blocchi", type=int, nargs="+", default=[10, 100, 1000], help="Dimensioni dei corpus (fino a 10000 e oltre)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latenza", type=float, default=0.2, help="Latenza media simulata delle risposte, in secondi")
+    parser.add_argument("--variazione", type=float, default=0.05)
+    parser.add_argument("--errori", type=float, default=0.0, help="Quota di risposte 429 simulate")
+    parser.add_argument("--quota-critici", type=float, default=0.05)
+    parser.add_argument("--concorrenza", type=int, default=8, help="MAX_CONCURRENT_REQUESTS")
+    parser.add_argument("--rpm", type=float, default=0, help="REQUESTS_PER_MINUTE (0 = nessun limite)")
+    parser.add_argument("--url", help="Usa un server già avviato invece di quello simulato")
+    parser.add_argument("--senza-memoria", action="store_true", help="Non misura il picco di memoria (riduce la durata a meno della metà)")
+    parser.add_argument("--cartella-corpus", default="bench_corpus")
+    parser.add_argument("--output", help="Salva i risultati in JSON, da usare come riferimento")
+    parser.add_argument("--confronta", help="File JSON di un'esecuzione precedente da confrontare")
+    args = parser.parse_args(argv)
+
+    # La configurazione di revisione viene letta all'importazione
+    os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+    os.environ["MAX_CONCURRENT_REQUESTS"] = str(args.concorrenza)
+    os.environ["REQUESTS_PER_MINUTE"] = str(args.rpm)
+    os.environ["METRICS_PATH"] = ""
+    server, url = None, args.url
+    if not url:
+        from benchmark.mock_openrouter import ConfigurazioneMock
+        server, url = avvia_server(ConfigurazioneMock(
+            latenza=args.latenza, variazione=args.variazione, errori=args.errori, quota_critici=args.quota_critici, seed=args.seed
+        ))
+    import revisione
+
+    righe = []
+    try:
+        with tempfile.TemporaryDirectory() as cartella_cache:
+            banco = Banco(revisione, url, cartella_cache, memoria=not args.senza_memoria)
+            for formato in args.formati:
+                for n in args.blocchi:
+                    path = carica_corpus(args.cartella_corpus, formato, n, args.seed)
+                    for fase, misure in esegui_formato(banco, formato, path).items():
+                        righe.append({
+                            "formato": formato,
+                            "dimensione": n,
+                            "fase": fase,
+                            **misure,
+                            "blocchi_al_secondo": misure["blocchi"] / misure["secondi"] if misure["secondi"] else 0.0,
+                        })
+    finally:
+        if server is not None:
+            server.terminate()
+    baseline = None
+    if args.confronta:
+        with open(args.confronta, encoding="utf-8") as f:
+            baseline = json.load(f)["risultati"]
+    stampa(righe, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"parametri": vars(args), "risultati": righe}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
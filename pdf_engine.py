@@ -0,0 +1,166 @@
+import os
+import math
+import shutil
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+# Oltre questo numero di pagine l'estrazione viene distribuita su più processi
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "100"))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "25"))
+
+REDACTION_FONT = "helv"
+REDACTION_MAX_FONTSIZE = 11
+REDACTION_MIN_FONTSIZE = 4
+
+def _merge_lines(text):
+    """Unisce le righe di un blocco in un unico paragrafo, ricomponendo le parole sillabate."""
+    paragraph = ""
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if paragraph.endswith("-") and line[:1].islower():
+            paragraph = paragraph[:-1] + line
+        elif paragraph:
+            paragraph += " " + line
+        else:
+            paragraph = line
+    return paragraph
+
+def _open(source):
+    """Apre il PDF da un percorso (le pagine vengono lette da disco quando servono) o da bytes."""
+    import pymupdf
+    if isinstance(source, (str, os.PathLike)):
+        return pymupdf.open(source)
+    return pymupdf.open(stream=source, filetype="pdf")
+
+_worker_source = None
+
+def _init_worker(source):
+    # Il PDF (o il suo percorso) viene passato una sola volta per processo, non a ogni gruppo di pagine
+    global _worker_source
+    _worker_source = source
+
+def _extract_pages_in_worker(first, last):
+    return _extract_pages(_worker_source, first, last)
+
+def _page_paragraphs(page):
+    for x0, y0, x1, y1, text, _, block_type in page.get_text("blocks", sort=True):
+        if block_type != 0:  # blocchi immagine
+            continue
+        paragraph = _merge_lines(text)
+        if paragraph:
+            yield (page.number, (x0, y0, x1, y1), paragraph)
+
+def _extract_pages(source, first, last):
+    """Estrae i paragrafi (pagina, rettangolo, testo) delle pagine [first, last)."""
+    with _open(source) as doc:
+        return [paragraph for page_number in range(first, last) for paragraph in _page_paragraphs(doc[page_number])]
+
+def _iter_ranges(submit, ranges, ahead):
+    """Paragrafi dei gruppi di pagine estratti con submit(first, last), in ordine, con al più ahead gruppi in corso."""
+    pending = deque()
+    try:
+        for first, last in ranges:
+            pending.append(submit(first, last))
+            if len(pending) >= ahead:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        # Lettura interrotta: i gruppi non ancora avviati non servono più
+        for future in pending:
+            future.cancel()
+
+def iter_pdf_paragraphs(source, executor=None):
+    """
+    Paragrafi del PDF (percorso o bytes) come tuple (pagina, rettangolo, testo), in ordine di
+    lettura, restituiti man mano. I documenti con meno di PDF_PARALLEL_MIN_PAGES pagine vengono
+    letti una pagina alla volta nel processo corrente; gli altri in gruppi di PDF_PAGES_PER_TASK
+    pagine da un pool di processi (executor, che deve ricevere un percorso, o uno creato apposta),
+    tenendone in corso uno per core oltre a quello in lettura: in memoria restano solo questi.
+    """
+    with _open(source) as doc:
+        page_count = doc.page_count
+        if page_count < PDF_PARALLEL_MIN_PAGES or page_count <= PDF_PAGES_PER_TASK:
+            for page in doc:
+                yield from _page_paragraphs(page)
+            return
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    workers = min(os.cpu_count() or 1, len(ranges))
+    if executor is not None:
+        yield from _iter_ranges(partial(executor.submit, _extract_pages, source), ranges, workers + 1)
+        return
+    # "spawn": l'estrazione può partire da un processo con altri thread attivi (l'app Streamlit),
+    # e un fork ne copierebbe i lock eventualmente acquisiti
+    contesto = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=contesto, initializer=_init_worker, initargs=(source,)) as executor:
+        try:
+            yield from _iter_ranges(partial(executor.submit, _extract_pages_in_worker), ranges, workers + 1)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+def _fontsize_for(rect, text):
+    """Dimensione del carattere con cui il testo sostitutivo entra (circa) nel rettangolo originale."""
+    if not text:
+        return REDACTION_MAX_FONTSIZE
+    # Capacità stimata: (larghezza / 0.5 fs) caratteri per riga, altezza / (1.2 fs) righe
+    fontsize = math.sqrt(rect.width * rect.height / (0.6 * len(text))) * 0.9
+    return max(REDACTION_MIN_FONTSIZE, min(REDACTION_MAX_FONTSIZE, fontsize))
+
+class _FileObject:
+    """
+    Inoltra tutto al file avvolto tranne l'attributo name: PyMuPDF tratta come percorso ogni
+    oggetto che ha un name (None per i SpooledTemporaryFile ancora in memoria).
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def __getattr__(self, attr):
+        if attr == "name":
+            raise AttributeError(attr)
+        return getattr(self._file, attr)
+
+def redact_pdf(source, paragraphs, modifications, output):
+    """
+    Applica le modifiche {testo originale: nuovo testo} ai paragrafi (pagina, rettangolo, testo)
+    tramite annotazioni di redazione: il testo originale viene rimosso e, se non vuoto,
+    sostituito dal nuovo nello stesso rettangolo. Il documento viene scritto una sola volta
+    nel file output, senza passare da una copia in memoria.
+    """
+    import pymupdf
+    with _open(source) as doc:
+        pages = set()
+        for page_number, bbox, text in paragraphs:
+            new_text = modifications.get(text)
+            if new_text is None or new_text == text:
+                continue
+            rect = pymupdf.Rect(bbox)
+            doc[page_number].add_redact_annot(
+                rect,
+                text=new_text or None,
+                fontname=REDACTION_FONT,
+                fontsize=_fontsize_for(rect, new_text),
+                fill=(1, 1, 1)
+            )
+            pages.add(page_number)
+        if pages:
+            for page_number in sorted(pages):
+                doc[page_number].apply_redactions(images=pymupdf.PDF_REDACT_IMAGE_NONE)
+            logger.info(f"Redazioni applicate su {len(pages)} pagine del PDF.")
+            doc.save(_FileObject(output), garbage=3, deflate=True)
+    if not pages:
+        # Nessuna modifica: il PDF originale viene copiato così com'è
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, output)
+        else:
+            output.write(source)
+    output.seek(0)
+    return output
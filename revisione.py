@@ -0,0 +1,2406 @@
+import openai
+import os
+import re
+import logging
+import json
+import html
+import time
+import hashlib
+import sqlite3
+import threading
+import itertools
+import random
+import email.utils
+import copy
+import atexit
+import shutil
+import contextvars
+import cProfile
+import pstats
+import tempfile
+import zipfile
+import zlib
+import math
+import unicodedata
+import uuid
+from contextlib import contextmanager
+from array import array
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+from dotenv import load_dotenv
+from pydantic import BaseModel
+from pdf_engine import iter_pdf_paragraphs, redact_pdf
+
+# Logica di revisione dei documenti, indipendente dall'interfaccia: la usano sia
+# l'app Streamlit (testapp.py) sia la revisione in batch (revisione_batch.py).
+# I parser specifici per formato (markdown, python-docx, PyMuPDF) vengono
+# importati solo quando servono.
+
+# Configurazione iniziale
+########################################
+
+class Settings(BaseModel):
+    OPENROUTER_API_KEY: str
+
+@lru_cache(maxsize=None)
+def load_settings():
+    load_dotenv()
+    return Settings(OPENROUTER_API_KEY=os.getenv("OPENROUTER_API_KEY") or "")
+
+@lru_cache(maxsize=None)
+def configure_logging():
+    # Eseguita una sola volta per processo: i rerun non aggiungono altri handler
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[logging.FileHandler("app.log"), logging.StreamHandler()]
+    )
+
+settings = load_settings()
+logger = logging.getLogger(__name__)
+
+# Connessioni HTTP mantenute aperte (keep-alive) verso OpenRouter
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+
+API_KEY = settings.OPENROUTER_API_KEY
+MODEL = "google/gemini-2.0-pro-exp-02-05:free"
+# Indirizzo dell'API (modificabile per puntare al server simulato dei benchmark)
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+@lru_cache(maxsize=None)
+def get_client():
+    """Client OpenRouter condiviso dal processo, con un pool di connessioni keep-alive."""
+    try:
+        import httpx2 as httpx  # trasporto delle versioni recenti del client openai
+    except ImportError:
+        import httpx
+    if not API_KEY:
+        raise RuntimeError("API Key di OpenRouter non trovata! Impostala come variabile d'ambiente.")
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(60.0, connect=10.0)
+    )
+    # I ritentativi li gestisce il RequestScheduler: quelli interni del client si sommerebbero ai suoi
+    return openai.OpenAI(api_key=API_KEY, base_url=OPENROUTER_BASE_URL, http_client=http_client, max_retries=0)
+
+def check_api():
+    """Verifica la connessione all'API con una richiesta minima; restituisce (esito, messaggio)."""
+    try:
+        response = get_client().chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "system", "content": "Test"}],
+            max_tokens=1
+        )
+        if not response:
+            return False, "Chiave API non valida!"
+        return True, ""
+    except Exception as e:
+        return False, f"Errore di connessione all'API: {e}"
+
+# Pattern critici aggiornati per includere anche frasi come "io e ..."
+CRITICAL_PATTERNS = [
+    r"\bIlias Contreas\b",
+    r"\bIlias\b",
+    r"\bContreas\b",
+    r"\bJoey\b",
+    r"\bMya\b",
+    r"\bmia moglie\b",
+    r"\bmia figlia\b",
+    r"\bShake Your English\b",
+    r"\bBarman PR\b",
+    r"\bStairs Club\b",
+    r"\bil mio socio\b",
+    r"\bio e il mio socio\b",
+    r"\bil mio corso\b",
+    r"\bla mia accademia\b",
+    r"\bintervista\b",
+    r"Mi chiamo .*? la mia esperienza personale\.",
+    r"\bflair\b",
+    r"\bfiglio di papà\b",
+    r"\bhappy our\b",
+    r"\bio e\b\s+.+"
+]
+
+# File opzionale con termini aggiuntivi da segnalare (uno per riga, es. nomi di clienti e marchi)
+CRITICAL_TERMS_FILE = os.getenv("CRITICAL_TERMS_FILE", "")
+
+# Numero massimo di richieste contemporanee verso OpenRouter, per l'intero processo
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "8"))
+
+# Limiti del provider (i modelli gratuiti di OpenRouter accettano 20 richieste al minuto; 0 = nessun limite)
+REQUESTS_PER_MINUTE = float(os.getenv("REQUESTS_PER_MINUTE", "20"))
+REQUEST_BURST = int(os.getenv("REQUEST_BURST", "5"))
+# Tentativi per richiesta in caso di 429, errori 5xx, timeout o problemi di connessione
+REQUEST_RETRIES = int(os.getenv("REQUEST_RETRIES", "5"))
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Dopo CIRCUIT_FAILURE_THRESHOLD errori consecutivi le richieste vengono sospese per CIRCUIT_COOLDOWN secondi
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "8"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "60"))
+
+# Raggruppamento di più blocchi in un'unica richiesta (BATCH_SIZE=1 disattiva il batching)
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "15"))
+BATCH_TOKEN_BUDGET = int(os.getenv("BATCH_TOKEN_BUDGET", "3000"))
+BATCH_CONTEXT_CHARS = 200
+
+# Pipeline a memoria limitata: blocchi classificati per finestra (0 = 2 * MAX_CONCURRENT_REQUESTS * BATCH_SIZE)
+# e dimensione oltre la quale i documenti generati passano dalla memoria a un file temporaneo
+PIPELINE_WINDOW = int(os.getenv("PIPELINE_WINDOW", "0")) or 2 * MAX_CONCURRENT_REQUESTS * max(1, BATCH_SIZE)
+SPOOL_MAX_MEMORY = int(os.getenv("SPOOL_MAX_MEMORY", str(16 * 2 ** 20)))
+
+# Blocchi quasi identici (intestazioni, piè di pagina, numeri di pagina...) classificati una volta sola:
+# soglia di somiglianza (Jaccard sulle sequenze di SHINGLE_WORDS parole); 1 = solo blocchi identici
+# a meno di maiuscole, punteggiatura, spazi e cifre
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.9"))
+SHINGLE_WORDS = 3
+MINHASH_PERMUTATIONS = 16  # valori a 32 bit di un digest blake2b (al massimo 64 byte)
+LSH_BANDS = 4
+
+# Pre-classificazione locale (PreClassificatore) dei blocchi non segnalati dai pattern:
+# "off", "shadow" (confronta soltanto le previsioni con i verdetti del modello) o "active"
+# (i blocchi non critici con probabilità almeno TRIAGE_THRESHOLD non vengono inviati all'API).
+# Le previsioni iniziano quando ciascuna classe ha almeno TRIAGE_MIN_EXAMPLES esempi;
+# TRIAGE_MAX_EXAMPLES è il numero di impronte ricordate per non contare due volte un esempio
+TRIAGE_MODE = os.getenv("TRIAGE_MODE", "off")
+TRIAGE_THRESHOLD = float(os.getenv("TRIAGE_THRESHOLD", "0.99"))
+TRIAGE_MIN_EXAMPLES = int(os.getenv("TRIAGE_MIN_EXAMPLES", "50"))
+TRIAGE_MAX_EXAMPLES = int(os.getenv("TRIAGE_MAX_EXAMPLES", "50000"))
+TRIAGE_PATH = os.getenv("TRIAGE_PATH", "triage.sqlite3")
+TRIAGE_FEATURES = 2 ** 20
+
+# Cache persistente delle risposte del modello
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+
+# Metriche delle esecuzioni (una riga JSON ciascuna; vuoto = disattivate) e profilo cProfile opzionale
+METRICS_PATH = os.getenv("METRICS_PATH", "metrics.jsonl")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+
+# Conversione in plurale a blocchi: dimensione dei blocchi, contesto e tentativi
+CONVERSION_CHUNK_TOKENS = int(os.getenv("CONVERSION_CHUNK_TOKENS", "1200"))
+CONVERSION_CONTEXT_UNITS = 2
+CONVERSION_RETRIES = int(os.getenv("CONVERSION_RETRIES", "2"))
+CONVERSION_TIMEOUT = 60
+
+# Intervallo minimo (secondi) tra due aggiornamenti delle anteprime in streaming
+PROGRESS_INTERVAL = 0.3
+
+# Elaborazioni in background dell'interfaccia: job eseguiti contemporaneamente e secondi
+# per cui restano consultabili quelli terminati
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", "3600"))
+# Copie su disco dei documenti caricati nell'interfaccia: eliminate dopo UPLOAD_TTL_SECONDS secondi senza uso
+UPLOAD_TTL_SECONDS = int(os.getenv("UPLOAD_TTL_SECONDS", "3600"))
+
+SUPPORTED_EXTENSIONS = ("html", "md", "doc", "docx", "pdf")
+
+TONE_OPTIONS = {
+    "Stile originale": "Mantieni lo stesso stile e struttura del testo originale.",
+    "Formale": "Riscrivi in modo formale e professionale, adatto a documenti ufficiali.",
+    "Informale": "Riscrivi in modo amichevole e colloquiale, adatto a comunicazioni informali.",
+    "Tecnico": "Riscrivi con linguaggio tecnico e preciso, adatto ad un manuale tecnico.",
+    "Narrativo": "Riscrivi in modo descrittivo e coinvolgente stile racconto.",
+    "Pubblicitario": "Riscrivi in modo persuasivo, come una pubblicità.",
+    "Giornalistico": "Riscrivi in tono chiaro e informativo.",
+}
+
+# Prompt per il modello
+PLURAL_CHUNK_PROMPT = """Riscrivi ciascun elemento dell'array JSON seguente modificando esclusivamente il modo di interloquire da prima persona singolare a prima persona plurale. Mantieni invariato il contenuto e il senso logico.
+Gli elementi sono parti consecutive dello stesso documento. Il contesto precedente serve solo a capire il discorso e non va riscritto.
+
+Contesto precedente:
+{context}
+
+Elementi:
+{payload}
+
+Rispondi esattamente con un array JSON di stringhe, con lo stesso numero di elementi e nello stesso ordine.
+"""
+
+REWRITE_PROMPT = (
+    "Contesto:\nPrecedente: {prev_text}\nTesto: {text}\nSuccessivo: {next_text}\n\n"
+    "Riscrivi il 'Testo' in tono '{tone}'. Rimuovi eventuali dettagli personali o identificabili. "
+    "Rispondi con UNA sola frase, senza ulteriori commenti."
+)
+
+ANALYZE_PROMPT = """Contesto:
+Precedente: {prev_text}
+Testo: {text}
+Successivo: {next_text}
+
+Analizza il blocco di testo e indica se è "Critico" o "Non critico" in base alla presenza di informazioni sensibili, dati personali o riferimenti problematici, con particolare attenzione a frasi che iniziano con "io e". 
+Rispondi esattamente in questo formato JSON:
+{{
+  "classificazione": "Critico" o "Non critico",
+  "motivazione": "Descrizione sintetica degli elementi problematici, se presenti."
+}}
+"""
+
+BATCH_ANALYZE_PROMPT = """Per ciascun blocco dell'elenco seguente, indica se è "Critico" o "Non critico" in base alla presenza di informazioni sensibili, dati personali o riferimenti problematici, con particolare attenzione a frasi che iniziano con "io e". I campi "precedente" e "successivo" sono solo contesto.
+
+Blocchi:
+{payload}
+
+Rispondi esattamente con un array JSON, un elemento per blocco, in questo formato:
+[
+  {{"id": <id del blocco>, "classificazione": "Critico" o "Non critico"}}
+]
+"""
+
+BATCH_REWRITE_PROMPT = """Per ciascun elemento dell'elenco seguente, riscrivi il campo "testo" nel tono indicato dal campo "tono". Rimuovi eventuali dettagli personali o identificabili. Ogni riscrittura deve essere UNA sola frase, senza ulteriori commenti. I campi "precedente" e "successivo" sono solo contesto.
+
+Elementi:
+{payload}
+
+Rispondi esattamente con un array JSON, un elemento per blocco, in questo formato:
+[
+  {{"id": <id dell'elemento>, "testo": "testo riscritto"}}
+]
+"""
+
+PROMPT_TEMPLATES = [PLURAL_CHUNK_PROMPT, REWRITE_PROMPT, ANALYZE_PROMPT, BATCH_ANALYZE_PROMPT, BATCH_REWRITE_PROMPT]
+
+# Funzioni di supporto
+########################################
+
+def run_concurrently(func, args_list, max_workers=MAX_CONCURRENT_REQUESTS):
+    """
+    Esegue func(*args) per ogni tupla di argomenti, con al massimo max_workers
+    chiamate in volo. I risultati sono restituiti nello stesso ordine di args_list.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return []
+    workers = max(1, min(max_workers, len(args_list)))
+    if workers == 1:
+        return [func(*args) for args in args_list]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(propaga_contesto(func), *args) for args in args_list]
+        return [future.result() for future in futures]
+
+PatternMatch = namedtuple("PatternMatch", ["pattern", "start", "end"])
+
+_REGEX_METACHARS = set(".^$*+?{}[]\\|()")
+_QUANTIFIERS = set("*?{")
+
+def _is_word_char(c):
+    return c.isalnum() or c == "_"
+
+def _fold_case(text):
+    # Minuscolo carattere per carattere, così gli offset restano allineati al testo originale
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    return "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+class PatternMatcher:
+    """
+    Ricerca in un solo passaggio di tutti i pattern critici.
+    I pattern letterali (es. r"\bJoey\b") e i termini aggiuntivi finiscono in un automa
+    Aho-Corasick; le regex vere e proprie vengono valutate solo nelle posizioni in cui
+    l'automa trova il loro prefisso letterale (es. "io e", "mi chiamo "), oppure
+    sull'intero testo se non ne hanno uno.
+    """
+
+    def __init__(self, patterns, terms=()):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._literals = []  # (pattern, termine, confini di parola richiesti)
+        self._anchored = []  # (pattern, regex compilata)
+        self._unanchored = []
+        for pattern in patterns:
+            literal = self._literal_of(pattern)
+            if literal is not None:
+                self._add_literal(pattern, literal)
+                continue
+            compiled = re.compile(pattern, re.IGNORECASE)
+            prefix = self._prefix_of(pattern)
+            if prefix:
+                self._anchored.append((pattern, compiled))
+                self._add_word(prefix, ("regex", len(self._anchored) - 1))
+            else:
+                self._unanchored.append((pattern, compiled))
+        for term in terms:
+            term = term.strip()
+            if term:
+                self._add_literal(term, term)
+        self._build()
+
+    @staticmethod
+    def _literal_of(pattern):
+        """Restituisce il termine se il pattern è della forma \btermine\b (o un letterale puro)."""
+        inner = pattern
+        if inner.startswith(r"\b") and inner.endswith(r"\b"):
+            inner = inner[2:-2]
+        if inner and not any(c in _REGEX_METACHARS for c in inner):
+            return inner
+        return None
+
+    @staticmethod
+    def _prefix_of(pattern):
+        """Prefisso letterale obbligatorio della regex (vuoto se assente)."""
+        body = pattern[2:] if pattern.startswith(r"\b") else pattern
+        prefix = []
+        for c in body:
+            if c in _REGEX_METACHARS:
+                # Un quantificatore rende facoltativo il carattere precedente
+                if c in _QUANTIFIERS and prefix:
+                    prefix.pop()
+                break
+            prefix.append(c)
+        return "".join(prefix) if len(prefix) >= 2 else ""
+
+    def _add_literal(self, pattern, term):
+        self._literals.append((pattern, len(term), _is_word_char(term[0]), _is_word_char(term[-1])))
+        self._add_word(term, ("literal", len(self._literals) - 1))
+
+    def _add_word(self, word, payload):
+        state = 0
+        for c in _fold_case(word):
+            nxt = self._goto[state].get(c)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][c] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = nxt
+        self._output[state].append((len(word), payload))
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and c not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(c, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._output[nxt] = self._output[nxt] + self._output[self._fail[nxt]]
+
+    def find_all(self, text):
+        """Restituisce tutte le corrispondenze (pattern, inizio, fine), ordinate per posizione."""
+        matches = []
+        regex_end = {}
+        folded = _fold_case(text)
+        state = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for pos, c in enumerate(folded):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for length, (kind, index) in output[state]:
+                start, end = pos - length + 1, pos + 1
+                if kind == "literal":
+                    pattern, _, word_start, word_end = self._literals[index]
+                    if word_start and start > 0 and _is_word_char(text[start - 1]):
+                        continue
+                    if word_end and end < len(text) and _is_word_char(text[end]):
+                        continue
+                    matches.append(PatternMatch(pattern, start, end))
+                else:
+                    pattern, compiled = self._anchored[index]
+                    if start < regex_end.get(index, 0):
+                        continue
+                    found = compiled.match(text, start)
+                    if found:
+                        regex_end[index] = found.end()
+                        matches.append(PatternMatch(pattern, found.start(), found.end()))
+        for pattern, compiled in self._unanchored:
+            matches.extend(PatternMatch(pattern, m.start(), m.end()) for m in compiled.finditer(text))
+        matches.sort(key=lambda m: (m.start, -m.end))
+        return matches
+
+    def search(self, text):
+        """Prima corrispondenza nel testo, oppure None."""
+        matches = self.find_all(text)
+        return matches[0] if matches else None
+
+def load_critical_terms(path):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+@lru_cache(maxsize=None)
+def get_pattern_matcher():
+    return PatternMatcher(CRITICAL_PATTERNS, load_critical_terms(CRITICAL_TERMS_FILE))
+
+pattern_matcher = get_pattern_matcher()
+
+def highlight_matches(text, matches):
+    """Restituisce il testo in HTML con le parti corrispondenti ai pattern evidenziate."""
+    spans = []
+    for m in matches:
+        if spans and m.start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], m.end)
+        else:
+            spans.append([m.start, m.end])
+    parts, cursor = [], 0
+    for start, end in spans:
+        parts.append(html.escape(text[cursor:start]))
+        parts.append(f"<mark>{html.escape(text[start:end])}</mark>")
+        cursor = end
+    parts.append(html.escape(text[cursor:]))
+    return "".join(parts)
+
+def iter_concurrently(func, args_list, max_workers=MAX_CONCURRENT_REQUESTS):
+    """
+    Come run_concurrently, ma restituisce le coppie (indice, risultato) appena
+    ciascuna chiamata termina. Se l'iterazione viene interrotta, le chiamate non
+    ancora avviate sono annullate.
+    """
+    args_list = list(args_list)
+    if not args_list:
+        return
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(args_list))))
+    try:
+        futures = {executor.submit(propaga_contesto(func), *args): n for n, args in enumerate(args_list)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+class LLMCache:
+    """
+    Cache su disco (SQLite) delle risposte del modello, indirizzata per contenuto.
+    Le voci scadono dopo ttl_seconds; oltre max_entries vengono rimosse quelle
+    usate meno di recente. Le voci create con una versione diversa
+    (pattern o prompt modificati) vengono scartate all'apertura.
+    Le letture non scrivono su disco: l'ultimo accesso delle voci lette viene registrato
+    a gruppi (ACCESSI_PER_SCRITTURA voci, ogni SECONDI_PER_SCRITTURA secondi o alla prossima
+    scrittura), e le voci in eccesso vengono rimosse solo quando superano max_entries di
+    oltre il 10%, riportandole a max_entries.
+    """
+
+    ACCESSI_PER_SCRITTURA = 500
+    SECONDI_PER_SCRITTURA = 30.0
+
+    def __init__(self, path, version, max_entries=LLM_CACHE_MAX_ENTRIES, ttl_seconds=LLM_CACHE_TTL_SECONDS):
+        self.version = version
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._accessi = {}  # chiave -> ultimo accesso non ancora registrato
+        self._registrati = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL: le letture non attendono le scritture e i commit non richiedono un fsync ciascuno
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, version TEXT, function TEXT, response TEXT, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        self.purge()
+        self._voci = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, function, prompt, tone=None):
+        payload = json.dumps([model, function, prompt, tone], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND version = ? AND created >= ?",
+                (key, self.version, now - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._accessi[key] = now
+            if len(self._accessi) >= self.ACCESSI_PER_SCRITTURA or time.monotonic() - self._registrati >= self.SECONDI_PER_SCRITTURA:
+                self._registra_accessi()
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, function, response):
+        now = time.time()
+        with self._lock:
+            self._registra_accessi()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, version, function, response, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, self.version, function, response, now, now)
+            )
+            # Conteggio per eccesso (una sostituzione non aggiunge voci): l'eliminazione lo ricalcola
+            self._voci += 1
+            if self._voci > self.max_entries * 1.1:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+                self._voci = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            self._conn.commit()
+
+    def _registra_accessi(self):
+        """Scrive (senza commit) gli ultimi accessi in sospeso; va chiamata con il lock."""
+        if self._accessi:
+            self._conn.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(t, k) for k, t in self._accessi.items()])
+            self._accessi.clear()
+        self._registrati = time.monotonic()
+
+    def purge(self):
+        """Rimuove le voci scadute o create con una versione diversa."""
+        with self._lock:
+            self._registra_accessi()
+            self._conn.execute(
+                "DELETE FROM responses WHERE version != ? OR created < ?",
+                (self.version, time.time() - self.ttl_seconds)
+            )
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._accessi.clear()
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._voci = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"voci": entries, "hit": self.hits, "miss": self.misses}
+
+def cache_version():
+    """Impronta di pattern e prompt: cambia (invalidando la cache) quando uno dei due viene modificato."""
+    payload = json.dumps([MODEL, CRITICAL_PATTERNS, PROMPT_TEMPLATES], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+@lru_cache(maxsize=None)
+def get_llm_cache():
+    return LLMCache(LLM_CACHE_PATH, cache_version())
+
+class CircuitOpenError(RuntimeError):
+    """Richiesta rifiutata senza contattare l'API perché il circuito è aperto."""
+
+def _retry_after(error):
+    """Secondi indicati dall'header Retry-After (o retry-after-ms) della risposta, se presente."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def _is_retryable(error):
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    status = getattr(error, "status_code", None)
+    return status in (408, 409, 429) or (status is not None and status >= 500)
+
+class RequestScheduler:
+    """
+    Punto di passaggio di tutte le richieste al modello, condiviso dal processo.
+      - Token bucket: al massimo rate_per_minute richieste al minuto, con picchi di burst.
+      - Concorrenza adattiva (AIMD): il limite di richieste in volo cresce di uno ogni
+        "limite" successi e si dimezza a ogni 429, errore 5xx o timeout.
+      - Ritentativi: rispetta Retry-After (sospendendo anche le altre richieste),
+        altrimenti attende con backoff esponenziale e jitter.
+      - Circuit breaker: dopo failure_threshold errori consecutivi le richieste falliscono
+        subito con CircuitOpenError per cooldown secondi; poi una sola richiesta di prova
+        decide se richiudere il circuito.
+    """
+
+    def __init__(self, rate_per_minute=REQUESTS_PER_MINUTE, burst=REQUEST_BURST, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                 retries=REQUEST_RETRIES, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.retries = retries
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._condition = threading.Condition()
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._limit = self.max_concurrency
+        self._credit = 0.0
+        self._last_decrease = 0.0
+        self._local = threading.local()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe = False
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+        self.last_error = ""
+
+    def _refill(self, now):
+        if self.rate <= 0:
+            self._tokens = float(self.burst)
+            return
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _check_circuit(self, now):
+        if self._opened_at is None:
+            return
+        remaining = self._opened_at + self.cooldown - now
+        if remaining > 0 or self._probe:
+            raise CircuitOpenError(f"API sospesa dopo {self._consecutive_failures} errori consecutivi: {self.last_error}")
+        self._probe = True  # semiaperto: passa solo questa richiesta
+
+    def acquire(self):
+        """Attende un posto libero e un token; solleva CircuitOpenError se il circuito è aperto."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._check_circuit(now)
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0 and self._in_flight < self._limit:
+                    if self.rate <= 0 or self._tokens >= 1:
+                        self._tokens -= 1
+                        self._in_flight += 1
+                        self.requests += 1
+                        self._local.started = now
+                        return
+                    wait = (1 - self._tokens) / self.rate if self.rate > 0 else 1.0
+                if self._probe and self._opened_at is not None:
+                    self._probe = False  # la richiesta di prova non è partita: la cede a chi arriva dopo
+                self._condition.wait(wait if wait > 0 else None)
+
+    def release(self, error=None):
+        """Libera il posto e aggiorna concorrenza e circuito in base all'esito."""
+        with self._condition:
+            self._in_flight -= 1
+            if error is None:
+                self._consecutive_failures = 0
+                self._opened_at = None
+                self._probe = False
+                if self._limit < self.max_concurrency:
+                    self._credit += 1 / self._limit
+                    if self._credit >= 1:
+                        self._limit += 1
+                        self._credit = 0.0
+            elif _is_retryable(error):
+                now = time.monotonic()
+                self.failures += 1
+                self.last_error = f"{type(error).__name__}: {error}"
+                self._consecutive_failures += 1
+                # Un solo dimezzamento per ondata di errori: le richieste partite prima
+                # dell'ultimo dimezzamento non lo ripetono
+                if getattr(self._local, "started", now) >= self._last_decrease:
+                    self._limit = max(1, self._limit // 2)
+                    self._credit = 0.0
+                    self._last_decrease = now
+                retry_after = _retry_after(error)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                if self._probe or self._consecutive_failures >= self.failure_threshold:
+                    if self._opened_at is None:
+                        logger.error(f"⚠️ Circuito aperto: richieste sospese per {self.cooldown:.0f} s ({self.last_error})")
+                    self._opened_at = now
+                    self._probe = False
+            else:
+                # Errore definitivo (es. richiesta non valida): l'API ha comunque risposto
+                self._consecutive_failures = 0
+                self._opened_at = None
+                self._probe = False
+            self._condition.notify_all()
+
+    def _backoff(self, error, attempt):
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, RETRY_MAX_DELAY)
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    def call(self, func, keep_slot=False, label=None):
+        """
+        Esegue func() rispettando i limiti e ritentando gli errori temporanei.
+        Gli altri errori, e l'ultimo dopo REQUEST_RETRIES tentativi, vengono rilanciati.
+        Con keep_slot il posto resta occupato dopo il successo: va liberato con release().
+        label è la funzione a cui attribuire i ritentativi nelle metriche.
+        """
+        for attempt in itertools.count():
+            self.acquire()
+            try:
+                result = func()
+            except Exception as e:
+                self.release(e)
+                if not _is_retryable(e) or attempt >= self.retries:
+                    raise
+                delay = self._backoff(e, attempt)
+                with self._condition:
+                    self.retried += 1
+                if label:
+                    get_metrics().add_llm(label, ritentativi=1)
+                logger.info(f"Nuovo tentativo tra {delay:.1f} s ({type(e).__name__}, tentativo {attempt + 1} di {self.retries})")
+                time.sleep(delay)
+                continue
+            if not keep_slot:
+                self.release()
+            return result
+
+    def status(self):
+        with self._condition:
+            now = time.monotonic()
+            if self._opened_at is None:
+                stato, riapertura = "chiuso", 0.0
+            else:
+                riapertura = max(0.0, self._opened_at + self.cooldown - now)
+                stato = "aperto" if riapertura > 0 else "semiaperto"
+            return {
+                "stato": stato,
+                "riapertura": riapertura,
+                "pausa": max(0.0, self._paused_until - now),
+                "concorrenza": self._limit,
+                "max_concorrenza": self.max_concurrency,
+                "in_volo": self._in_flight,
+                "richieste": self.requests,
+                "ritentativi": self.retried,
+                "errori": self.failures,
+                "ultimo_errore": self.last_error,
+            }
+
+@lru_cache(maxsize=None)
+def get_scheduler():
+    return RequestScheduler()
+
+# Contatori delle esecuzioni misurate (misura_esecuzione) in corso nel contesto corrente
+_esecuzioni = contextvars.ContextVar("esecuzioni", default=())
+
+def propaga_contesto(func):
+    """
+    func da eseguire in un altro thread (pool) con una copia del contesto corrente, così che
+    le sue metriche vengano attribuite alle esecuzioni misurate che l'hanno avviata.
+    Va chiamata una volta per ogni esecuzione di func.
+    """
+    return partial(contextvars.copy_context().run, func)
+
+class Metrics:
+    """
+    Contatori del processo: tempo e numero di esecuzioni di ogni fase (tempo inclusivo:
+    una fase comprende quelle che richiama) e, per ogni funzione che interroga il modello,
+    richieste, risposte dalla cache, token, ritentativi, errori e tempo di attesa.
+    Ogni conteggio viene aggiunto anche alle esecuzioni misurate del contesto corrente.
+    """
+
+    LLM_COUNTERS = ("richieste", "cache_hit", "prompt_tokens", "completion_tokens", "ritentativi", "errori", "secondi")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.llm = {}
+
+    def add_stage(self, name, seconds):
+        for metrics in (self, *_esecuzioni.get()):
+            with metrics._lock:
+                stage = metrics.stages.setdefault(name, {"chiamate": 0, "secondi": 0.0})
+                stage["chiamate"] += 1
+                stage["secondi"] += seconds
+
+    def add_llm(self, function, **counters):
+        for metrics in (self, *_esecuzioni.get()):
+            with metrics._lock:
+                entry = metrics.llm.setdefault(function, dict.fromkeys(self.LLM_COUNTERS, 0))
+                for name, value in counters.items():
+                    entry[name] += value
+
+    def add_usage(self, function, usage):
+        """Token indicati da response.usage (assente per alcuni modelli)."""
+        if usage is not None:
+            self.add_llm(
+                function,
+                prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+                completion_tokens=getattr(usage, "completion_tokens", 0) or 0
+            )
+
+    def snapshot(self):
+        with self._lock:
+            return {"fasi": copy.deepcopy(self.stages), "llm": copy.deepcopy(self.llm)}
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.llm.clear()
+
+@lru_cache(maxsize=None)
+def get_metrics():
+    return Metrics()
+
+@contextmanager
+def fase(name):
+    """Misura una fase della pipeline; si usa come blocco with o come decoratore."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        get_metrics().add_stage(name, time.perf_counter() - start)
+
+def _rounded(counters):
+    return {name: {key: round(value, 4) for key, value in values.items()} for name, values in counters.items()}
+
+_profiling = threading.Lock()
+
+@contextmanager
+def misura_esecuzione(name, **info):
+    """
+    Misura un'esecuzione completa (analisi di un documento, riscrittura, conversione...)
+    e ne aggiunge il riepilogo a METRICS_PATH come riga JSON. Con PROFILE_DIR impostata
+    salva anche il profilo cProfile dell'esecuzione (una alla volta per processo), limitato
+    al thread che la esegue: i thread dei pool restano fuori, e le loro attese compaiono come
+    attese sui risultati. Fasi e richieste al modello sono solo quelle dell'esecuzione (anche
+    dai thread avviati con propaga_contesto), non quelle di altre esecuzioni contemporanee.
+    """
+    metrics = Metrics()
+    token = _esecuzioni.set((*_esecuzioni.get(), metrics))
+    start = time.perf_counter()
+    profiler = None
+    if PROFILE_DIR and _profiling.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        _esecuzioni.reset(token)
+        record = {"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "esecuzione": name, **info}
+        record["secondi"] = round(time.perf_counter() - start, 4)
+        if profiler is not None:
+            try:
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                record["profilo"] = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+                profiler.disable()
+                pstats.Stats(profiler).dump_stats(record["profilo"])
+            except Exception as e:
+                logger.error(f"⚠️ Errore nel salvataggio del profilo: {e}")
+            finally:
+                _profiling.release()
+        misure = metrics.snapshot()
+        record["fasi"] = _rounded(misure["fasi"])
+        record["llm"] = _rounded(misure["llm"])
+        if METRICS_PATH:
+            try:
+                with open(METRICS_PATH, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError as e:
+                logger.error(f"⚠️ Errore nella scrittura delle metriche: {e}")
+
+class Job:
+    """
+    Elaborazione eseguita in background da JobManager. La funzione del job riceve il job
+    stesso: con aggiorna() riporta l'avanzamento e i risultati parziali, con cancel_event
+    (impostato da annulla()) sa quando fermarsi. Completato il job, risultato contiene quanto
+    restituito dalla funzione; se fallisce, errore contiene l'eccezione.
+    Stati: "in coda", "in corso", "completato", "annullato", "errore".
+    """
+
+    def __init__(self, tipo):
+        self.id = uuid.uuid4().hex
+        self.tipo = tipo
+        self.stato = "in coda"
+        self.fase = None
+        self.completati = 0
+        self.totale = None
+        self.parziale = None
+        self.risultato = None
+        self.errore = None
+        self.terminato_il = None
+        self.cancel_event = threading.Event()
+
+    def aggiorna(self, completati, totale, parziale=None, fase=None):
+        self.completati = completati
+        self.totale = totale
+        if parziale is not None:
+            self.parziale = parziale
+        if fase is not None:
+            self.fase = fase
+
+    def annulla(self):
+        self.cancel_event.set()
+
+    @property
+    def annullato(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def terminato(self):
+        return self.terminato_il is not None
+
+class JobManager:
+    """
+    Esecutore dei job del processo (analisi, riscritture, conversioni avviate dall'interfaccia):
+    i job proseguono indipendentemente dai rerun di Streamlit e si ritrovano con get(id).
+    Chi usa il risultato di un job lo rimuove (rimuovi); quelli terminati e mai rimossi
+    vengono dimenticati dopo ttl_seconds. I risultati parziali, e il risultato di un job
+    annullato o fallito, vengono scartati appena il job termina.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, ttl_seconds=JOB_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, tipo, func, *args):
+        """Avvia func(job, *args) in background e restituisce il job."""
+        job = Job(tipo)
+        with self._lock:
+            self._pulisci()
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, func, args)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def rimuovi(self, job_id):
+        """Dimentica il job (annullandolo se è ancora in corso)."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.annulla()
+
+    def status(self):
+        """Numero di job per stato."""
+        with self._lock:
+            self._pulisci()
+            stati = [job.stato for job in self._jobs.values()]
+        return {stato: stati.count(stato) for stato in set(stati)}
+
+    def _pulisci(self):
+        scadenza = time.monotonic() - self.ttl_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.terminato and job.terminato_il < scadenza]:
+            del self._jobs[job_id]
+
+    def _run(self, job, func, args):
+        if job.annullato:
+            job.stato = "annullato"
+            job.terminato_il = time.monotonic()
+            return
+        job.stato = "in corso"
+        try:
+            risultato = func(job, *args)
+            if job.annullato:
+                job.stato = "annullato"
+            else:
+                job.risultato = risultato
+                job.stato = "completato"
+        except Exception as e:
+            logger.error(f"⚠️ Errore nel job {job.tipo} {job.id}: {e}")
+            job.errore = e
+            job.stato = "errore"
+        finally:
+            job.parziale = None
+            job.terminato_il = time.monotonic()
+
+@lru_cache(maxsize=None)
+def get_jobs():
+    return JobManager()
+
+def _elimina_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class FileCaricati:
+    """
+    Copie temporanee dei documenti caricati nell'interfaccia, per processo. Ogni sessione
+    segnala a ogni rerun (usa) il file su cui lavora; quelli non usati da ttl_seconds (sessione
+    chiusa o abbandonata) vengono eliminati, come quelli rimasti alla chiusura del processo:
+    i documenti contengono dati personali e non devono accumularsi nella cartella temporanea.
+    """
+
+    def __init__(self, ttl_seconds=UPLOAD_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._usati = {}  # percorso -> ultimo uso
+        atexit.register(self.svuota)
+
+    def salva(self, source, suffix=""):
+        """Copia il file aperto source in un nuovo file temporaneo e ne restituisce il percorso."""
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            source.seek(0)
+            shutil.copyfileobj(source, f)
+        source.seek(0)
+        with self._lock:
+            self._pulisci()
+            self._usati[f.name] = time.monotonic()
+        return f.name
+
+    def usa(self, path):
+        """Segnala che path è ancora in uso; False se non esiste più (scaduto o rimosso)."""
+        with self._lock:
+            self._pulisci()
+            if path not in self._usati:
+                return False
+            self._usati[path] = time.monotonic()
+            return True
+
+    def rimuovi(self, path):
+        with self._lock:
+            self._usati.pop(path, None)
+        _elimina_file(path)
+
+    def svuota(self):
+        with self._lock:
+            percorsi = list(self._usati)
+            self._usati.clear()
+        for path in percorsi:
+            _elimina_file(path)
+
+    def _pulisci(self):
+        scadenza = time.monotonic() - self.ttl_seconds
+        for path in [path for path, usato in self._usati.items() if usato < scadenza]:
+            del self._usati[path]
+            _elimina_file(path)
+
+@lru_cache(maxsize=None)
+def get_file_caricati():
+    return FileCaricati()
+
+def chat_completion(function, prompt, max_tokens, tone=None, timeout=None, validate=None):
+    """
+    Invia il prompt al modello e restituisce il testo della risposta.
+    Le risposte non vuote (e, se indicato, accettate da validate) vengono salvate in cache
+    e riutilizzate alle richieste successive.
+    """
+    cache = get_llm_cache()
+    metrics = get_metrics()
+    key = LLMCache.make_key(MODEL, function, prompt, tone)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics.add_llm(function, cache_hit=1)
+        return cached
+    kwargs = {"timeout": timeout} if timeout else {}
+    start = time.perf_counter()
+    try:
+        response = get_scheduler().call(lambda: get_client().chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "system", "content": prompt}],
+            max_tokens=max_tokens,
+            **kwargs
+        ), label=function)
+    except Exception:
+        metrics.add_llm(function, errori=1, secondi=time.perf_counter() - start)
+        raise
+    metrics.add_llm(function, richieste=1, secondi=time.perf_counter() - start)
+    metrics.add_usage(function, getattr(response, "usage", None))
+    raw_output = response.choices[0].message.content.strip() if (response and hasattr(response, "choices") and response.choices) else ""
+    if raw_output and (validate is None or validate(raw_output)):
+        cache.set(key, function, raw_output)
+    return raw_output
+
+# Elementi che delimitano un blocco di testo; tutti gli altri (span, a, b, em...) sono in linea
+BLOCK_TAGS = frozenset((
+    "title", "body", "p", "div", "li", "h1", "h2", "h3", "h4", "h5", "h6",
+    "td", "th", "caption", "blockquote", "pre", "dt", "dd", "figcaption",
+    "section", "article", "header", "footer", "nav", "aside", "main", "address",
+))
+# Elementi il cui contenuto non è testo del documento
+SKIP_TAGS = frozenset(("script", "style", "noscript", "template"))
+# Elementi vuoti che separano il testo che li circonda (es. "Joey<br>Mya" sono due parole)
+BREAK_TAGS = frozenset(("br", "hr", "img", "input", "embed"))
+
+class Block:
+    """
+    Blocco di testo del documento.
+    id è la posizione nella lista dei blocchi (quindi i vicini sono blocks[id - 1] e blocks[id + 1]);
+    location indica da dove proviene il testo: la posizione dell'elemento HTML
+    nell'ordine di documento (root.iter()).
+    """
+    __slots__ = ("id", "text", "location")
+
+    def __init__(self, id, text, location=None):
+        self.id = id
+        self.text = text
+        self.location = location
+
+    def __repr__(self):
+        return f"Block({self.id}, {self.text!r})"
+
+def parse_html(html_content):
+    """Albero lxml del documento (None se vuoto)."""
+    from lxml import etree
+    if not html_content.strip():
+        return None
+    return etree.fromstring(html_content.encode("utf-8"), etree.HTMLParser(encoding="utf-8"))
+
+_DOCTYPE = re.compile(r"\A\ufeff?\s*(?:<!--.*?-->\s*)*<!doctype", re.IGNORECASE | re.DOTALL)
+
+def _has_doctype(html_content):
+    """True se il documento dichiara un doctype (eventualmente dopo dei commenti)."""
+    return _DOCTYPE.match(html_content) is not None
+
+def serialize_html(root, doctype=True):
+    """
+    Serializza il documento di root. Con doctype=False (sorgente senza doctype, es. l'HTML
+    generato dal Markdown) si omette quello che lxml aggiunge, che cambierebbe la modalità di
+    visualizzazione del documento.
+    """
+    from lxml import etree
+    tree = root.getroottree()
+    text = etree.tostring(tree, method="html", encoding="unicode")
+    if not doctype and tree.docinfo.doctype and text.startswith(tree.docinfo.doctype):
+        text = text[len(tree.docinfo.doctype):].lstrip("\n")
+    return text
+
+def _is_block(element):
+    return isinstance(element.tag, str) and element.tag in BLOCK_TAGS
+
+def extract_html_blocks(root):
+    """
+    Estrae i blocchi di testo in un solo passaggio sull'albero. Ogni elemento di BLOCK_TAGS
+    produce al più un blocco con il proprio testo (compreso quello degli elementi in linea),
+    escluso quello dei blocchi annidati: lo stesso testo non compare mai due volte.
+    """
+    if root is None:
+        return []
+    slots = []  # (posizione dell'elemento in root.iter(), frammenti di testo), in ordine di apertura
+    counter = itertools.count()
+
+    def walk(element, parts):
+        position = next(counter)
+        if not isinstance(element.tag, str):  # commenti e istruzioni di elaborazione
+            return
+        if element.tag in SKIP_TAGS:
+            for _ in element.iterdescendants():
+                next(counter)
+            return
+        if element.tag in BREAK_TAGS:
+            parts.append(" ")
+        if element.tag in BLOCK_TAGS:
+            parts = []
+            slots.append((position, parts))
+        if element.text:
+            parts.append(element.text)
+        for child in element:
+            walk(child, parts)
+            # La coda appartiene al blocco che contiene l'elemento
+            if child.tail:
+                parts.append(child.tail)
+
+    walk(root, [])
+    blocks = []
+    for position, parts in slots:
+        text = " ".join("".join(parts).split())
+        if text:
+            blocks.append(Block(len(blocks), text, position))
+    return blocks
+
+def _clear_own_text(element):
+    """Rimuove il testo proprio di un blocco, lasciando al loro posto i blocchi annidati."""
+    element.text = None
+    for child in list(element):
+        if _is_block(child):
+            child.tail = None
+        elif any(_is_block(descendant) for descendant in child.iterdescendants()):
+            # Contenitore (ul, table...) di altri blocchi: ne resta solo la struttura
+            _clear_own_text(child)
+            child.tail = None
+        else:
+            element.remove(child)  # rimuove anche la coda dell'elemento in linea
+
+def _set_block_text(element, new_text, highlight):
+    """Sostituisce il testo proprio di un blocco con new_text."""
+    _clear_own_text(element)
+    if highlight and new_text:
+        from lxml import etree
+        mark = etree.Element("mark")
+        mark.text = new_text
+        element.text = None
+        element.insert(0, mark)
+    else:
+        element.text = new_text or None
+
+def _text_slots(root):
+    """Nodi di testo (elemento, "text" o "tail") non vuoti del documento, in ordine."""
+    slots = []
+    skip_roots = set()
+    for element in root.iter():
+        inside_skip = element in skip_roots or (isinstance(element.tag, str) and element.tag in SKIP_TAGS)
+        if inside_skip:
+            skip_roots.update(element)
+        elif isinstance(element.tag, str) and element.text and element.text.strip():
+            slots.append((element, "text"))
+        if element is not root and element.tail and element.tail.strip() and element.getparent() not in skip_roots:
+            slots.append((element, "tail"))
+    return slots
+
+def contesto_blocchi(blocchi, indici):
+    """
+    {indice: (precedente, successivo)} dei blocchi in posizione indici ("" prima del primo e
+    dopo l'ultimo), leggendo una sola volta un iterabile di testi (anche un generatore del parser):
+    in memoria restano solo gli ultimi blocchi letti, e la lettura si ferma appena li ha trovati tutti.
+    """
+    indici = set(indici)
+    contesti = {}
+    if not indici:
+        return contesti
+    precedente, corrente = "", None
+    # Il blocco vuoto finale fa da successivo dell'ultimo
+    for i, blocco in enumerate(itertools.chain(blocchi, [""])):
+        if i - 1 in indici:
+            contesti[i - 1] = (precedente, blocco)
+            if len(contesti) == len(indici):
+                break
+        precedente, corrente = "" if corrente is None else corrente, blocco
+    return contesti
+
+def _rewrite_prompt(text, prev_text, next_text, tone):
+    return REWRITE_PROMPT.format(prev_text=prev_text, text=text, next_text=next_text, tone=tone)
+
+def stream_chat_completion(function, prompt, max_tokens, timeout=None, validate=None, cancel_event=None):
+    """
+    Come chat_completion, ma restituisce i frammenti di testo man mano che arrivano (stream=True).
+    Se cancel_event viene impostato lo stream viene chiuso; le risposte complete finiscono in cache.
+    """
+    cache = get_llm_cache()
+    metrics = get_metrics()
+    key = LLMCache.make_key(MODEL, function, prompt)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics.add_llm(function, cache_hit=1)
+        yield cached
+        return
+    kwargs = {"timeout": timeout} if timeout else {}
+    parts = []
+    # Il posto resta occupato finché lo stream è aperto
+    scheduler = get_scheduler()
+    start = time.perf_counter()
+    try:
+        stream = scheduler.call(lambda: get_client().chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "system", "content": prompt}],
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs
+        ), keep_slot=True, label=function)
+    except Exception:
+        metrics.add_llm(function, errori=1, secondi=time.perf_counter() - start)
+        raise
+    error = None
+    try:
+        for event in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            # L'utilizzo di token arriva nell'ultimo evento, senza scelte
+            metrics.add_usage(function, getattr(event, "usage", None))
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        stream.close()
+        scheduler.release(error)
+        metrics.add_llm(function, richieste=1, errori=int(error is not None), secondi=time.perf_counter() - start)
+    raw_output = "".join(parts).strip()
+    if raw_output and (validate is None or validate(raw_output)):
+        cache.set(key, function, raw_output)
+
+def iter_json_array_items(deltas):
+    """
+    Decodifica in modo incrementale un array JSON ricevuto a frammenti,
+    restituendo ciascun elemento appena è completo.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = None
+    for delta in deltas:
+        buffer += delta
+        if pos is None:
+            start = buffer.find("[")
+            if start < 0:
+                continue
+            pos = start + 1
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buffer) or buffer[pos] == "]":
+                break
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break
+            if not isinstance(item, (str, list, dict)) and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+                break  # un numero potrebbe continuare nel frammento successivo (es. "12." + "5")
+            yield item
+            pos = end
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+def ai_rewrite_text(text, prev_text, next_text, tone):
+    """Riscrive il blocco nel tono indicato; restituisce None se la riscrittura non è disponibile."""
+    prompt = _rewrite_prompt(text, prev_text, next_text, tone)
+    try:
+        rewritten = chat_completion("ai_rewrite_text", prompt, max_tokens=50, tone=tone)
+        if rewritten:
+            return rewritten
+        logger.error("⚠️ Errore: Nessun testo valido restituito dall'API per la riscrittura del blocco.")
+        return None
+    except Exception as e:
+        logger.error(f"⚠️ Errore nell'elaborazione (riscrittura del blocco): {e}")
+        return None
+
+def _analyze_prompt(prev_text, text, next_text):
+    return ANALYZE_PROMPT.format(prev_text=prev_text, text=text, next_text=next_text)
+
+def ai_analyze_block(prev_text, text, next_text):
+    prompt = _analyze_prompt(prev_text, text, next_text)
+    try:
+        raw_output = chat_completion("ai_analyze_block", prompt, max_tokens=150)
+        logger.debug(f"Risposta grezza per il blocco: {raw_output}")
+        if not raw_output:
+            logger.error("⚠️ Errore: Nessun testo valido restituito dall'API per l'analisi del blocco.")
+            return None
+        return raw_output
+    except Exception as e:
+        logger.error(f"⚠️ Errore nell'analisi del blocco: {e}")
+        return None
+
+def estimate_tokens(text):
+    # Stima approssimativa: circa 4 caratteri per token
+    return len(text) // 4 + 1
+
+def make_batches(items, text_of, max_items=BATCH_SIZE, token_budget=BATCH_TOKEN_BUDGET):
+    """
+    Suddivide items in gruppi consecutivi di al massimo max_items elementi,
+    senza superare token_budget (stimato su text_of(item)) per gruppo.
+    """
+    batches, current, used = [], [], 0
+    for item in items:
+        cost = estimate_tokens(text_of(item))
+        if current and (len(current) >= max_items or used + cost > token_budget):
+            batches.append(current)
+            current, used = [], 0
+        current.append(item)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+def parse_json_response(raw_output):
+    """Decodifica la risposta JSON del modello, tollerando i blocchi ```json ... ```."""
+    if not raw_output:
+        return None
+    text = raw_output.strip()
+    if text.startswith("```"):
+        text = re.sub(r"^```[a-zA-Z]*\s*|\s*```$", "", text)
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+def _truncate_context(text):
+    return text if len(text) <= BATCH_CONTEXT_CHARS else text[:BATCH_CONTEXT_CHARS] + "..."
+
+def _batch_completion(function, prompt, max_tokens, description):
+    """
+    Elementi dell'array JSON restituito per un gruppo. Se la risposta è troncata (limite di
+    max_tokens) si recuperano gli elementi completi: solo i mancanti vengono rielaborati singolarmente.
+    Restituisce None se la richiesta non è riuscita (429 o timeout dopo i ritentativi, circuito
+    aperto...): gli elementi del gruppo non vanno allora richiesti uno per uno, moltiplicando le
+    richieste proprio mentre l'API è in difficoltà.
+    """
+    try:
+        raw_output = chat_completion(function, prompt, max_tokens=max_tokens, validate=lambda raw: isinstance(parse_json_response(raw), list))
+        logger.debug(f"Risposta grezza per il gruppo ({description}): {raw_output}")
+        result = parse_json_response(raw_output)
+        if isinstance(result, list):
+            return result
+        result = list(iter_json_array_items([raw_output or ""]))
+        if result:
+            logger.error(f"⚠️ Risposta incompleta per il gruppo ({description}): recuperati {len(result)} elementi.")
+        else:
+            logger.error(f"⚠️ Errore: risposta non valida per il gruppo ({description}).")
+        return result
+    except Exception as e:
+        logger.error(f"⚠️ Errore nell'elaborazione del gruppo ({description}): {e}")
+        return None
+
+def ai_analyze_blocks_batch(items):
+    """
+    Classifica più blocchi con una sola richiesta.
+    items: lista di tuple (id, precedente, testo, successivo).
+    Restituisce {id: {"classificazione": ...}} per i soli elementi validi, o None se la richiesta
+    non è riuscita.
+    """
+    payload = [
+        {"id": item_id, "precedente": _truncate_context(prev_text), "testo": text, "successivo": _truncate_context(next_text)}
+        for item_id, prev_text, text, next_text in items
+    ]
+    prompt = BATCH_ANALYZE_PROMPT.format(payload=json.dumps(payload, ensure_ascii=False))
+    expected = {item_id for item_id, _, _, _ in items}
+    entries = _batch_completion("ai_analyze_blocks_batch", prompt, 60 * len(items) + 100, "analisi")
+    if entries is None:
+        return None
+    results = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get("id") not in expected:
+            continue
+        if entry.get("classificazione") not in ("Critico", "Non critico"):
+            continue
+        results[entry["id"]] = {"classificazione": entry["classificazione"]}
+    return results
+
+@fase("analisi_ai")
+def analyze_blocks(items):
+    """
+    Classifica i blocchi raggruppandoli in batch eseguiti in parallelo.
+    items: lista di tuple (id, precedente, testo, successivo).
+    Restituisce, nello stesso ordine, il dizionario di analisi di ogni blocco (None se non disponibile).
+    I blocchi già analizzati vengono letti dalla cache; gli elementi mancanti o non validi
+    nella risposta di gruppo vengono rianalizzati singolarmente, quelli dei gruppi la cui
+    richiesta non è riuscita restano senza analisi.
+    """
+    cache = get_llm_cache()
+    keys = {
+        item_id: LLMCache.make_key(MODEL, "ai_analyze_block", _analyze_prompt(prev_text, text, next_text))
+        for item_id, prev_text, text, next_text in items
+    }
+    merged = {}
+    for item_id, key in keys.items():
+        result = parse_json_response(cache.get(key))
+        if isinstance(result, dict):
+            merged[item_id] = result
+    if merged:
+        get_metrics().add_llm("ai_analyze_block", cache_hit=len(merged))
+    pending = [item for item in items if item[0] not in merged]
+    non_disponibili = set()
+    if BATCH_SIZE > 1 and pending:
+        batches = make_batches(pending, lambda item: item[2])
+        for batch, batch_result in zip(batches, run_concurrently(ai_analyze_blocks_batch, [(batch,) for batch in batches])):
+            if batch_result is None:
+                non_disponibili.update(item[0] for item in batch)
+                continue
+            for item_id, result in batch_result.items():
+                merged[item_id] = result
+                cache.set(keys[item_id], "ai_analyze_block", json.dumps(result, ensure_ascii=False))
+    missing = [item for item in pending if item[0] not in merged and item[0] not in non_disponibili]
+    if missing:
+        singoli = run_concurrently(ai_analyze_block, [(prev_text, text, next_text) for _, prev_text, text, next_text in missing])
+        for (item_id, _, _, _), analysis in zip(missing, singoli):
+            result = parse_json_response(analysis)
+            if isinstance(result, dict):
+                merged[item_id] = result
+            elif analysis:
+                logger.error("Errore nel parsing dell'analisi del blocco.")
+    return [merged.get(item[0]) for item in items]
+
+def ai_rewrite_texts_batch(items):
+    """
+    Riscrive più blocchi con una sola richiesta.
+    items: lista di tuple (id, testo, precedente, successivo, tono).
+    Restituisce {id: testo riscritto} per i soli elementi validi, o None se la richiesta non è riuscita.
+    """
+    payload = [
+        {"id": item_id, "precedente": _truncate_context(prev_text), "testo": text, "successivo": _truncate_context(next_text), "tono": tone}
+        for item_id, text, prev_text, next_text, tone in items
+    ]
+    prompt = BATCH_REWRITE_PROMPT.format(payload=json.dumps(payload, ensure_ascii=False))
+    expected = {item[0] for item in items}
+    entries = _batch_completion("ai_rewrite_texts_batch", prompt, 50 * len(items) + 100, "riscrittura")
+    if entries is None:
+        return None
+    results = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get("id") not in expected:
+            continue
+        text = entry.get("testo")
+        if isinstance(text, str) and text.strip():
+            results[entry["id"]] = text.strip()
+    return results
+
+@fase("riscrittura_ai")
+def rewrite_blocks(items, on_result=None, cancel_event=None):
+    """
+    Riscrive i blocchi raggruppandoli in batch eseguiti in parallelo.
+    items: lista di tuple (testo, precedente, successivo, tono).
+    Restituisce i testi riscritti nello stesso ordine (None per quelli non disponibili). Le riscritture già note
+    vengono lette dalla cache; gli elementi non validi nella risposta di gruppo
+    vengono riscritti singolarmente, quelli dei gruppi la cui richiesta non è riuscita
+    restano non riscritti (None). on_result(indice, testo riscritto), se indicato,
+    viene chiamata appena ciascuna riscrittura è disponibile. Impostando cancel_event le
+    richieste non ancora avviate vengono annullate.
+    """
+    cache = get_llm_cache()
+    keys = [
+        LLMCache.make_key(MODEL, "ai_rewrite_text", _rewrite_prompt(text, prev_text, next_text, tone), tone)
+        for text, prev_text, next_text, tone in items
+    ]
+    merged = {}
+
+    def deliver(n, rewritten):
+        merged[n] = rewritten
+        if on_result:
+            on_result(n, rewritten)
+
+    for n, key in enumerate(keys):
+        cached = cache.get(key)
+        if cached is not None:
+            deliver(n, cached)
+    if merged:
+        get_metrics().add_llm("ai_rewrite_text", cache_hit=len(merged))
+    pending = [(n, text, prev_text, next_text, tone) for n, (text, prev_text, next_text, tone) in enumerate(items) if n not in merged]
+    if BATCH_SIZE > 1 and pending:
+        batches = make_batches(pending, lambda item: item[1])
+        for k, batch_result in iter_concurrently(ai_rewrite_texts_batch, [(batch,) for batch in batches]):
+            if batch_result is None:
+                for item in batches[k]:
+                    deliver(item[0], None)
+                batch_result = {}
+            for n, rewritten in batch_result.items():
+                cache.set(keys[n], "ai_rewrite_text", rewritten)
+                deliver(n, rewritten)
+            if cancel_event is not None and cancel_event.is_set():
+                break
+    if cancel_event is not None and cancel_event.is_set():
+        pending = []
+    missing = [item for item in pending if item[0] not in merged]
+    for k, rewritten in iter_concurrently(ai_rewrite_text, [item[1:] for item in missing]):
+        deliver(missing[k][0], rewritten)
+        if cancel_event is not None and cancel_event.is_set():
+            break
+    return [merged.get(n) for n in range(len(items))]
+
+def ai_convert_chunk_to_plural(texts, context):
+    """
+    Converte in plurale una sequenza di parti consecutive del documento con una sola richiesta.
+    Restituisce la lista delle parti convertite, oppure None se anche l'ultimo tentativo fallisce.
+    """
+    payload = json.dumps(texts, ensure_ascii=False)
+    prompt = PLURAL_CHUNK_PROMPT.format(context="\n".join(context) or "(nessuno)", payload=payload)
+
+    for attempt in range(CONVERSION_RETRIES + 1):
+        if attempt:
+            time.sleep(attempt)
+        try:
+            raw_output = chat_completion(
+                "ai_convert_chunk_to_plural", prompt,
+                max_tokens=2 * estimate_tokens(payload) + 100,
+                timeout=CONVERSION_TIMEOUT,
+                validate=lambda raw: _valid_string_list(raw, len(texts))
+            )
+            if _valid_string_list(raw_output, len(texts)):
+                return parse_json_response(raw_output)
+            logger.error(f"⚠️ Errore: risposta non valida per la conversione in plurale (tentativo {attempt + 1}).")
+        except CircuitOpenError as e:
+            logger.error(f"⚠️ Errore nell'elaborazione (conversione in plurale): {e}")
+            return None
+        except Exception as e:
+            logger.error(f"⚠️ Errore nell'elaborazione (conversione in plurale, tentativo {attempt + 1}): {e}")
+    return None
+
+def _valid_string_list(raw_output, length):
+    result = parse_json_response(raw_output)
+    return isinstance(result, list) and len(result) == length and all(isinstance(item, str) for item in result)
+
+def _split_sentences(text):
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text) if sentence]
+
+class PluralConversion:
+    """
+    Conversione in plurale di una lista di parti del documento (paragrafi, nodi di testo...).
+    Le parti vengono raggruppate in blocchi entro token_budget (le parti troppo lunghe
+    sono spezzate per frasi), convertiti in parallelo con le ultime parti del blocco
+    precedente come contesto. Ogni blocco viene ricevuto in streaming: iterando si ottengono
+    le coppie (indice della parte, testo convertito) nell'ordine originale, appena disponibili.
+    Se la risposta in streaming è incompleta le parti mancanti vengono richieste di nuovo;
+    quelle che non si riesce a convertire restano invariate e sono conteggiate in failed.
+    """
+
+    def __init__(self, units, token_budget=CONVERSION_CHUNK_TOKENS, cancel_event=None):
+        self.units = list(units)
+        self.failed = 0
+        self.cancel_event = cancel_event or threading.Event()
+        pieces = []  # (indice della parte, testo)
+        for n, unit in enumerate(self.units):
+            if estimate_tokens(unit) > token_budget:
+                pieces.extend((n, sentence) for sentence in _split_sentences(unit))
+            else:
+                pieces.append((n, unit))
+        self._chunks = make_batches(pieces, lambda piece: piece[1], max_items=len(pieces) or 1, token_budget=token_budget)
+        self._received = [[] for _ in self._chunks]
+        self._condition = threading.Condition()
+
+    def _push(self, k, text):
+        with self._condition:
+            self._received[k].append(text)
+            self._condition.notify_all()
+
+    def _convert_chunk(self, k):
+        texts = [text for _, text in self._chunks[k]]
+        context = [text for _, text in self._chunks[k - 1][-CONVERSION_CONTEXT_UNITS:]] if k else []
+        payload = json.dumps(texts, ensure_ascii=False)
+        prompt = PLURAL_CHUNK_PROMPT.format(context="\n".join(context) or "(nessuno)", payload=payload)
+        received = 0
+        try:
+            deltas = stream_chat_completion(
+                "ai_convert_chunk_to_plural", prompt,
+                max_tokens=2 * estimate_tokens(payload) + 100,
+                timeout=CONVERSION_TIMEOUT,
+                validate=lambda raw: _valid_string_list(raw, len(texts)),
+                cancel_event=self.cancel_event
+            )
+            for item in iter_json_array_items(deltas):
+                if not isinstance(item, str) or received == len(texts):
+                    break
+                self._push(k, item)
+                received += 1
+            # Legge la fine dello stream: la risposta completa va in cache e l'ultimo evento porta i token
+            for _ in deltas:
+                pass
+        except Exception as e:
+            logger.error(f"⚠️ Errore nell'elaborazione (conversione in plurale in streaming): {e}")
+        if received < len(texts) and not self.cancel_event.is_set():
+            # Richiede di nuovo solo le parti non ancora ricevute
+            rest = ai_convert_chunk_to_plural(texts[received:], context + texts[:received])
+            if rest is None:
+                with self._condition:
+                    self.failed += 1
+                rest = texts[received:]
+            for text in rest:
+                self._push(k, text)
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(max_workers=max(1, min(MAX_CONCURRENT_REQUESTS, len(self._chunks))))
+        completed = False
+        try:
+            for k in range(len(self._chunks)):
+                executor.submit(propaga_contesto(self._convert_chunk), k)
+            for k, chunk in enumerate(self._chunks):
+                for j, (n, _) in enumerate(chunk):
+                    with self._condition:
+                        while len(self._received[k]) <= j:
+                            if self.cancel_event.is_set():
+                                return
+                            self._condition.wait(timeout=0.5)
+                        text = self._received[k][j]
+                    yield n, text
+            completed = True
+        finally:
+            if completed:
+                # Restano solo le code degli stream: vanno lette perché le risposte finiscano in cache
+                executor.shutdown(wait=True)
+            else:
+                # Interruzione (anche per un rerun di Streamlit): annulla i blocchi non ancora avviati
+                self.cancel_event.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def result(self):
+        """Attende la fine della conversione e restituisce (parti convertite, blocchi non convertiti)."""
+        converted = [[] for _ in self.units]
+        for n, text in self:
+            converted[n].append(text)
+        return [" ".join(parts) for parts in converted], self.failed
+
+@fase("conversione_plurale")
+def convert_units_to_plural(units, token_budget=CONVERSION_CHUNK_TOKENS):
+    """Restituisce (parti convertite, numero di blocchi non convertiti); vedi PluralConversion."""
+    return PluralConversion(units, token_budget).result()
+
+def _stream_progress(conversion, total, render, on_progress):
+    """
+    Consuma la conversione chiamando on_progress(parti completate, totale, anteprima) al più
+    ogni PROGRESS_INTERVAL secondi e alla fine. render riceve {indice: [testi convertiti]}
+    con le parti ricevute finora e costruisce l'anteprima.
+    """
+    converted = {}
+    last = 0.0
+    for n, text in conversion:
+        converted.setdefault(n, []).append(text)
+        now = time.monotonic()
+        if on_progress and now - last >= PROGRESS_INTERVAL:
+            on_progress(len(converted), total, render(converted))
+            last = now
+    if on_progress:
+        on_progress(len(converted), total, render(converted))
+    return converted
+
+@fase("conversione_plurale")
+def convert_text_to_plural(text, on_progress=None, cancel_event=None):
+    """
+    Converte in plurale un testo semplice, una riga (paragrafo) alla volta.
+    on_progress(completate, totale, testo) riceve le righe convertite fino a quel momento.
+    """
+    lines = text.split("\n")
+    positions = [n for n, line in enumerate(lines) if line.strip()]
+    conversion = PluralConversion([lines[n].strip() for n in positions], cancel_event=cancel_event)
+
+    def render(converted):
+        return "\n".join(" ".join(parts) for parts in converted.values())
+
+    converted = _stream_progress(conversion, len(positions), render, on_progress)
+    for k, n in enumerate(positions):
+        if k in converted:
+            lines[n] = " ".join(converted[k])
+    return "\n".join(lines), conversion.failed
+
+@fase("conversione_plurale")
+def convert_html_to_plural(html_content, on_progress=None, cancel_event=None):
+    """
+    Converte in plurale il testo di un documento HTML lasciando intatto il markup:
+    al modello vengono inviati solo i nodi di testo, poi reinseriti nelle loro posizioni.
+    on_progress(completati, totale, html) riceve il documento con i nodi convertiti fino a quel momento.
+    """
+    root = parse_html(html_content)
+    if root is None:
+        return html_content, 0
+    slots = _text_slots(root)
+    originals = [getattr(element, attr) for element, attr in slots]
+    conversion = PluralConversion([text.strip() for text in originals], cancel_event=cancel_event)
+
+    def render(converted):
+        for k, parts in converted.items():
+            element, attr = slots[k]
+            text = originals[k]
+            leading = text[:len(text) - len(text.lstrip())]
+            trailing = text[len(text.rstrip()):]
+            setattr(element, attr, leading + " ".join(parts) + trailing)
+        return serialize_html(root, _has_doctype(html_content))
+
+    converted = _stream_progress(conversion, len(slots), render, on_progress)
+    return render(converted), conversion.failed
+
+def content_hash(content):
+    """Impronta SHA-256 del contenuto di un file (bytes) o di un blocco di testo."""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def diff_blocchi(impronte_precedenti, impronte_attuali):
+    """
+    Confronta le impronte (content_hash) dei blocchi di una nuova versione con quelle della precedente.
+    Restituisce (invariati, aggiunti o modificati, rimossi), contando i blocchi distinti:
+    un blocco modificato risulta come rimosso nella vecchia forma e aggiunto nella nuova.
+    """
+    precedenti = set(impronte_precedenti)
+    attuali = set(impronte_attuali)
+    return len(attuali & precedenti), len(attuali - precedenti), len(precedenti - attuali)
+
+def normalizza_blocco(text):
+    """Forma canonica di un blocco per il confronto: minuscole, senza punteggiatura, cifre come 0, spazi singoli."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = re.sub(r"\d+", "0", text)
+    text = re.sub(r"[^\w\s]|_", " ", text)
+    return " ".join(text.split())
+
+class IndiceSimili:
+    """
+    Raggruppa i blocchi quasi identici, man mano che arrivano. Un blocco entra nel gruppo di
+    un blocco precedente se la forma canonica (normalizza_blocco) coincide oppure, per i
+    blocchi di almeno SHINGLE_WORDS parole, se la somiglianza di Jaccard tra le sequenze di
+    parole (shingle) raggiunge soglia: i candidati vengono cercati con MinHash/LSH
+    (MINHASH_PERMUTATIONS funzioni di hash in LSH_BANDS bande) e verificati sugli insiemi esatti.
+    Il gruppo è identificato dall'impronta (content_hash) del suo primo blocco.
+    """
+
+    def __init__(self, soglia=NEAR_DUPLICATE_THRESHOLD):
+        self.soglia = soglia
+        self.raggruppati = 0
+        self._canonici = {}  # impronta della forma canonica -> gruppo
+        self._bande = [{} for _ in range(LSH_BANDS)]  # valori della banda -> [gruppo]
+        self._shingle = {}  # gruppo -> shingle del primo blocco
+
+    @staticmethod
+    def _hash_shingle(canonico):
+        """
+        Per ogni shingle, MINHASH_PERMUTATIONS valori di hash a 32 bit ottenuti da un solo
+        digest blake2b: il primo identifica anche lo shingle nel confronto esatto.
+        """
+        parole = canonico.split()
+        return [
+            memoryview(hashlib.blake2b(" ".join(parole[k:k + SHINGLE_WORDS]).encode("utf-8"), digest_size=4 * MINHASH_PERMUTATIONS).digest()).cast("I")
+            for k in range(len(parole) - SHINGLE_WORDS + 1)
+        ]
+
+    def gruppo(self, blocco):
+        """Identificativo del gruppo del blocco; se non somiglia a nessuno ne apre uno nuovo."""
+        canonico = normalizza_blocco(blocco)
+        chiave = content_hash(canonico)
+        if chiave in self._canonici:
+            self.raggruppati += 1
+            return self._canonici[chiave]
+        gruppo = content_hash(blocco)
+        self._canonici[chiave] = gruppo
+        valori = self._hash_shingle(canonico) if self.soglia < 1 else []
+        if not valori:
+            return gruppo
+        shingle = {hashes[0] for hashes in valori}
+        firma = list(map(min, zip(*valori)))  # minimo di ciascuna funzione di hash sugli shingle
+        righe = MINHASH_PERMUTATIONS // LSH_BANDS
+        bande = [tuple(firma[banda * righe:(banda + 1) * righe]) for banda in range(LSH_BANDS)]
+        verificati = set()
+        for indice, valori_banda in zip(self._bande, bande):
+            for candidato in indice.get(valori_banda, ()):
+                if candidato in verificati:
+                    continue
+                verificati.add(candidato)
+                simile = self._shingle[candidato]
+                if len(shingle & simile) >= self.soglia * len(shingle | simile):
+                    self._canonici[chiave] = candidato
+                    self.raggruppati += 1
+                    return candidato
+        for indice, valori_banda in zip(self._bande, bande):
+            indice.setdefault(valori_banda, []).append(gruppo)
+        self._shingle[gruppo] = shingle
+        return gruppo
+
+class PreClassificatore:
+    """
+    Classificatore locale dei blocchi: naive Bayes sulla presenza di parole, coppie di parole,
+    trigrammi di caratteri e parole iniziali (forma canonica di normalizza_blocco), contati in
+    TRIAGE_FEATURES contatori per classe tramite crc32. Si addestra sui verdetti restituiti dal
+    modello e sui blocchi segnalati dai pattern (critici). In SQLite vengono salvati solo i
+    contatori e le impronte degli esempi già contati, mai i testi; vengono caricati al primo uso.
+    Il modello creato con una versione diversa (pattern o prompt modificati) viene scartato.
+    """
+
+    def __init__(self, path, version, soglia=TRIAGE_THRESHOLD, min_esempi=TRIAGE_MIN_EXAMPLES,
+                 max_esempi=TRIAGE_MAX_EXAMPLES, caratteristiche=TRIAGE_FEATURES):
+        self.version = version
+        self.soglia = soglia
+        self.min_esempi = min_esempi
+        self.max_esempi = max_esempi
+        self.n_caratteristiche = caratteristiche
+        self._lock = threading.Lock()
+        # Per classe (0 = "Non critico", 1 = "Critico"): esempi e, per caratteristica, esempi che la contengono
+        self._esempi = None
+        self._conteggi = None
+        self._stats = dict.fromkeys(("saltati", "valutati", "concordi", "sicuri", "mancati"), 0)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("DROP TABLE IF EXISTS esempi")  # versioni precedenti: contenevano i testi
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS modello (version TEXT, non_critici INTEGER, critici INTEGER, "
+            "conteggi_non_critici BLOB, conteggi_critici BLOB)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS impronte (impronta TEXT PRIMARY KEY, created REAL)")
+        if self._conn.execute("SELECT COUNT(*) FROM modello WHERE version != ?", (version,)).fetchone()[0]:
+            self._conn.execute("DELETE FROM modello")
+            self._conn.execute("DELETE FROM impronte")
+        self._conn.commit()
+
+    def _carica(self):
+        """Contatori del modello, letti dal database al primo uso (da chiamare con il lock)."""
+        if self._conteggi is None:
+            row = self._conn.execute(
+                "SELECT non_critici, critici, conteggi_non_critici, conteggi_critici FROM modello"
+            ).fetchone()
+            self._conteggi = [array("I"), array("I")]
+            if row is not None and len(row[2]) == len(row[3]) == 4 * self.n_caratteristiche:
+                self._esempi = [row[0], row[1]]
+                self._conteggi[0].frombytes(row[2])
+                self._conteggi[1].frombytes(row[3])
+            else:
+                self._esempi = [0, 0]
+                for conteggi in self._conteggi:
+                    conteggi.frombytes(bytes(4 * self.n_caratteristiche))
+        return self._conteggi
+
+    def caratteristiche(self, testo):
+        canonico = normalizza_blocco(testo)
+        parole = canonico.split()
+        voci = {"p:" + parola for parola in parole}
+        voci.update(f"b:{a} {b}" for a, b in zip(parole, parole[1:]))
+        voci.update("c:" + canonico[k:k + 3] for k in range(len(canonico) - 2))
+        voci.add("i:" + " ".join(parole[:2]))
+        return {zlib.crc32(voce.encode("utf-8")) % self.n_caratteristiche for voce in voci}
+
+    def impara(self, esempi):
+        """Aggiunge al modello le coppie (testo, classificazione) non ancora note."""
+        esempi = {content_hash(testo): (testo, classificazione) for testo, classificazione in esempi}
+        if not esempi:
+            return
+        now = time.time()
+        with self._lock:
+            conteggi = self._carica()
+            noti = set()
+            impronte = list(esempi)
+            for k in range(0, len(impronte), 500):
+                parte = impronte[k:k + 500]
+                noti.update(row[0] for row in self._conn.execute(
+                    f"SELECT impronta FROM impronte WHERE impronta IN ({','.join('?' * len(parte))})", parte
+                ))
+            nuovi = [impronta for impronta in impronte if impronta not in noti]
+            if not nuovi:
+                return
+            for impronta in nuovi:
+                testo, classificazione = esempi[impronta]
+                critico = int(classificazione == "Critico")
+                self._esempi[critico] += 1
+                for caratteristica in self.caratteristiche(testo):
+                    conteggi[critico][caratteristica] += 1
+            self._conn.executemany("INSERT OR IGNORE INTO impronte (impronta, created) VALUES (?, ?)", [(impronta, now) for impronta in nuovi])
+            # Oltre max_esempi si dimenticano le impronte più vecchie (i loro conteggi restano)
+            self._conn.execute(
+                "DELETE FROM impronte WHERE impronta IN (SELECT impronta FROM impronte ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_esempi,)
+            )
+            self._conn.execute("DELETE FROM modello")
+            self._conn.execute(
+                "INSERT INTO modello (version, non_critici, critici, conteggi_non_critici, conteggi_critici) VALUES (?, ?, ?, ?, ?)",
+                (self.version, *self._esempi, conteggi[0].tobytes(), conteggi[1].tobytes())
+            )
+            self._conn.commit()
+
+    def probabilita_critico(self, testo):
+        """Probabilità che il blocco sia critico; None finché una delle classi ha meno di min_esempi esempi."""
+        caratteristiche = self.caratteristiche(testo)
+        with self._lock:
+            conteggi_non_critici, conteggi_critici = self._carica()
+            non_critici, critici = self._esempi
+            if min(non_critici, critici) < self.min_esempi:
+                return None
+            logit = math.log(critici / non_critici) + len(caratteristiche) * math.log((non_critici + 2) / (critici + 2))
+            logit += sum(math.log((conteggi_critici[c] + 1) / (conteggi_non_critici[c] + 1)) for c in caratteristiche)
+        return 1 / (1 + math.exp(min(-logit, 700)))
+
+    def sicuro(self, probabilita):
+        """Vero se la previsione basta a considerare il blocco non critico senza interrogare l'API."""
+        return probabilita is not None and 1 - probabilita >= self.soglia
+
+    def conta_saltati(self, n):
+        with self._lock:
+            self._stats["saltati"] += n
+
+    def confronta(self, probabilita, classificazione):
+        """Confronta la previsione con il verdetto del modello (misura dell'accordo in modalità shadow)."""
+        if probabilita is None:
+            return
+        critico = classificazione == "Critico"
+        with self._lock:
+            self._stats["valutati"] += 1
+            self._stats["concordi"] += (probabilita >= 0.5) == critico
+            if self.sicuro(probabilita):
+                self._stats["sicuri"] += 1
+                self._stats["mancati"] += critico
+
+    def stats(self):
+        """Esempi e contatori: sicuri = blocchi che in modalità active non sarebbero stati inviati, mancati = quelli tra loro critici."""
+        with self._lock:
+            esempi = self._esempi
+            if esempi is None:
+                # Senza caricare i contatori
+                row = self._conn.execute("SELECT non_critici, critici FROM modello").fetchone()
+                esempi = row or (0, 0)
+            return {"esempi": sum(esempi), "critici": esempi[1], **self._stats}
+
+@lru_cache(maxsize=None)
+def get_preclassificatore():
+    return PreClassificatore(TRIAGE_PATH, cache_version())
+
+def _con_contesto(blocchi):
+    """(indice, precedente, blocco, successivo) per ogni blocco di un iterabile, leggendone uno in anticipo."""
+    precedente, corrente, i = "", None, -1
+    for i, blocco in enumerate(blocchi):
+        if corrente is not None:
+            yield i - 1, precedente, corrente, blocco
+            precedente = corrente
+        corrente = blocco
+    if corrente is not None:
+        yield i, precedente, corrente, ""
+
+def _classifica_finestra(finestra, verdetti):
+    """
+    Classifica tramite API i candidati di una finestra non già segnalati dai pattern, uno per
+    gruppo di blocchi simili e solo per i gruppi non presenti in verdetti. Con TRIAGE_MODE
+    "active" quelli che il PreClassificatore ritiene sicuramente non critici non vengono inviati;
+    i verdetti del modello e i blocchi segnalati dai pattern diventano suoi esempi.
+    Restituisce [(indice, blocco, regex_match, classificazione, gruppo)], il numero di
+    classificazioni riprese da verdetti o da un blocco simile e quello delle classificazioni locali.
+    """
+    preclassificatore = get_preclassificatore() if TRIAGE_MODE in ("shadow", "active") else None
+    da_analizzare = []
+    gruppi = {}  # indice del blocco analizzato -> gruppo
+    previsioni = {}
+    in_analisi = set()
+    locali = 0
+    for i, prev_text, blocco, next_text, regex_match, gruppo in finestra:
+        if regex_match or gruppo in verdetti or gruppo in in_analisi:
+            continue
+        if preclassificatore is not None:
+            previsioni[i] = preclassificatore.probabilita_critico(blocco)
+            if TRIAGE_MODE == "active" and preclassificatore.sicuro(previsioni[i]):
+                verdetti[gruppo] = "Non critico"
+                locali += 1
+                continue
+        da_analizzare.append((i, prev_text, blocco, next_text))
+        gruppi[i] = gruppo
+        in_analisi.add(gruppo)
+    esempi = [(blocco, "Critico") for _, _, blocco, _, regex_match, _ in finestra if regex_match]
+    for (i, _, blocco, _), result in zip(da_analizzare, analyze_blocks(da_analizzare)):
+        classification = result.get("classificazione") if result else None
+        # Solo i verdetti validi: un blocco non analizzato va ritentato alla versione successiva
+        if classification in ("Critico", "Non critico"):
+            verdetti[gruppi[i]] = classification
+            if preclassificatore is not None:
+                esempi.append((blocco, classification))
+                preclassificatore.confronta(previsioni[i], classification)
+    if preclassificatore is not None:
+        preclassificatore.impara(esempi)
+        if locali:
+            preclassificatore.conta_saltati(locali)
+    esiti = [
+        (i, blocco, regex_match, verdetti.get(gruppo) if not regex_match else None, gruppo)
+        for i, _, blocco, _, regex_match, gruppo in finestra
+    ]
+    ripresi = sum(not regex_match for _, _, _, _, regex_match, _ in finestra) - len(da_analizzare) - locali
+    return esiti, ripresi, locali
+
+def filtra_blocchi_stream(blocchi, verdetti=None, finestra=PIPELINE_WINDOW, on_progress=None, cancel_event=None):
+    """
+    Individua i blocchi critici di un iterabile di testi (anche un generatore del parser),
+    restituendo man mano, nell'ordine del documento, (indice, blocco, analizzato, gruppo) per
+    ogni blocco da revisionare; analizzato è False se il blocco è incluso perché l'analisi non è
+    disponibile, gruppo identifica i blocchi quasi identici (IndiceSimili), che condividono
+    un'unica classificazione. I blocchi vengono classificati a finestre di al più `finestra` blocchi:
+    mentre l'API classifica una finestra si legge la successiva, e la lettura si ferma finché
+    la precedente non è stata consegnata, quindi dei testi letti restano in memoria al più due
+    finestre (oltre alle impronte dei blocchi già visti, per i duplicati e i blocchi simili).
+    Per verdetti vedi filtra_blocchi_avanzata. on_progress(blocchi letti), se indicata, viene
+    chiamata dopo la consegna di ogni finestra; impostando cancel_event la lettura si ferma e
+    si consegna solo la finestra già in classificazione.
+    """
+    if verdetti is None:
+        verdetti = {}
+    seen = set()
+    simili = IndiceSimili()
+    secondi_pattern = 0.0
+    ripresi = 0
+    locali = 0
+
+    def consegna(esiti):
+        for i, blocco, regex_match, classification, gruppo in esiti:
+            # Se almeno uno segnala criticità (o l'analisi manca), includi il blocco
+            if regex_match or classification != "Non critico":
+                yield i, blocco, regex_match or classification == "Critico", gruppo
+        if on_progress and esiti:
+            on_progress(esiti[-1][0] + 1)
+
+    # Un solo thread: le finestre (e gli aggiornamenti di verdetti) si susseguono in ordine
+    with ThreadPoolExecutor(max_workers=1) as classificatore:
+        in_corso = None
+        corrente = []
+        for i, prev_text, blocco, next_text in _con_contesto(blocchi):
+            if cancel_event is not None and cancel_event.is_set():
+                corrente = []
+                break
+            inizio = time.perf_counter()
+            impronta = content_hash(blocco)
+            # Evita duplicati
+            if impronta in seen:
+                continue
+            seen.add(impronta)
+            # Verifica tramite pattern, in un solo passaggio sul blocco
+            regex_match = pattern_matcher.search(blocco) is not None
+            gruppo = simili.gruppo(blocco)
+            secondi_pattern += time.perf_counter() - inizio
+            corrente.append((i, prev_text, blocco, next_text, regex_match, gruppo))
+            if len(corrente) < finestra:
+                continue
+            if in_corso is not None:
+                esiti, n, m = in_corso.result()
+                ripresi += n
+                locali += m
+                yield from consegna(esiti)
+            in_corso = classificatore.submit(propaga_contesto(_classifica_finestra), corrente, verdetti)
+            corrente = []
+        if in_corso is not None:
+            esiti, n, m = in_corso.result()
+            ripresi += n
+            locali += m
+            yield from consegna(esiti)
+        if corrente:
+            esiti, n, m = classificatore.submit(propaga_contesto(_classifica_finestra), corrente, verdetti).result()
+            ripresi += n
+            locali += m
+            yield from consegna(esiti)
+    get_metrics().add_stage("filtro_pattern", secondi_pattern)
+    if simili.raggruppati:
+        logger.info(f"Blocchi quasi identici raggruppati: {simili.raggruppati}.")
+    if ripresi:
+        logger.info(f"Classificazioni riprese dalla versione precedente o da un blocco simile: {ripresi} blocchi.")
+    if locali:
+        logger.info(f"Blocchi classificati come non critici dal pre-classificatore locale, senza interrogare l'API: {locali}.")
+
+def filtra_blocchi_avanzata(blocchi, max_length=300, verdetti=None, on_progress=None, cancel_event=None):
+    """
+    Filtra i blocchi di testo per individuare quelli critici.
+    Combina:
+      1. Controllo tramite pattern (PatternMatcher).
+      2. Analisi contestuale tramite API (più blocchi per richiesta).
+    Deduplica i blocchi e, per la visualizzazione, tronca quelli troppo lunghi.
+    I blocchi quasi identici (IndiceSimili) vengono classificati una volta sola e compaiono
+    una volta sola: il primo rappresenta il gruppo, gli altri sono elencati a parte e vanno
+    trattati come lui.
+    verdetti, se indicato, è il dizionario {gruppo: classificazione} di una versione
+    precedente del documento: i blocchi già classificati non vengono rianalizzati (anche se è
+    cambiato il contesto), e le nuove classificazioni vi vengono aggiunte.
+    Restituisce ({chiave: blocco}, chiavi dei blocchi inclusi perché l'analisi non è disponibile,
+    {chiave: [(indice, blocco) dei blocchi simili]}): un errore dell'API non fa mai passare
+    un blocco come "Non critico".
+    on_progress(blocchi letti, totale, {chiave: blocco} trovati finora), se indicata, segue
+    l'avanzamento; impostando cancel_event l'analisi si ferma e restituisce i blocchi trovati
+    fino a quel momento.
+    """
+    blocchi_filtrati = {}
+    non_analizzati = set()
+    simili = {}
+    chiavi_gruppi = {}
+    totale = len(blocchi) if hasattr(blocchi, "__len__") else None
+
+    def avanzamento(letti):
+        on_progress(letti, totale, blocchi_filtrati)
+
+    stream = filtra_blocchi_stream(blocchi, verdetti, on_progress=avanzamento if on_progress else None, cancel_event=cancel_event)
+    for i, blocco, analizzato, gruppo in stream:
+        key = chiavi_gruppi.get(gruppo)
+        if key is not None:
+            simili.setdefault(key, []).append((i, blocco))
+        else:
+            # Per visualizzazione, tronca se troppo lungo
+            display_blocco = blocco if len(blocco) <= max_length else blocco[:max_length] + "..."
+            key = chiavi_gruppi[gruppo] = f"{i}_{display_blocco}"
+            blocchi_filtrati[key] = blocco
+        if not analizzato:
+            non_analizzati.add(key)
+    if non_analizzati:
+        logger.error(f"⚠️ {len(non_analizzati)} blocchi non analizzati: inclusi per la revisione manuale.")
+    return blocchi_filtrati, non_analizzati, simili
+
+def build_modifications(scelte_utente, blocchi, on_progress=None, cancel_event=None):
+    """
+    Traduce le scelte dell'utente in un dizionario {blocco originale: nuovo testo}.
+    blocchi sono i testi del documento (una lista o un generatore del parser, letto una
+    sola volta), da cui si ricava il contesto dei blocchi da riscrivere.
+    Le riscritture vengono richieste all'API in batch paralleli; on_progress(completate, totale,
+    blocco, riscrittura), se indicato, viene chiamata appena ciascuna riscrittura è disponibile.
+    Restituisce (modifiche, numero di riscritture non riuscite): i blocchi non riscritti
+    (anche quelli rimasti in sospeso impostando cancel_event) restano invariati.
+    """
+    modifications = {}
+    da_riscrivere = []
+    contesti = contesto_blocchi(blocchi, [info["indice"] for info in scelte_utente.values() if info["azione"] == "Riscrivi"])
+    for blocco, info in scelte_utente.items():
+        if info["azione"] == "Riscrivi":
+            if info["indice"] not in contesti:
+                logger.error("Il blocco selezionato non è presente nella lista.")
+            prev_blocco, next_blocco = contesti.get(info["indice"], ("", ""))
+            da_riscrivere.append((blocco, prev_blocco, next_blocco, info["tono"]))
+            modifications[blocco] = None  # segnaposto per mantenere l'ordine
+        elif info["azione"] == "Elimina":
+            modifications[blocco] = ""
+        else:
+            modifications[blocco] = blocco
+    completate = []
+
+    def on_result(n, mod_blocco):
+        completate.append(n)
+        if on_progress:
+            on_progress(len(completate), len(da_riscrivere), da_riscrivere[n][0], mod_blocco)
+
+    riscritture = rewrite_blocks(da_riscrivere, on_result=on_result, cancel_event=cancel_event)
+    non_riscritti = 0
+    for args, mod_blocco in zip(da_riscrivere, riscritture):
+        if mod_blocco is None:
+            non_riscritti += 1
+            mod_blocco = args[0]
+        modifications[args[0]] = mod_blocco
+    return modifications, non_riscritti
+
+@fase("parsing")
+def process_file_content(file_content, file_extension):
+    """
+    Restituisce i blocchi (oggetti Block con la posizione dell'elemento di provenienza)
+    e l'HTML a cui si riferiscono.
+    """
+    if file_extension == "html":
+        return extract_html_blocks(parse_html(file_content)), file_content
+    elif file_extension == "md":
+        import markdown
+        html_content = markdown.markdown(file_content)
+        return extract_html_blocks(parse_html(html_content)), html_content
+    return [], ""
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# Testo equivalente degli elementi di un run, come in python-docx (Run.text)
+_RUN_TEXT = {_W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-"}
+
+def _run_text(run):
+    parts = []
+    for child in run:
+        if child.tag == _W + "t":
+            parts.append(child.text or "")
+        elif child.tag == _W + "br":
+            parts.append("\n" if child.get(_W + "type", "textWrapping") == "textWrapping" else "")
+        else:
+            parts.append(_RUN_TEXT.get(child.tag, ""))
+    return "".join(parts)
+
+def _docx_main_part(archive):
+    """Nome, nell'archivio, della parte principale del documento Word."""
+    from lxml import etree
+    rels = etree.fromstring(archive.read("_rels/.rels"))
+    for rel in rels:
+        if rel.get("Type", "").endswith("/officeDocument"):
+            return rel.get("Target").lstrip("/")
+    return "word/document.xml"
+
+def iter_docx_paragraphs(source):
+    """
+    Testi non vuoti dei paragrafi del corpo di un documento Word (percorso o file), letti
+    man mano dall'XML compresso: in memoria resta solo il paragrafo corrente.
+    Il testo è lo stesso di python-docx (Document(...).paragraphs), tabelle escluse.
+    """
+    from lxml import etree
+    with zipfile.ZipFile(source) as archive:
+        with archive.open(_docx_main_part(archive)) as xml:
+            for _, paragraph in etree.iterparse(xml, events=("end",), tag=_W + "p", huge_tree=True):
+                parent = paragraph.getparent()
+                if parent is not None and parent.tag == _W + "body":
+                    runs = paragraph.iterchildren(_W + "r", _W + "hyperlink")
+                    text = "".join(
+                        _run_text(run) if run.tag == _W + "r" else "".join(_run_text(r) for r in run.iterchildren(_W + "r"))
+                        for run in runs
+                    ).strip()
+                    if text:
+                        yield text
+                    # Libera i paragrafi (e le tabelle) già letti
+                    paragraph.clear()
+                    while paragraph.getprevious() is not None:
+                        del parent[0]
+
+def _misura_lettura(blocchi):
+    """Restituisce i blocchi di un generatore registrando nella fase "parsing" solo il tempo speso a produrli."""
+    secondi = 0.0
+    try:
+        while True:
+            inizio = time.perf_counter()
+            try:
+                blocco = next(blocchi)
+            except StopIteration:
+                return
+            finally:
+                secondi += time.perf_counter() - inizio
+            yield blocco
+    finally:
+        get_metrics().add_stage("parsing", secondi)
+
+def _testi_documento(path, file_extension):
+    # Eseguita nei processi del pool di iter_document_blocks
+    return list(iter_document_blocks(path, file_extension))
+
+def iter_document_blocks(path, file_extension, executor=None):
+    """
+    Testi dei blocchi di un documento su disco in uno dei formati supportati (SUPPORTED_EXTENSIONS),
+    restituiti man mano: per Word e PDF la lettura procede solo quando il blocco precedente è
+    stato consumato (i PDF lunghi a gruppi di pagine, vedi iter_pdf_paragraphs). HTML e Markdown
+    vengono invece analizzati per intero (serve l'albero).
+    Con executor (un pool di processi) il parsing non occupa il thread chiamante: i PDF lunghi
+    vengono estratti dal pool a gruppi di pagine, gli altri documenti letti per intero da uno dei
+    suoi processi, che ne restituisce solo i testi.
+    """
+    if executor is not None and file_extension != "pdf":
+        future = executor.submit(_testi_documento, path, file_extension)
+        # Generatore: l'attesa del risultato rientra nel tempo di lettura misurato
+        yield from _misura_lettura(testo for risultato in [future] for testo in risultato.result())
+    elif file_extension in ["html", "md"]:
+        with open(path, encoding="utf-8") as f:
+            blocks, _ = process_file_content(f.read(), file_extension)
+        yield from (block.text for block in blocks)
+    elif file_extension in ["doc", "docx"]:
+        yield from _misura_lettura(iter_docx_paragraphs(path))
+    elif file_extension == "pdf":
+        yield from _misura_lettura(text for _, _, text in iter_pdf_paragraphs(path, executor))
+    else:
+        raise ValueError(f"Formato non supportato: {file_extension}")
+
+def spooled_output():
+    """File temporaneo per i documenti generati: resta in memoria fino a SPOOL_MAX_MEMORY byte, poi passa su disco."""
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+
+@fase("output")
+def process_html_content(html_content: str, modifications: dict, highlight: bool = False, blocks=None) -> str:
+    """
+    Sostituisce il testo dei blocchi modificati (tutte le occorrenze) e serializza
+    il documento una sola volta. blocks, se indicato, deve provenire da html_content.
+    """
+    root = parse_html(html_content)
+    if root is None:
+        return html_content
+    if blocks is None:
+        blocks = extract_html_blocks(root)
+    targets = {block.location: block.text for block in blocks if block.text in modifications}
+    if not targets:
+        return html_content
+    # Le posizioni si riferiscono all'albero originale: vanno risolte prima di modificarlo
+    elements = list(root.iter())
+    for position, text in targets.items():
+        element = elements[position]
+        if modifications[text] != text:
+            _set_block_text(element, modifications[text], highlight)
+    return serialize_html(root, _has_doctype(html_content))
+
+@fase("output")
+def build_docx(text):
+    """Documento Word con il testo revisionato, in un file temporaneo (spooled_output) riavvolto."""
+    from docx import Document
+    new_doc = Document()
+    new_doc.add_paragraph(text)
+    output = spooled_output()
+    new_doc.save(output)
+    output.seek(0)
+    return output
+
+@fase("output")
+def build_text_pdf(text):
+    """PDF con il testo revisionato, impaginato da capo, in un file temporaneo (spooled_output) riavvolto."""
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.set_font("Arial", size=12)
+    pdf.multi_cell(0, 10, text)
+    output = spooled_output()
+    pdf.output(output)
+    output.seek(0)
+    return output
+
+@fase("output")
+def process_pdf_content_with_overlay(pdf_file, modifications):
+    """
+    Restituisce, in un file temporaneo (spooled_output) riavvolto, il PDF con le modifiche
+    applicate come redazioni (testo sostituito o rimosso nel rettangolo del paragrafo originale).
+    pdf_file è il percorso del PDF (letto da disco senza copiarlo in memoria) o un file aperto;
+    i paragrafi vengono riletti dal PDF man mano (iter_pdf_paragraphs).
+    """
+    if not isinstance(pdf_file, (str, os.PathLike)):
+        pdf_file.seek(0)
+        pdf_file = pdf_file.read()
+    return redact_pdf(pdf_file, iter_pdf_paragraphs(pdf_file), modifications, spooled_output())
@@ -0,0 +1,268 @@
+"""
+Revisione in batch, senza interfaccia, di intere cartelle di documenti.
+
+    python revisione_batch.py documenti/ altri/file.pdf -o report.jsonl [--riscrivi Formale]
+
+Per ogni documento (html, md, doc, docx, pdf) scrive nel report una riga JSON con i
+blocchi critici trovati. Impronte e parsing dei documenti sono affidati a un pool di
+processi, uno per core; l'analisi di più documenti procede in parallelo e le richieste
+al modello passano tutte dallo stesso RequestScheduler (limiti del provider,
+ritentativi, concorrenza adattiva). I PDF lunghi arrivano all'analisi a gruppi di pagine,
+man mano che i processi li estraggono, gli altri documenti come elenco dei soli testi:
+dei documenti analizzati restano in memoria solo i blocchi critici.
+
+Il report viene scritto un documento alla volta: se l'esecuzione si interrompe,
+rilanciando lo stesso comando i documenti già presenti nel report (stesso percorso e
+stesso contenuto) vengono saltati. Quelli terminati con un errore, o con blocchi che
+l'API non ha analizzato o riscritto, vengono ritentati, come quelli elaborati senza
+--riscrivi o con un altro tono quando la riscrittura viene richiesta.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from revisione import (
+    API_KEY,
+    SUPPORTED_EXTENSIONS,
+    TONE_OPTIONS,
+    TRIAGE_MODE,
+    configure_logging,
+    contesto_blocchi,
+    filtra_blocchi_stream,
+    get_preclassificatore,
+    iter_document_blocks,
+    misura_esecuzione,
+    pattern_matcher,
+    propaga_contesto,
+    rewrite_blocks,
+)
+
+logger = logging.getLogger(__name__)
+
+# Documenti analizzati contemporaneamente (le richieste restano comunque limitate dal RequestScheduler)
+BATCH_DOCUMENTS = int(os.getenv("BATCH_DOCUMENTS", "4"))
+
+def trova_documenti(percorsi):
+    """Percorsi dei documenti supportati, cercando ricorsivamente nelle cartelle indicate."""
+    documenti = []
+    for percorso in percorsi:
+        if os.path.isdir(percorso):
+            for cartella, _, nomi in os.walk(percorso):
+                documenti.extend(os.path.join(cartella, nome) for nome in nomi)
+        else:
+            documenti.append(percorso)
+    return sorted(
+        os.path.abspath(documento) for documento in documenti
+        if documento.rsplit(".", 1)[-1].lower() in SUPPORTED_EXTENSIONS
+    )
+
+def leggi_report(path, tono=None):
+    """
+    Coppie (percorso, sha256) dei documenti già elaborati completamente; con tono, solo quelli
+    i cui blocchi critici sono stati riscritti in quel tono.
+    """
+    completati = set()
+    if not os.path.exists(path):
+        return completati
+    # errors="replace": l'ultima riga può essere troncata a metà di un carattere multibyte
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for riga in f:
+            try:
+                voce = json.loads(riga)
+            except ValueError:
+                continue  # riga troncata da un'interruzione
+            if voce.get("errore") or voce.get("non_analizzati") or voce.get("non_riscritti"):
+                continue
+            # Senza blocchi critici non c'è niente da riscrivere, in nessun tono
+            if tono and voce.get("tono") != tono and voce.get("critici"):
+                continue
+            completati.add((voce["file"], voce["sha256"]))
+    return completati
+
+def apri_report(path):
+    """Apre il report in aggiunta, completando l'eventuale ultima riga rimasta a metà."""
+    if os.path.exists(path):
+        # In binario: la riga interrotta può terminare a metà di un carattere multibyte
+        with open(path, "rb+") as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+    return open(path, "a", encoding="utf-8")
+
+_completati = set()
+
+def _init_lettore(completati):
+    global _completati
+    _completati = completati
+
+def impronta_documento(path):
+    """
+    Eseguita nei processi del pool: restituisce (percorso, sha256, già nel report). Il documento
+    viene letto a blocchi, senza caricarlo per intero: lo rilegge da disco il parser durante l'analisi.
+    """
+    impronta = hashlib.sha256()
+    with open(path, "rb") as f:
+        for parte in iter(lambda: f.read(2 ** 20), b""):
+            impronta.update(parte)
+    sha256 = impronta.hexdigest()
+    return path, sha256, (path, sha256) in _completati
+
+def analizza_documento(path, sha256, tono=None, lettori=None):
+    """
+    Voce del report per un documento: blocchi critici e, se richiesto, la loro riscrittura.
+    Il parsing avviene nei processi del pool lettori (iter_document_blocks); i blocchi passano al
+    filtro man mano che arrivano (filtra_blocchi_stream) e se ne conservano solo quelli critici.
+    Il contesto dei blocchi da riscrivere viene riletto da disco.
+    """
+    inizio = time.monotonic()
+    file_extension = path.rsplit(".", 1)[-1].lower()
+    critici = []
+    non_riscritti = 0
+    letti = 0
+    primi = {}  # gruppo di blocchi simili -> indice del primo blocco del gruppo
+    non_analizzati = set()
+
+    def conta(blocchi):
+        nonlocal letti
+        for letti, blocco in enumerate(blocchi, 1):
+            yield blocco
+
+    for i, blocco, analizzato, gruppo in filtra_blocchi_stream(conta(iter_document_blocks(path, file_extension, lettori))):
+        # I blocchi quasi identici hanno la stessa classificazione: nel report indicano il primo del gruppo
+        simile_a = primi.setdefault(gruppo, i)
+        if not analizzato:
+            non_analizzati.add(simile_a)
+        critici.append({
+            "indice": i,
+            "testo": blocco,
+            "pattern": sorted({m.pattern for m in pattern_matcher.find_all(blocco)}),
+            "analizzato": analizzato,
+            "simile_a": None if simile_a == i else simile_a,
+        })
+    if tono and critici:
+        contesti = contesto_blocchi(iter_document_blocks(path, file_extension, lettori), [voce["indice"] for voce in critici])
+        richieste = [(voce["testo"], *contesti[voce["indice"]], tono) for voce in critici]
+        for voce, riscrittura in zip(critici, rewrite_blocks(richieste)):
+            voce["riscrittura"] = riscrittura
+            non_riscritti += riscrittura is None
+    return {
+        "file": path,
+        "sha256": sha256,
+        "formato": file_extension,
+        "tono": tono,
+        "blocchi": letti,
+        "critici": critici,
+        "non_analizzati": len(non_analizzati),
+        "non_riscritti": non_riscritti,
+        "secondi": round(time.monotonic() - inizio, 3),
+        "errore": None,
+    }
+
+def voce_errore(path, sha256, errore):
+    return {"file": path, "sha256": sha256, "errore": f"{type(errore).__name__}: {errore}"}
+
+def esegui(documenti, report_path, processi, documenti_paralleli, tono=None):
+    """Elabora i documenti aggiornando il report; restituisce il conteggio per esito."""
+    conteggi = {"elaborati": 0, "saltati": 0, "errori": 0, "incompleti": 0}
+    completati = leggi_report(report_path, tono)
+    da_leggere = iter(documenti)
+    # Documenti in attesa dell'impronta o in analisi: oltre questo limite si attende, così
+    # le analisi in coda (e i loro risultati) non crescono con il numero di documenti
+    finestra = processi + 2 * documenti_paralleli
+    # "spawn": i processi non ereditano i thread (e i lock) delle analisi già in corso
+    contesto = multiprocessing.get_context("spawn")
+    with apri_report(report_path) as report, \
+            ProcessPoolExecutor(max_workers=processi, mp_context=contesto, initializer=_init_lettore, initargs=(completati,)) as lettori, \
+            ThreadPoolExecutor(max_workers=documenti_paralleli) as analisti:
+        in_lettura, in_analisi = {}, {}
+
+        def scrivi(voce):
+            report.write(json.dumps(voce, ensure_ascii=False) + "\n")
+            report.flush()
+            if voce["errore"]:
+                conteggi["errori"] += 1
+                logger.error(f"⚠️ {voce['file']}: {voce['errore']}")
+            else:
+                conteggi["elaborati"] += 1
+                logger.info(f"✅ {voce['file']}: {len(voce['critici'])} blocchi critici su {voce['blocchi']}")
+                if voce["non_analizzati"] or voce["non_riscritti"]:
+                    conteggi["incompleti"] += 1
+
+        try:
+            while True:
+                for path in da_leggere:
+                    in_lettura[lettori.submit(impronta_documento, path)] = path
+                    if len(in_lettura) + len(in_analisi) >= finestra:
+                        break
+                if not in_lettura and not in_analisi:
+                    break
+                fatti, _ = wait([*in_lettura, *in_analisi], return_when=FIRST_COMPLETED)
+                for future in fatti:
+                    if future in in_lettura:
+                        path = in_lettura.pop(future)
+                        try:
+                            path, sha256, completato = future.result()
+                        except Exception as e:
+                            scrivi(voce_errore(path, None, e))
+                            continue
+                        if completato:
+                            conteggi["saltati"] += 1
+                            continue
+                        in_analisi[analisti.submit(propaga_contesto(analizza_documento), path, sha256, tono, lettori)] = (path, sha256)
+                    else:
+                        path, sha256 = in_analisi.pop(future)
+                        try:
+                            scrivi(future.result())
+                        except Exception as e:
+                            scrivi(voce_errore(path, sha256, e))
+        except KeyboardInterrupt:
+            logger.info("Interrotto: rilanciare lo stesso comando per riprendere dal punto raggiunto.")
+            lettori.shutdown(wait=False, cancel_futures=True)
+            analisti.shutdown(wait=False, cancel_futures=True)
+            raise
+    return conteggi
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Individua i blocchi critici di interi gruppi di documenti e li riporta in un file JSONL.")
+    parser.add_argument("percorsi", nargs="+", help="File o cartelle (esplorate ricorsivamente) da revisionare")
+    parser.add_argument("-o", "--report", default="report.jsonl", help="File JSONL dei risultati; se esiste, i documenti già presenti vengono saltati")
+    parser.add_argument("--processi", type=int, default=os.cpu_count() or 1, help="Processi per impronte e parsing dei documenti (predefinito: uno per core)")
+    parser.add_argument("--documenti", type=int, default=BATCH_DOCUMENTS, help="Documenti analizzati contemporaneamente")
+    parser.add_argument("--riscrivi", choices=list(TONE_OPTIONS), metavar="TONO", help="Aggiunge al report una riscrittura dei blocchi critici nel tono indicato")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if not API_KEY:
+        logger.error("⚠️ Errore: API Key di OpenRouter non trovata! Impostala come variabile d'ambiente.")
+        return 2
+    documenti = trova_documenti(args.percorsi)
+    logger.info(f"Documenti da revisionare: {len(documenti)}")
+    inizio = time.monotonic()
+    try:
+        with misura_esecuzione("batch", documenti=len(documenti), report=args.report):
+            conteggi = esegui(documenti, args.report, max(1, args.processi), max(1, args.documenti), args.riscrivi)
+    except KeyboardInterrupt:
+        return 130
+    logger.info(
+        f"Completato in {time.monotonic() - inizio:.1f} s: {conteggi['elaborati']} elaborati, "
+        f"{conteggi['saltati']} già presenti nel report, {conteggi['errori']} errori, "
+        f"{conteggi['incompleti']} da rielaborare per errori dell'API."
+    )
+    if TRIAGE_MODE in ("shadow", "active"):
+        triage = get_preclassificatore().stats()
+        logger.info(
+            f"Pre-classificazione locale ({TRIAGE_MODE}): {triage['saltati']} blocchi non inviati all'API, "
+            f"accordo con il modello {triage['concordi']} su {triage['valutati']}, {triage['sicuri']} sicuramente "
+            f"non critici di cui {triage['mancati']} critici per il modello."
+        )
+    return 1 if conteggi["errori"] or conteggi["incompleti"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,17 +1,39 @@
 import streamlit as st
-import openai
+import threading
 import os
-import re
-import logging
-import io
-import json
-from dotenv import load_dotenv
-from bs4 import BeautifulSoup
-import markdown
-from docx import Document
-from PyPDF2 import PdfReader
-from fpdf import FPDF
-from pydantic import BaseModel
+from concurrent.futures import Future
+from revisione import (
+    API_KEY,
+    TONE_OPTIONS,
+    TRIAGE_MODE,
+    build_docx,
+    build_modifications,
+    build_text_pdf,
+    check_api,
+    configure_logging,
+    content_hash,
+    convert_html_to_plural,
+    convert_text_to_plural,
+    convert_units_to_plural,
+    diff_blocchi,
+    filtra_blocchi_avanzata,
+    get_file_caricati,
+    get_jobs,
+    get_llm_cache,
+    get_metrics,
+    get_preclassificatore,
+    get_scheduler,
+    highlight_matches,
+    iter_document_blocks,
+    misura_esecuzione,
+    pattern_matcher,
+    process_file_content,
+    process_html_content,
+    process_pdf_content_with_overlay,
+)
+
+# La logica di revisione vive in revisione.py (condivisa con revisione_batch.py):
+# qui resta solo l'interfaccia Streamlit.
 
 # Configurazione iniziale
 ########################################
@@ -23,247 +45,213 @@ st.set_page_config(
     page_icon="📄"
 )
 
-load_dotenv()
+configure_logging()
 
-class Settings(BaseModel):
-    OPENROUTER_API_KEY: str
+# Validità (secondi) dell'esito del controllo di connessione all'API
+HEALTH_CHECK_TTL = int(os.getenv("HEALTH_CHECK_TTL", "600"))
 
-settings = Settings(OPENROUTER_API_KEY=os.getenv("OPENROUTER_API_KEY"))
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("app.log"), logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
+# Intervallo (secondi) tra due aggiornamenti dell'avanzamento delle elaborazioni in background
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
 
-API_KEY = settings.OPENROUTER_API_KEY
 if not API_KEY:
     st.error("⚠️ Errore: API Key di OpenRouter non trovata! Impostala come variabile d'ambiente.")
     st.stop()
 
-try:
-    client = openai.OpenAI(api_key=API_KEY, base_url="https://openrouter.ai/api/v1")
-    test_response = client.chat.completions.create(
-        model="google/gemini-2.0-pro-exp-02-05:free",
-        messages=[{"role": "system", "content": "Test"}]
-    )
-    if not test_response:
-        st.error("⚠️ Errore: Chiave API non valida!")
-        st.stop()
-except Exception as e:
-    st.error(f"⚠️ Errore di connessione all'API: {e}")
-    st.stop()
-
-# Pattern critici aggiornati per includere anche frasi come "io e ..."
-CRITICAL_PATTERNS = [
-    r"\bIlias Contreas\b",
-    r"\bIlias\b",
-    r"\bContreas\b",
-    r"\bJoey\b",
-    r"\bMya\b",
-    r"\bmia moglie\b",
-    r"\bmia figlia\b",
-    r"\bShake Your English\b",
-    r"\bBarman PR\b",
-    r"\bStairs Club\b",
-    r"\bil mio socio\b",
-    r"\bio e il mio socio\b",
-    r"\bil mio corso\b",
-    r"\bla mia accademia\b",
-    r"\bintervista\b",
-    r"Mi chiamo .*? la mia esperienza personale\.",
-    r"\bflair\b",
-    r"\bfiglio di papà\b",
-    r"\bhappy our\b",
-    r"\bio e\b\s+.+"
-]
-compiled_patterns = [re.compile(p, re.IGNORECASE) for p in CRITICAL_PATTERNS]
-
-TONE_OPTIONS = {
-    "Stile originale": "Mantieni lo stesso stile e struttura del testo originale.",
-    "Formale": "Riscrivi in modo formale e professionale, adatto a documenti ufficiali.",
-    "Informale": "Riscrivi in modo amichevole e colloquiale, adatto a comunicazioni informali.",
-    "Tecnico": "Riscrivi con linguaggio tecnico e preciso, adatto ad un manuale tecnico.",
-    "Narrativo": "Riscrivi in modo descrittivo e coinvolgente stile racconto.",
-    "Pubblicitario": "Riscrivi in modo persuasivo, come una pubblicità.",
-    "Giornalistico": "Riscrivi in tono chiaro e informativo.",
-}
+@st.cache_resource(ttl=HEALTH_CHECK_TTL)
+def api_health_check():
+    """
+    Avvia in background il controllo di connessione all'API e ne restituisce il Future.
+    L'esito resta in cache per HEALTH_CHECK_TTL secondi, quindi i rerun non lo ripetono.
+    """
+    future = Future()
+    threading.Thread(target=lambda: future.set_result(check_api()), daemon=True).start()
+    return future
 
 # Funzioni di supporto
 ########################################
 
-def ai_convert_first_singular_to_plural(text):
-    if not text.strip():
-        return ""
-    prompt = (
-        "Riscrivi il seguente testo modificando esclusivamente il modo di interloquire da prima persona singolare a prima persona plurale. "
-        "Mantieni invariato il contenuto e il senso logico.\n\n"
-        f"Testo originale:\n{text}"
-    )
-    try:
-        response = client.chat.completions.create(
-            model="google/gemini-2.0-pro-exp-02-05:free",
-            messages=[{"role": "system", "content": prompt}],
-            max_tokens=500,
-            timeout=10
-        )
-        if response and hasattr(response, "choices") and response.choices:
-            return response.choices[0].message.content.strip()
-        logger.error("⚠️ Errore: Nessun testo valido restituito dall'API per la conversione in plurale.")
-        return ""
-    except Exception as e:
-        logger.error(f"⚠️ Errore nell'elaborazione (conversione in plurale): {e}")
-        return ""
-
-def convert_plain_text_to_minimal_html(text):
-    paragraphs = "".join(f"<p>{line.strip()}</p>" for line in text.splitlines() if line.strip())
-    return f"""<!DOCTYPE html>
-<html lang="it">
-<head>
-  <meta charset="utf-8">
-  <title>Documento Revisionato</title>
-</head>
-<body>
-{paragraphs}
-</body>
-</html>"""
-
-def extract_context(blocks, selected_block):
-    try:
-        index = blocks.index(selected_block)
-        prev_block = blocks[index - 1] if index > 0 else ""
-        next_block = blocks[index + 1] if index < len(blocks) - 1 else ""
-        return prev_block, next_block
-    except ValueError:
-        logger.error("Il blocco selezionato non è presente nella lista.")
-        return "", ""
-
-def ai_rewrite_text(text, prev_text, next_text, tone):
-    prompt = (
-        f"Contesto:\nPrecedente: {prev_text}\nTesto: {text}\nSuccessivo: {next_text}\n\n"
-        f"Riscrivi il 'Testo' in tono '{tone}'. Rimuovi eventuali dettagli personali o identificabili. "
-        "Rispondi con UNA sola frase, senza ulteriori commenti."
-    )
-    try:
-        response = client.chat.completions.create(
-            model="google/gemini-2.0-pro-exp-02-05:free",
-            messages=[{"role": "system", "content": prompt}],
-            max_tokens=50
-        )
-        if response and hasattr(response, "choices") and response.choices:
-            return response.choices[0].message.content.strip()
-        logger.error("⚠️ Errore: Nessun testo valido restituito dall'API per la riscrittura del blocco.")
-        return ""
-    except Exception as e:
-        logger.error(f"⚠️ Errore nell'elaborazione (riscrittura del blocco): {e}")
-        return ""
-
-def ai_analyze_block(prev_text, text, next_text):
-    prompt = f"""Contesto:
-Precedente: {prev_text}
-Testo: {text}
-Successivo: {next_text}
-
-Analizza il blocco di testo e indica se è "Critico" o "Non critico" in base alla presenza di informazioni sensibili, dati personali o riferimenti problematici, con particolare attenzione a frasi che iniziano con "io e". 
-Rispondi esattamente in questo formato JSON:
-{{
-  "classificazione": "Critico" o "Non critico",
-  "motivazione": "Descrizione sintetica degli elementi problematici, se presenti."
-}}
-"""
-    try:
-        response = client.chat.completions.create(
-            model="google/gemini-2.0-pro-exp-02-05:free",
-            messages=[{"role": "system", "content": prompt}],
-            max_tokens=150
-        )
-        raw_output = response.choices[0].message.content.strip() if (response and hasattr(response, "choices") and response.choices) else ""
-        logger.info(f"Risposta grezza per il blocco: {raw_output}")
-        if not raw_output:
-            logger.error("⚠️ Errore: Nessun testo valido restituito dall'API per l'analisi del blocco.")
-            return None
-        return raw_output
-    except Exception as e:
-        logger.error(f"⚠️ Errore nell'analisi del blocco: {e}")
-        return None
+def salva_caricamento(uploaded_file, file_extension):
+    """
+    Copia il file caricato in un file temporaneo, una sola volta per versione: i parser lo
+    leggono da disco (anche dai processi di estrazione dei PDF) invece di riceverne copie.
+    Il file della versione precedente viene eliminato; quelli delle sessioni chiuse li
+    elimina FileCaricati dopo UPLOAD_TTL_SECONDS secondi senza uso.
+    """
+    precedente = st.session_state.get("file_path")
+    if precedente:
+        get_file_caricati().rimuovi(precedente)
+    return get_file_caricati().salva(uploaded_file, f".{file_extension}")
 
-def filtra_blocchi_avanzata(blocchi, max_length=300):
+def al_download(genera, *args):
     """
-    Filtra i blocchi di testo per individuare quelli critici.
-    Combina:
-      1. Controllo tramite regex.
-      2. Analisi contestuale tramite API.
-    Deduplica i blocchi e, per la visualizzazione, tronca quelli troppo lunghi.
+    Contenuto di un pulsante di download generato (con genera(*args)) solo quando l'utente
+    lo richiede, invece che a ogni rerun.
     """
-    blocchi_filtrati = {}
-    seen = set()
-    for i, blocco in enumerate(blocchi):
-        # Evita duplicati
-        if blocco in seen:
-            continue
-        seen.add(blocco)
-        # Verifica tramite regex
-        regex_match = any(pattern.search(blocco) for pattern in compiled_patterns)
-        # Analisi contestuale
-        analysis = ai_analyze_block("", blocco, "")
-        classification = "Non critico"  # fallback di default
-        if analysis:
-            try:
-                result = json.loads(analysis)
-                classification = result.get("classificazione", "Non critico")
-            except Exception as e:
-                logger.error(f"Errore nel parsing dell'analisi: {e}")
-        # Se almeno uno segnala criticità, includi il blocco
-        if regex_match or (classification == "Critico"):
-            # Per visualizzazione, tronca se troppo lungo
-            display_blocco = blocco if len(blocco) <= max_length else blocco[:max_length] + "..."
-            blocchi_filtrati[f"{i}_{display_blocco}"] = blocco
-    return blocchi_filtrati
-
-def process_file_content(file_content, file_extension):
-    if file_extension == "html":
-        soup = BeautifulSoup(file_content, "html.parser")
-        blocks = [tag.get_text().strip() for tag in soup.find_all(["p", "span", "div", "li", "a", "h5"]) if tag.get_text().strip()]
-        return blocks, file_content
-    elif file_extension == "md":
-        html_content = markdown.markdown(file_content)
-        soup = BeautifulSoup(html_content, "html.parser")
-        blocks = [tag.get_text().strip() for tag in soup.find_all(["p", "span", "div", "li", "a", "h5"]) if tag.get_text().strip()]
-        return blocks, html_content
-    return [], ""
-
-def process_doc_file(uploaded_file):
-    try:
-        doc = Document(uploaded_file)
-        return [p.text.strip() for p in doc.paragraphs if p.text.strip()]
-    except Exception as e:
-        st.error(f"Errore nell'apertura del file Word: {e}")
-        st.stop()
+    def leggi():
+        with genera(*args) as output:
+            return output.read()
+    return leggi
+
+def da_file(output):
+    """Contenuto di un pulsante di download letto, solo quando l'utente lo richiede, da un file temporaneo (spooled_output)."""
+    def leggi():
+        output.seek(0)
+        return output.read()
+    return leggi
+
+def job_analisi(job, path, file_extension, nome_file, verdetti):
+    """
+    Job di analisi di un documento: parsing e ricerca dei blocchi critici. Restituisce i
+    valori da copiare in st.session_state (il job gira fuori dallo script e non può scriverli).
+    Word e PDF passano dal parser al filtro un blocco alla volta: dei loro testi restano solo
+    i blocchi critici, il resto viene riletto dal file temporaneo quando serve.
+    """
+    with misura_esecuzione("analisi", file=nome_file, formato=file_extension):
+        risultato = {}
+        if file_extension in ["html", "md"]:
+            with open(path, encoding="utf-8") as f:
+                html_blocks, html_content = process_file_content(f.read(), file_extension)
+            blocchi = [block.text for block in html_blocks]
+            risultato.update(html_blocks=html_blocks, html_content=html_content)
+            risultato["impronte_blocchi"] = {content_hash(blocco) for blocco in blocchi}
+            job.aggiorna(0, len(blocchi), fase="🔎 Analisi dei blocchi")
+        else:
+            impronte = risultato["impronte_blocchi"] = set()
 
-def process_pdf_file(uploaded_file):
-    try:
-        pdf_reader = PdfReader(uploaded_file)
-        paragraphs = []
-        for page in pdf_reader.pages:
-            text = page.extract_text()
-            if text:
-                paragraphs.extend([line.strip() for line in text.split("\n") if line.strip()])
-        return paragraphs
-    except Exception as e:
-        st.error(f"Errore nell'apertura del file PDF: {e}")
-        st.stop()
+            def con_impronte(blocchi):
+                for blocco in blocchi:
+                    impronte.add(content_hash(blocco))
+                    yield blocco
+
+            blocchi = con_impronte(iter_document_blocks(path, file_extension))
+            job.aggiorna(0, None, fase="🔎 Analisi dei blocchi")
+
+        def avanzamento(letti, totale, trovati):
+            job.aggiorna(letti, totale, list(trovati.values()))
 
-def process_html_content(html_content: str, modifications: dict, highlight: bool = False) -> str:
-    for original, new_text in modifications.items():
-        replacement = f"<mark>{new_text}</mark>" if highlight and new_text else new_text
-        pattern = re.escape(original)
-        html_content = re.sub(pattern, replacement, html_content)
-    return html_content
+        (
+            risultato["blocchi_da_revisionare"],
+            risultato["blocchi_non_analizzati"],
+            risultato["blocchi_simili"],
+        ) = filtra_blocchi_avanzata(blocchi, verdetti=verdetti, on_progress=avanzamento, cancel_event=job.cancel_event)
+        return risultato
 
-def process_pdf_content_with_overlay(pdf_file, modifications):
-    pdf_file.seek(0)
-    return pdf_file.read()
+def job_conversione(job, file_extension, sorgente, nome_file):
+    """
+    Job di conversione completa in plurale (sorgente è l'HTML per html/md, il percorso del
+    file per Word e PDF); restituisce (testo convertito, parti non convertite).
+    """
+    with misura_esecuzione("conversione", file=nome_file, formato=file_extension):
+        job.aggiorna(0, None, fase="🔄 Conversione")
+        if file_extension in ["html", "md"]:
+            return convert_html_to_plural(sorgente, on_progress=job.aggiorna, cancel_event=job.cancel_event)
+        contenuto = "\n".join(iter_document_blocks(sorgente, file_extension))
+        return convert_text_to_plural(contenuto, on_progress=job.aggiorna, cancel_event=job.cancel_event)
+
+def job_revisione(job, file_extension, nome_file, scelte_utente, sorgente, blocks, global_conversion):
+    """
+    Job di revisione: riscrive i blocchi scelti e costruisce il documento finale (sorgente è
+    l'HTML per html/md, da cui provengono blocks, il percorso del file per Word e PDF, che
+    viene riletto invece di tenerne i blocchi in memoria). Restituisce {"contenuto": file
+    temporaneo riavvolto o None, "anteprima": HTML da mostrare o None, "non_riscritti": n},
+    o None se annullato.
+    """
+    with misura_esecuzione("revisione", file=nome_file, formato=file_extension):
+        job.aggiorna(0, None, fase="✍️ Riscrittura")
+        if file_extension in ["html", "md"]:
+            blocchi = [block.text for block in blocks]
+        else:
+            blocchi = iter_document_blocks(sorgente, file_extension)
+        righe = []
+
+        def mostra_riscrittura(done, total, blocco, mod_blocco):
+            righe.append(f"- {blocco[:80]} → **{mod_blocco}**" if mod_blocco is not None else f"- {blocco[:80]} → ⚠️ non riscritto")
+            job.aggiorna(done, total, "\n".join(righe[-10:]))
+
+        modifications, non_riscritti = build_modifications(scelte_utente, blocchi, on_progress=mostra_riscrittura, cancel_event=job.cancel_event)
+        if job.annullato:
+            return None
+        risultato = {"contenuto": None, "anteprima": None, "non_riscritti": non_riscritti}
+        if file_extension in ["html", "md"]:
+            final_content = process_html_content(sorgente, modifications, highlight=True, blocks=blocks)
+            if global_conversion:
+                job.aggiorna(0, None, fase="🔄 Conversione globale")
+                final_content, _ = convert_html_to_plural(final_content, on_progress=lambda done, total, _: job.aggiorna(done, total), cancel_event=job.cancel_event)
+            risultato["anteprima"] = final_content
+        elif file_extension in ["doc", "docx"]:
+            full_text = "\n".join(modifications.get(p, p) for p in iter_document_blocks(sorgente, file_extension))
+            if global_conversion:
+                job.aggiorna(0, None, fase="🔄 Conversione globale")
+                full_text, _ = convert_text_to_plural(full_text, on_progress=lambda done, total, _: job.aggiorna(done, total), cancel_event=job.cancel_event)
+            risultato["contenuto"] = build_docx(full_text)
+        else:
+            if global_conversion:
+                job.aggiorna(0, None, fase="🔄 Conversione globale")
+                chiavi = [k for k in modifications if modifications[k].strip()]
+                convertiti, _ = convert_units_to_plural([modifications[k] for k in chiavi])
+                modifications.update(zip(chiavi, convertiti))
+            job.aggiorna(0, None, fase="📄 Costruzione del PDF")
+            risultato["contenuto"] = process_pdf_content_with_overlay(sorgente, modifications)
+        return None if job.annullato else risultato
+
+def avvia_job(chiave, tipo, funzione, *args):
+    """Avvia un job in background e ne salva l'id nella sessione, annullando il precedente."""
+    annulla_job(chiave)
+    st.session_state[chiave] = get_jobs().submit(tipo, funzione, *args).id
+
+def annulla_job(chiave):
+    get_jobs().rimuovi(st.session_state.pop(chiave, None))
+
+def consuma_job(chiave):
+    """Risultato del job completato salvato in chiave, che viene rimosso (dalla sessione e dal JobManager)."""
+    job_id = st.session_state.pop(chiave)
+    risultato = get_jobs().get(job_id).risultato
+    get_jobs().rimuovi(job_id)
+    return risultato
+
+def segui_job(chiave, descrizione, anteprima=None):
+    """
+    Job salvato nella sessione con chiave (None se non c'è o è scaduto). Se è in corso ne mostra
+    l'avanzamento in un frammento aggiornato ogni JOB_POLL_INTERVAL secondi, senza rieseguire la
+    pagina, finché non termina; se è terminato con un errore o è stato annullato lo segnala.
+    anteprima(parziale) disegna i risultati parziali.
+    """
+    job = get_jobs().get(st.session_state.get(chiave))
+    if job is None:
+        st.session_state.pop(chiave, None)
+        return None
+    if job.stato == "errore":
+        st.error(f"⚠️ {descrizione}: errore durante l'elaborazione: {job.errore}")
+    elif job.stato == "annullato":
+        st.warning(f"⏹️ {descrizione}: elaborazione annullata.")
+    elif not job.terminato:
+        @st.fragment(run_every=JOB_POLL_INTERVAL)
+        def avanzamento():
+            if job.terminato:
+                st.rerun()
+            # Il job legge ancora il file caricato anche se la pagina non viene rieseguita
+            get_file_caricati().usa(st.session_state.get("file_path"))
+            testo = job.fase or descrizione
+            if job.annullato:
+                testo = "⏹️ Annullamento in corso..."
+            elif job.totale:
+                testo += f": {job.completati} su {job.totale}"
+            st.progress(job.completati / job.totale if job.totale else 0.0, text=testo)
+            if not job.annullato and st.button("⏹️ Annulla", key=f"annulla_{job.id}"):
+                job.annulla()
+            if anteprima is not None and job.parziale is not None:
+                anteprima(job.parziale)
+
+        avanzamento()
+    return job
+
+def anteprima_analisi(trovati):
+    st.caption(f"Blocchi da revisionare trovati finora: {len(trovati)}")
+    if trovati:
+        st.markdown("\n".join(f"- {blocco[:120]}" for blocco in trovati[-5:]))
+
+def anteprima_html(parziale):
+    st.components.v1.html(parziale, height=500, scrolling=True)
 
 # Logica principale dell'applicazione
 ########################################
@@ -283,55 +271,145 @@ global_conversion = st.checkbox(
     help="Seleziona per convertire l'intero documento dalla prima persona singolare alla prima persona plurale dopo le revisioni dei blocchi critici."
 )
 
+with st.sidebar:
+    health_check = api_health_check()
+    if not health_check.done():
+        st.caption("🔄 Verifica della connessione all'API in corso...")
+    else:
+        api_ok, api_error = health_check.result()
+        if api_ok:
+            st.caption("🟢 API raggiungibile")
+        else:
+            st.error(f"⚠️ {api_error}")
+            if st.button("Riprova connessione"):
+                api_health_check.clear()
+                st.rerun()
+    st.subheader("🚦 Richieste all'API")
+    richieste = get_scheduler().status()
+    if richieste["stato"] == "chiuso":
+        st.caption(f"🟢 Concorrenza {richieste['concorrenza']}/{richieste['max_concorrenza']} · In corso: {richieste['in_volo']}")
+    elif richieste["stato"] == "aperto":
+        st.error(f"⚠️ Richieste sospese per {richieste['riapertura']:.0f} s dopo errori ripetuti: {richieste['ultimo_errore']}")
+    else:
+        st.warning("🟡 Verifica della ripresa dell'API in corso...")
+    if richieste["pausa"] > 0:
+        st.caption(f"⏳ Limite del provider raggiunto: ripresa tra {richieste['pausa']:.0f} s")
+    st.caption(f"Richieste: {richieste['richieste']} · Ritentativi: {richieste['ritentativi']} · Errori: {richieste['errori']}")
+    lavori = get_jobs().status()
+    if lavori.get("in corso") or lavori.get("in coda"):
+        st.caption(f"🧵 Elaborazioni in background: {lavori.get('in corso', 0)} in corso, {lavori.get('in coda', 0)} in coda")
+    st.subheader("🗄️ Cache risposte AI")
+    cache_stats = get_llm_cache().stats()
+    st.caption(f"Voci: {cache_stats['voci']} · Hit: {cache_stats['hit']} · Miss: {cache_stats['miss']}")
+    if st.button("Svuota cache", help="Elimina tutte le risposte salvate, forzando una nuova analisi."):
+        get_llm_cache().clear()
+    if TRIAGE_MODE in ("shadow", "active"):
+        st.subheader("🧠 Pre-classificazione locale")
+        triage = get_preclassificatore().stats()
+        st.caption(f"Modalità: {TRIAGE_MODE} · Esempi: {triage['esempi']} (critici: {triage['critici']}) · Blocchi non inviati all'API: {triage['saltati']}")
+        if triage["valutati"]:
+            st.caption(
+                f"Accordo con il modello: {triage['concordi'] / triage['valutati']:.1%} su {triage['valutati']} blocchi · "
+                f"Sicuramente non critici: {triage['sicuri']}, di cui critici per il modello: {triage['mancati']}"
+            )
+    with st.expander("⏱️ Prestazioni"):
+        metriche = get_metrics().snapshot()
+        if not metriche["fasi"] and not metriche["llm"]:
+            st.caption("Nessuna elaborazione ancora misurata.")
+        if metriche["fasi"]:
+            st.caption("Fasi (tempo inclusivo delle fasi richiamate)")
+            st.dataframe([
+                {"fase": nome, "esecuzioni": fase_misurata["chiamate"], "secondi": round(fase_misurata["secondi"], 2)}
+                for nome, fase_misurata in sorted(metriche["fasi"].items(), key=lambda item: -item[1]["secondi"])
+            ], hide_index=True)
+        if metriche["llm"]:
+            st.caption("Richieste al modello")
+            st.dataframe([
+                {
+                    "funzione": nome,
+                    "richieste": voce["richieste"],
+                    "cache": voce["cache_hit"],
+                    "token in": voce["prompt_tokens"],
+                    "token out": voce["completion_tokens"],
+                    "ritentativi": voce["ritentativi"],
+                    "errori": voce["errori"],
+                    "secondi": round(voce["secondi"], 2),
+                }
+                for nome, voce in metriche["llm"].items()
+            ], hide_index=True)
+            token_totali = sum(voce["prompt_tokens"] + voce["completion_tokens"] for voce in metriche["llm"].values())
+            st.caption(f"Token totali: {token_totali}")
+        if st.button("Azzera metriche"):
+            get_metrics().reset()
+            st.rerun()
+
 uploaded_file = st.file_uploader("📂 Seleziona un file (html, md, doc, docx, pdf)", type=["html", "md", "doc", "docx", "pdf"])
 
 if uploaded_file is not None:
     try:
-        file_bytes = uploaded_file.read()
-        uploaded_file.seek(0)
+        file_bytes = uploaded_file.getvalue()
         file_extension = uploaded_file.name.split('.')[-1].lower()
         st.success(f"File caricato con successo: {uploaded_file.name}")
     except Exception as e:
         st.error(f"Errore durante la lettura del file: {e}")
         st.stop()
 
-    if "file_processed" not in st.session_state:
-        if file_extension in ["html", "md"]:
-            file_content = file_bytes.decode("utf-8")
-            blocchi, html_content = process_file_content(file_content, file_extension)
-            st.session_state.blocchi = blocchi
-            st.session_state.html_content = html_content
-            st.session_state.blocchi_da_revisionare = filtra_blocchi_avanzata(blocchi)
-        elif file_extension in ["doc", "docx"]:
-            paragraphs = process_doc_file(io.BytesIO(file_bytes))
-            st.session_state.paragraphs = paragraphs
-            st.session_state.blocchi_da_revisionare = filtra_blocchi_avanzata(paragraphs)
-        elif file_extension == "pdf":
-            paragraphs = process_pdf_file(io.BytesIO(file_bytes))
-            st.session_state.paragraphs = paragraphs
-            st.session_state.blocchi_da_revisionare = filtra_blocchi_avanzata(paragraphs)
-        st.session_state.file_processed = True
+    # Lo stato dell'analisi è legato al contenuto del file: caricandone una nuova versione
+    # si rianalizzano solo i blocchi aggiunti o modificati, gli altri riprendono il verdetto precedente.
+    # L'analisi gira in background: la pagina resta utilizzabile e ne mostra l'avanzamento
+    file_hash = content_hash(file_bytes)
+    if st.session_state.get("file_hash") != file_hash:
+        for chiave in ("job_analisi", "job_conversione", "job_revisione"):
+            annulla_job(chiave)
+        st.session_state.pop("converted_text", None)
+        st.session_state.pop("conversion_failed", None)
+        st.session_state.pop("risultato_revisione", None)
+        st.session_state.verdetti = dict(st.session_state.get("verdetti", {}))
+        st.session_state.file_path = salva_caricamento(uploaded_file, file_extension)
+        avvia_job("job_analisi", "analisi", job_analisi, st.session_state.file_path, file_extension, uploaded_file.name, st.session_state.verdetti)
+        st.session_state.file_hash = file_hash
+    elif not get_file_caricati().usa(st.session_state.file_path):
+        # Copia eliminata perché la sessione è rimasta inattiva oltre UPLOAD_TTL_SECONDS
+        st.session_state.file_path = salva_caricamento(uploaded_file, file_extension)
+
+    if st.session_state.get("file_analizzato") != file_hash:
+        job = segui_job("job_analisi", "Analisi del documento", anteprima=anteprima_analisi)
+        if job is None or job.stato in ("errore", "annullato"):
+            # I verdetti ottenuti prima dell'interruzione restano: si riprende da dove si era arrivati
+            if st.button("🔄 Riavvia analisi"):
+                st.session_state.pop("file_hash", None)
+                st.rerun()
+        if job is None or job.stato != "completato":
+            st.stop()
+        impronte_precedenti = st.session_state.get("impronte_blocchi")
+        for chiave, valore in consuma_job("job_analisi").items():
+            st.session_state[chiave] = valore
+        if impronte_precedenti is not None:
+            st.session_state.diff_versione = diff_blocchi(impronte_precedenti, st.session_state.impronte_blocchi)
+        # Si conservano solo i verdetti dei blocchi di questa versione
+        verdetti = st.session_state.verdetti
+        st.session_state.verdetti = {impronta: verdetti[impronta] for impronta in st.session_state.impronte_blocchi if impronta in verdetti}
+        st.session_state.file_analizzato = file_hash
+
+    if "diff_versione" in st.session_state:
+        invariati, modificati, rimossi = st.session_state.diff_versione
+        st.info(f"🔁 Rispetto alla versione precedente: {invariati} blocchi invariati, {modificati} aggiunti o modificati, {rimossi} rimossi. Sono stati analizzati solo i blocchi nuovi.")
 
     if modalita == "Conversione completa in plurale":
-        if file_extension in ["html", "md"]:
-            file_content = file_bytes.decode("utf-8")
-            if file_extension == "html":
-                soup = BeautifulSoup(file_content, "html.parser")
-                body = soup.body
-                original_body_text = body.get_text(separator="\n") if body else file_content
-            else:
-                original_body_text = file_content
-
-            if st.button("Genera Anteprima Conversione Completa in Plurale"):
-                converted_text = ai_convert_first_singular_to_plural(original_body_text)
-                st.session_state.converted_text = converted_text
-
-            if "converted_text" in st.session_state:
+        if st.button("Genera Anteprima Conversione Completa in Plurale"):
+            st.session_state.pop("converted_text", None)
+            sorgente = st.session_state.html_content if file_extension in ["html", "md"] else st.session_state.file_path
+            avvia_job("job_conversione", "conversione", job_conversione, file_extension, sorgente, uploaded_file.name)
+        job = segui_job("job_conversione", "Conversione", anteprima=anteprima_html if file_extension in ["html", "md"] else st.text)
+        if job is not None and job.stato == "completato":
+            st.session_state.converted_text, st.session_state.conversion_failed = consuma_job("job_conversione")
+
+        if "converted_text" in st.session_state:
+            if st.session_state.conversion_failed:
+                st.warning(f"⚠️ {st.session_state.conversion_failed} parti del documento non sono state convertite e sono rimaste invariate.")
+            if file_extension in ["html", "md"]:
                 st.subheader("📌 Testo Revisionato (Conversione Completa in Plurale)")
-                if "<" in st.session_state.converted_text:
-                    final_html = st.session_state.converted_text
-                else:
-                    final_html = convert_plain_text_to_minimal_html(st.session_state.converted_text)
+                final_html = st.session_state.converted_text
                 st.components.v1.html(final_html, height=500, scrolling=True)
                 st.download_button(
                     "📥 Scarica File Revisionato",
@@ -339,45 +417,20 @@ if uploaded_file is not None:
                     file_name="document_revised.html",
                     mime="text/html"
                 )
-        elif file_extension in ["doc", "docx"]:
-            paragraphs = process_doc_file(io.BytesIO(file_bytes))
-            full_text = "\n".join(paragraphs)
-            if st.button("Genera Anteprima Conversione Completa in Plurale"):
-                converted_text = ai_convert_first_singular_to_plural(full_text)
-                st.session_state.converted_text = converted_text
-
-            if "converted_text" in st.session_state:
+            elif file_extension in ["doc", "docx"]:
                 st.subheader("📌 Testo Revisionato (Conversione Completa in Plurale)")
                 st.write(st.session_state.converted_text)
-                new_doc = Document()
-                new_doc.add_paragraph(st.session_state.converted_text)
-                buffer = io.BytesIO()
-                new_doc.save(buffer)
                 st.download_button(
                     "📥 Scarica Documento Revisionato",
-                    data=buffer.getvalue(),
+                    data=al_download(build_docx, st.session_state.converted_text),
                     file_name="document_revised.docx",
                     mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                 )
-        elif file_extension == "pdf":
-            paragraphs = process_pdf_file(io.BytesIO(file_bytes))
-            full_text = "\n".join(paragraphs)
-            if st.button("Genera Anteprima Conversione Completa in Plurale"):
-                converted_text = ai_convert_first_singular_to_plural(full_text)
-                st.session_state.converted_text = converted_text
-
-            if "converted_text" in st.session_state:
+            elif file_extension == "pdf":
                 st.subheader("📌 PDF Revisionato (Conversione Completa in Plurale)")
-                pdf = FPDF()
-                pdf.add_page()
-                pdf.set_auto_page_break(auto=True, margin=15)
-                pdf.set_font("Arial", size=12)
-                pdf.multi_cell(0, 10, st.session_state.converted_text)
-                buffer = io.BytesIO()
-                pdf.output(buffer, 'F')
                 st.download_button(
                     "📥 Scarica PDF Revisionato",
-                    data=buffer.getvalue(),
+                    data=al_download(build_text_pdf, st.session_state.converted_text),
                     file_name="document_revised.pdf",
                     mime="application/pdf"
                 )
@@ -386,88 +439,72 @@ if uploaded_file is not None:
             with st.form("blocchi_form"):
                 st.subheader("📌 Blocchi da revisionare")
                 scelte_utente = {}
-                if file_extension in ["html", "md"]:
-                    blocchi = st.session_state.blocchi
-                else:
-                    blocchi = st.session_state.paragraphs
 
+                if st.session_state.blocchi_non_analizzati:
+                    st.warning(f"⚠️ {len(st.session_state.blocchi_non_analizzati)} blocchi non sono stati analizzati dall'AI (API non disponibile) e vanno verificati manualmente.")
+                # Scelte indicizzate per impronta del blocco: restano valide nelle versioni successive del documento
+                scelte_salvate = st.session_state.setdefault("scelte_blocchi", {})
+                azioni = ["Riscrivi", "Elimina", "Ignora"]
+                toni = list(TONE_OPTIONS.keys())
                 for uid, blocco in st.session_state.blocchi_da_revisionare.items():
-                    st.markdown(f"**{blocco}**")
-                    azione = st.radio("Azione per questo blocco:", ["Riscrivi", "Elimina", "Ignora"], key=f"action_{uid}")
+                    st.markdown(f"**{highlight_matches(blocco, pattern_matcher.find_all(blocco))}**", unsafe_allow_html=True)
+                    if uid in st.session_state.blocchi_non_analizzati:
+                        st.caption("⚠️ Analisi AI non disponibile per questo blocco")
+                    simili = st.session_state.blocchi_simili.get(uid, [])
+                    if simili:
+                        with st.expander(f"🔁 Blocchi quasi identici che riceveranno la stessa azione: {len(simili)}"):
+                            st.markdown("\n".join(f"- {simile[:200]}" for _, simile in simili))
+                    impronta = content_hash(blocco)
+                    precedente = scelte_salvate.get(impronta, {})
+                    azione = st.radio("Azione per questo blocco:", azioni, index=azioni.index(precedente.get("azione", azioni[0])), key=f"action_{impronta}")
                     tono = None
                     if azione == "Riscrivi":
-                        tono = st.selectbox("Scegli il tono:", list(TONE_OPTIONS.keys()), key=f"tone_{uid}")
-                    scelte_utente[blocco] = {"azione": azione, "tono": tono}
+                        tono = st.selectbox("Scegli il tono:", toni, index=toni.index(precedente.get("tono") or toni[0]), key=f"tone_{impronta}")
+                    scelte_salvate[impronta] = {"azione": azione, "tono": tono}
+                    scelte_utente[blocco] = {"azione": azione, "tono": tono, "indice": int(uid.split("_", 1)[0])}
+                    for indice, simile in simili:
+                        scelte_utente[simile] = {"azione": azione, "tono": tono, "indice": indice}
                 submitted = st.form_submit_button("✍️ Genera Documento Revisionato")
             if submitted:
-                modifications = {}
                 if file_extension in ["html", "md"]:
-                    html_content = st.session_state.html_content
-                    for blocco, info in scelte_utente.items():
-                        if info["azione"] == "Riscrivi":
-                            prev_blocco, next_blocco = extract_context(blocchi, blocco)
-                            mod_blocco = ai_rewrite_text(blocco, prev_blocco, next_blocco, info["tono"])
-                            modifications[blocco] = mod_blocco
-                        elif info["azione"] == "Elimina":
-                            modifications[blocco] = ""
-                        else:
-                            modifications[blocco] = blocco
-                    final_content = process_html_content(html_content, modifications, highlight=True)
-                    if global_conversion:
-                        final_content = ai_convert_first_singular_to_plural(final_content)
-                    st.success("✅ Revisione completata!")
+                    sorgente, blocks = st.session_state.html_content, st.session_state.html_blocks
+                else:
+                    sorgente, blocks = st.session_state.file_path, None
+                st.session_state.pop("risultato_revisione", None)
+                avvia_job(
+                    "job_revisione", "revisione", job_revisione, file_extension, uploaded_file.name,
+                    scelte_utente, sorgente, blocks, global_conversion
+                )
+            job = segui_job("job_revisione", "Revisione", anteprima=st.markdown)
+            if job is not None and job.stato == "completato":
+                st.session_state.risultato_revisione = consuma_job("job_revisione")
+            # Il risultato resta disponibile anche nei rerun successivi, fino alla prossima revisione
+            if "risultato_revisione" in st.session_state:
+                risultato = st.session_state.risultato_revisione
+                if risultato["non_riscritti"]:
+                    st.warning(f"⚠️ {risultato['non_riscritti']} blocchi non sono stati riscritti (API non disponibile) e sono rimasti invariati.")
+                st.success("✅ Revisione completata!")
+                if file_extension in ["html", "md"]:
                     st.subheader("🌍 Anteprima con Testo Revisionato")
-                    st.components.v1.html(final_content, height=500, scrolling=True)
+                    st.components.v1.html(risultato["anteprima"], height=500, scrolling=True)
                     st.download_button(
                         "📥 Scarica HTML Revisionato",
-                        data=final_content.encode("utf-8"),
+                        data=risultato["anteprima"].encode("utf-8"),
                         file_name="document_revised.html",
                         mime="text/html"
                     )
                 elif file_extension in ["doc", "docx"]:
-                    for paragrafo, info in scelte_utente.items():
-                        if info["azione"] == "Riscrivi":
-                            prev_par, next_par = extract_context(blocchi, paragrafo)
-                            mod_par = ai_rewrite_text(paragrafo, prev_par, next_par, info["tono"])
-                            modifications[paragrafo] = mod_par
-                        elif info["azione"] == "Elimina":
-                            modifications[paragrafo] = ""
-                        else:
-                            modifications[paragrafo] = paragrafo
-                    full_text = "\n".join([modifications.get(p, p) for p in blocchi])
-                    if global_conversion:
-                        full_text = ai_convert_first_singular_to_plural(full_text)
-                    new_doc = Document()
-                    new_doc.add_paragraph(full_text)
-                    buffer = io.BytesIO()
-                    new_doc.save(buffer)
-                    st.success("✅ Revisione completata!")
                     st.subheader("🌍 Anteprima Testo (Word)")
                     st.download_button(
                         "📥 Scarica Documento Word Revisionato",
-                        data=buffer.getvalue(),
+                        data=da_file(risultato["contenuto"]),
                         file_name="document_revised.docx",
                         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
                     )
                 elif file_extension == "pdf":
-                    for blocco, info in scelte_utente.items():
-                        if info["azione"] == "Riscrivi":
-                            prev_blocco, next_blocco = extract_context(blocchi, blocco)
-                            mod_blocco = ai_rewrite_text(blocco, prev_blocco, next_blocco, info["tono"])
-                            modifications[blocco] = mod_blocco
-                        elif info["azione"] == "Elimina":
-                            modifications[blocco] = ""
-                        else:
-                            modifications[blocco] = blocco
-                    if global_conversion:
-                        for key in modifications:
-                            modifications[key] = ai_convert_first_singular_to_plural(modifications[key])
-                    with st.spinner("🔄 Riscrittura in corso..."):
-                        revised_pdf = process_pdf_content_with_overlay(io.BytesIO(file_bytes), modifications)
-                    st.success("✅ Revisione completata!")
                     st.download_button(
                         "📥 Scarica PDF Revisionato",
-                        data=revised_pdf,
+                        data=da_file(risultato["contenuto"]),
                         file_name="document_revised.pdf",
                         mime="application/pdf"
                     )
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# I moduli dell'applicazione stanno nella radice del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Le metriche delle prove non vanno aggiunte a metrics.jsonl
+os.environ.setdefault("METRICS_PATH", "")
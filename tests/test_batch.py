@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import revisione
+from revisione import LLMCache, analyze_blocks, make_batches, rewrite_blocks
+
+class ErroreLimite(Exception):
+    """429 del provider, dopo i ritentativi dello scheduler."""
+
+    status_code = 429
+
+ITEMS = [(i, "", f"Blocco {i}: testo diverso da tutti gli altri ({i * 7}).", "") for i in range(40)]
+GRUPPI = len(make_batches(ITEMS, lambda item: item[2]))
+
+class Chiamate(list):
+    """Funzioni delle richieste inviate; risposta(funzione, prompt) decide l'esito di ognuna."""
+
+    risposta = None
+
+@pytest.fixture
+def chiamate(monkeypatch, tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite3"), "test")
+    monkeypatch.setattr(revisione, "get_llm_cache", lambda: cache)
+    chiamate = Chiamate()
+
+    def chat_completion(function, prompt, max_tokens, tone=None, timeout=None, validate=None):
+        chiamate.append(function)
+        return chiamate.risposta(function, prompt)
+
+    monkeypatch.setattr(revisione, "chat_completion", chat_completion)
+    return chiamate
+
+def _ids(prompt):
+    payload, _ = json.JSONDecoder().raw_decode(prompt, prompt.index('[{"id"'))
+    return [entry["id"] for entry in payload]
+
+def _non_disponibile(function, prompt):
+    raise ErroreLimite("Too Many Requests")
+
+def test_errore_api_non_moltiplica_le_richieste_di_analisi(chiamate):
+    chiamate.risposta = _non_disponibile
+    assert analyze_blocks(ITEMS) == [None] * len(ITEMS)
+    assert chiamate == ["ai_analyze_blocks_batch"] * GRUPPI
+
+def test_errore_api_non_moltiplica_le_richieste_di_riscrittura(chiamate):
+    chiamate.risposta = _non_disponibile
+    consegnati = []
+    risultati = rewrite_blocks([(testo, "", "", "Formale") for _, _, testo, _ in ITEMS], on_result=lambda n, testo: consegnati.append(n))
+    assert risultati == [None] * len(ITEMS)
+    assert sorted(consegnati) == list(range(len(ITEMS)))
+    assert chiamate == ["ai_rewrite_texts_batch"] * GRUPPI
+
+def test_elementi_non_validi_richiesti_singolarmente(chiamate):
+    def risposta(function, prompt):
+        if function == "ai_analyze_block":
+            return '{"classificazione": "Critico"}'
+        # Un elemento valido e uno con una classificazione non prevista per gruppo
+        ids = _ids(prompt)
+        return json.dumps([{"id": ids[0], "classificazione": "Non critico"}, {"id": ids[1], "classificazione": "Forse"}])
+
+    chiamate.risposta = risposta
+    risultati = analyze_blocks(ITEMS)
+    assert chiamate.count("ai_analyze_blocks_batch") == GRUPPI
+    assert chiamate.count("ai_analyze_block") == len(ITEMS) - GRUPPI
+    assert [r["classificazione"] for r in risultati].count("Non critico") == GRUPPI
+
+def test_risposta_illeggibile_richiesta_singolarmente(chiamate):
+    def risposta(function, prompt):
+        if function == "ai_rewrite_text":
+            return "Testo riscritto"
+        return "Mi dispiace, non posso rispondere in JSON."
+
+    chiamate.risposta = risposta
+    risultati = rewrite_blocks([(testo, "", "", "Formale") for _, _, testo, _ in ITEMS])
+    assert risultati == ["Testo riscritto"] * len(ITEMS)
+    assert chiamate.count("ai_rewrite_texts_batch") == GRUPPI
+    assert chiamate.count("ai_rewrite_text") == len(ITEMS)
@@ -0,0 +1,45 @@
+import itertools
+
+import revisione
+from revisione import LLMCache
+
+def _cache(tmp_path, **kwargs):
+    return LLMCache(str(tmp_path / "cache.sqlite3"), "v1", **kwargs)
+
+def test_letture_e_scritture(tmp_path):
+    cache = _cache(tmp_path)
+    assert cache.get("a") is None
+    cache.set("a", "f", "risposta")
+    assert cache.get("a") == "risposta"
+    assert cache.stats() == {"voci": 1, "hit": 1, "miss": 1}
+
+def test_versione_diversa_scartata(tmp_path):
+    _cache(tmp_path).set("a", "f", "risposta")
+    assert LLMCache(str(tmp_path / "cache.sqlite3"), "v2").get("a") is None
+    assert _cache(tmp_path).get("a") is None
+
+def test_rimuove_le_voci_usate_meno_di_recente(tmp_path):
+    cache = _cache(tmp_path, max_entries=10)
+    for i in range(10):
+        cache.set(f"k{i}", "f", str(i))
+    # Accessi non ancora scritti su disco: contano comunque per l'eliminazione
+    for i in range(5):
+        assert cache.get(f"k{i}") == str(i)
+    for i in range(10, 12):
+        cache.set(f"k{i}", "f", str(i))
+    assert cache.stats()["voci"] == 10
+    assert [cache.get(f"k{i}") is not None for i in range(12)] == [True] * 5 + [False] * 2 + [True] * 5
+
+def test_accessi_registrati_a_gruppi(tmp_path, monkeypatch):
+    monkeypatch.setattr(revisione.time, "time", itertools.count(1_000_000).__next__)
+    cache = _cache(tmp_path)
+    cache.ACCESSI_PER_SCRITTURA = 3
+    for i in range(3):
+        cache.set(f"k{i}", "f", str(i))
+    accessi = lambda: dict(cache._conn.execute("SELECT key, accessed FROM responses"))
+    prima = accessi()
+    cache.get("k0")
+    cache.get("k1")
+    assert accessi() == prima
+    cache.get("k2")
+    assert all(accessi()[k] > prima[k] for k in prima)
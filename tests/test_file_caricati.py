@@ -0,0 +1,49 @@
+import io
+import os
+
+import pytest
+
+import revisione
+from revisione import FileCaricati
+
+@pytest.fixture
+def orologio(monkeypatch):
+    adesso = [1000.0]
+    monkeypatch.setattr(revisione.time, "monotonic", lambda: adesso[0])
+    return adesso
+
+@pytest.fixture
+def caricati():
+    caricati = FileCaricati(ttl_seconds=60)
+    yield caricati
+    caricati.svuota()
+
+def test_salva_copia_il_contenuto(caricati):
+    sorgente = io.BytesIO(b"dati personali")
+    sorgente.read()
+    path = caricati.salva(sorgente, ".md")
+    assert path.endswith(".md")
+    with open(path, "rb") as f:
+        assert f.read() == b"dati personali"
+    assert sorgente.tell() == 0
+
+def test_eliminati_dopo_il_ttl_senza_uso(caricati, orologio):
+    usato = caricati.salva(io.BytesIO(b"a"))
+    abbandonato = caricati.salva(io.BytesIO(b"b"))
+    orologio[0] += 40
+    assert caricati.usa(usato)
+    orologio[0] += 40
+    assert caricati.usa(usato)
+    assert not os.path.exists(abbandonato)
+    assert not caricati.usa(abbandonato)
+    assert os.path.exists(usato)
+
+def test_rimuovi_e_svuota(caricati):
+    primo = caricati.salva(io.BytesIO(b"a"))
+    secondo = caricati.salva(io.BytesIO(b"b"))
+    caricati.rimuovi(primo)
+    assert not os.path.exists(primo)
+    assert not caricati.usa(primo)
+    caricati.svuota()
+    assert not os.path.exists(secondo)
+    assert not caricati.usa(None)
@@ -0,0 +1,45 @@
+import pytest
+
+from revisione import extract_html_blocks, parse_html, pattern_matcher, process_html_content, serialize_html
+
+def _testi(html):
+    return [block.text for block in extract_html_blocks(parse_html(html))]
+
+def test_blocchi_annidati_senza_duplicati():
+    assert _testi("<div>Prima <b>parte</b><p>Interno <i>in linea</i></p> coda</div>") == ["Prima parte coda", "Interno in linea"]
+
+def test_script_e_stili_esclusi():
+    assert _testi("<p>Testo<script>var Joey = 1;</script><style>p {}</style> visibile</p>") == ["Testo visibile"]
+
+@pytest.mark.parametrize("separatore", ["<br>", "<br/>", "<img src='x.png'>", "<input>"])
+def test_elementi_vuoti_separano_le_parole(separatore):
+    testo, = _testi(f"<p>Ciao Joey{separatore}Mya e io{separatore}Ilias</p>")
+    assert testo == "Ciao Joey Mya e io Ilias"
+    trovati = {m.pattern for m in pattern_matcher.find_all(testo)}
+    assert {r"\bJoey\b", r"\bMya\b", r"\bIlias\b"} <= trovati
+
+def test_sostituzione_di_un_blocco_con_a_capo():
+    html = "<p>Ciao Joey<br>Mya</p><p>Resta</p>"
+    blocco, _ = _testi(html)
+    risultato = process_html_content(html, {blocco: "Ciao a tutti"})
+    assert "<p>Ciao a tutti</p>" in risultato
+    assert "Joey" not in risultato and "<p>Resta</p>" in risultato
+
+@pytest.mark.parametrize("html, doctype", [
+    ("<p>Ciao Joey</p>", None),
+    ("<html><body><p>Ciao Joey</p></body></html>", None),
+    ("<!DOCTYPE html><html><body><p>Ciao Joey</p></body></html>", "<!DOCTYPE html>"),
+    ("<!-- intestazione -->\n<!doctype html><p>Ciao Joey</p>", "<!DOCTYPE html>"),
+])
+def test_doctype_originale_conservato(html, doctype):
+    risultato = process_html_content(html, {"Ciao Joey": "Ciao"})
+    assert "<p>Ciao</p>" in risultato
+    if doctype is None:
+        assert "<!DOCTYPE" not in risultato.upper()
+    else:
+        assert risultato.startswith(doctype)
+
+def test_serializzazione_senza_doctype():
+    root = parse_html("<!-- nota --><p>Testo</p>")
+    assert serialize_html(root, doctype=False) == "<!-- nota --><html><body><p>Testo</p></body></html>"
+    assert serialize_html(root).startswith("<!DOCTYPE")
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+from revisione import iter_json_array_items
+
+ELEMENTI = [
+    {"id": 0, "classificazione": "Critico"},
+    {"id": 1, "classificazione": "Non critico", "nota": "contiene ] e , e \"virgolette\""},
+    {"id": 2, "annidato": [1, [2, 3], {"a": None}]},
+    "stringa con [parentesi]",
+    12.5,
+    True,
+]
+
+def _frammenti(testo, dimensione):
+    return [testo[i:i + dimensione] for i in range(0, len(testo), dimensione)]
+
+@pytest.mark.parametrize("dimensione", [1, 2, 7, 1000])
+def test_array_completo_a_frammenti(dimensione):
+    testo = json.dumps(ELEMENTI, ensure_ascii=False, indent=2)
+    assert list(iter_json_array_items(_frammenti(testo, dimensione))) == ELEMENTI
+
+@pytest.mark.parametrize("dimensione", [1, 5, 1000])
+def test_array_in_blocco_di_codice(dimensione):
+    testo = "Ecco la classificazione:\n```json\n" + json.dumps(ELEMENTI[:3]) + "\n```\nAltro testo [1, 2]"
+    assert list(iter_json_array_items(_frammenti(testo, dimensione))) == ELEMENTI[:3]
+
+@pytest.mark.parametrize("taglio", [1, 10, 40, 100, -10, -2, -1])
+def test_array_troncato(taglio):
+    testo = json.dumps(ELEMENTI[:3])
+    troncato = testo[:taglio]
+    completi = [elemento for elemento in ELEMENTI[:3] if json.dumps(elemento) in troncato]
+    assert list(iter_json_array_items([troncato])) == completi
+
+def test_restituisce_gli_elementi_appena_completi():
+    consegnati = []
+    ricevuti = []
+
+    def frammenti():
+        for frammento in ['[{"id": 0}, ', '{"id"', ': 1}', ", 2", "3]"]:
+            consegnati.append(frammento)
+            yield frammento
+
+    for elemento in iter_json_array_items(frammenti()):
+        ricevuti.append((elemento, len(consegnati)))
+    # Il numero finale non viene restituito finché non è certo che sia terminato
+    assert ricevuti == [({"id": 0}, 1), ({"id": 1}, 3), (23, 5)]
+
+def test_numero_diviso_tra_frammenti():
+    assert list(iter_json_array_items(["[12", ".", "5e", "1, -", "3", "]"])) == [125.0, -3]
+
+def test_senza_array():
+    assert list(iter_json_array_items(["Nessun JSON ", "in questa risposta."])) == []
+    assert list(iter_json_array_items([])) == []
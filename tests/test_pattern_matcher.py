@@ -0,0 +1,70 @@
+import random
+import re
+
+import pytest
+
+from revisione import CRITICAL_PATTERNS, PatternMatcher
+
+TESTI = [
+    "",
+    "Nessun riferimento personale in questo paragrafo.",
+    "Ilias Contreas ha fondato il locale.",
+    "ILIAS e contreas, tutto maiuscolo e minuscolo.",
+    "Joeys e xJoey non sono Joey, ma Joey sì.",
+    "Mya_ e Mya.",
+    "Con mia moglie e mia figlia al Stairs Club.",
+    "Il corso Shake Your English e il Barman PR.",
+    "io e il mio socio abbiamo aperto la mia accademia",
+    "Io e\n  Joey, poi io eravamo.",
+    "dio e mio",
+    "Mi chiamo Luca e questa è la mia esperienza personale.",
+    "Mi chiamo Luca. Non è la mia esperienza personale",
+    "Un figlio di papà durante l'intervista.",
+    "FIGLIO DI PAPÀ, happy our, FLAIR!",
+    "il mio corso, il mio corsivo, intervistatore",
+]
+
+FRAMMENTI = [
+    "Ilias", "Contreas", "Joey", "Mya", "mia moglie", "mia figlia", "Shake Your English",
+    "Barman PR", "Stairs Club", "il mio socio", "io e", "il mio corso", "la mia accademia",
+    "intervista", "Mi chiamo", "la mia esperienza personale.", "flair", "figlio di papà",
+    "happy our", "io", "e", "mio", "papa", "x", "_", ".", ",", " ", "\n", "À", "ß",
+]
+
+def _attesi(testo):
+    return {pattern for pattern in CRITICAL_PATTERNS if re.search(pattern, testo, re.IGNORECASE)}
+
+def _testi_casuali(n, seed=0):
+    rng = random.Random(seed)
+    for _ in range(n):
+        parti = rng.choices(FRAMMENTI, k=rng.randint(1, 12))
+        testo = "".join(parte if rng.random() < 0.5 else " " + parte for parte in parti)
+        yield testo.upper() if rng.random() < 0.2 else testo
+
+@pytest.fixture(scope="module")
+def matcher():
+    return PatternMatcher(CRITICAL_PATTERNS)
+
+@pytest.mark.parametrize("testo", TESTI)
+def test_stessi_pattern_di_re_search(matcher, testo):
+    assert {m.pattern for m in matcher.find_all(testo)} == _attesi(testo)
+
+def test_testi_casuali(matcher):
+    for testo in _testi_casuali(2000):
+        trovati = matcher.find_all(testo)
+        assert {m.pattern for m in trovati} == _attesi(testo), testo
+        assert (matcher.search(testo) is not None) == bool(_attesi(testo)), testo
+
+def test_posizioni_delle_corrispondenze(matcher):
+    for testo in TESTI:
+        for m in matcher.find_all(testo):
+            trovato = re.compile(m.pattern, re.IGNORECASE).match(testo, m.start)
+            assert trovato is not None and trovato.end() == m.end, (testo, m)
+
+def test_termini_aggiuntivi():
+    matcher = PatternMatcher([], terms=["Acme S.p.A.", " ", "C++"])
+    assert [(m.pattern, m.start, m.end) for m in matcher.find_all("da acme s.p.a. e c++")] == [
+        ("Acme S.p.A.", 3, 14),
+        ("C++", 17, 20),
+    ]
+    assert matcher.search("acme spa") is None
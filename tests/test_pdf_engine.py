@@ -0,0 +1,47 @@
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import pdf_engine
+
+pymupdf = pytest.importorskip("pymupdf")
+
+@pytest.fixture
+def pdf(tmp_path):
+    path = tmp_path / "documento.pdf"
+    with pymupdf.open() as doc:
+        for n in range(7):
+            page = doc.new_page()
+            page.insert_text((72, 72), f"Pagina {n}, primo paragrafo.")
+            page.insert_text((72, 300), f"Pagina {n}, secondo paragrafo.")
+        doc.save(path)
+    return str(path)
+
+@pytest.fixture
+def a_gruppi(monkeypatch):
+    monkeypatch.setattr(pdf_engine, "PDF_PARALLEL_MIN_PAGES", 2)
+    monkeypatch.setattr(pdf_engine, "PDF_PAGES_PER_TASK", 2)
+
+def _testi(paragrafi):
+    return [(pagina, testo) for pagina, _, testo in paragrafi]
+
+def test_una_pagina_alla_volta(pdf):
+    testi = _testi(pdf_engine.iter_pdf_paragraphs(pdf))
+    assert len(testi) == 14
+    assert testi[:2] == [(0, "Pagina 0, primo paragrafo."), (0, "Pagina 0, secondo paragrafo.")]
+    assert testi[-1] == (6, "Pagina 6, secondo paragrafo.")
+
+def test_pool_di_processi_nello_stesso_ordine(pdf, a_gruppi):
+    attesi = _testi(pdf_engine._extract_pages(pdf, 0, 7))
+    assert _testi(pdf_engine.iter_pdf_paragraphs(pdf)) == attesi
+    with open(pdf, "rb") as f:
+        assert _testi(pdf_engine.iter_pdf_paragraphs(f.read())) == attesi
+
+def test_executor_esterno_e_lettura_interrotta(pdf, a_gruppi):
+    attesi = _testi(pdf_engine._extract_pages(pdf, 0, 7))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert _testi(pdf_engine.iter_pdf_paragraphs(pdf, executor)) == attesi
+        paragrafi = pdf_engine.iter_pdf_paragraphs(pdf, executor)
+        assert _testi(itertools.islice(paragrafi, 3)) == attesi[:3]
+        paragrafi.close()
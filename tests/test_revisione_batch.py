@@ -0,0 +1,39 @@
+import json
+
+from revisione_batch import apri_report, leggi_report
+
+def _voce(file, tono=None, critici=1, **extra):
+    voce = {"file": file, "sha256": "h" + file, "tono": tono, "critici": [{"indice": 0}] * critici,
+            "non_analizzati": 0, "non_riscritti": 0, "errore": None}
+    voce.update(extra)
+    return voce
+
+def _scrivi(path, voci, coda=b""):
+    with open(path, "wb") as f:
+        for voce in voci:
+            f.write(json.dumps(voce, ensure_ascii=False).encode("utf-8") + b"\n")
+        f.write(coda)
+
+def test_documenti_incompleti_da_rielaborare(tmp_path):
+    report = tmp_path / "report.jsonl"
+    _scrivi(report, [
+        _voce("a"),
+        _voce("b", errore="RuntimeError: x"),
+        _voce("c", non_analizzati=1),
+        _voce("d", tono="Formale", non_riscritti=2),
+    ])
+    assert leggi_report(str(report)) == {("a", "ha")}
+
+def test_riscrittura_richiesta_dopo_la_sola_analisi(tmp_path):
+    report = tmp_path / "report.jsonl"
+    _scrivi(report, [_voce("a"), _voce("b", tono="Formale"), _voce("c", tono="Informale"), _voce("d", critici=0)])
+    assert leggi_report(str(report)) == {("a", "ha"), ("b", "hb"), ("c", "hc"), ("d", "hd")}
+    assert leggi_report(str(report), "Formale") == {("b", "hb"), ("d", "hd")}
+
+def test_riga_troncata_a_meta_di_un_carattere(tmp_path):
+    report = tmp_path / "report.jsonl"
+    _scrivi(report, [_voce("perché")], coda=json.dumps(_voce("città")).encode("utf-8")[:-3] + "à".encode("utf-8")[:1])
+    assert leggi_report(str(report)) == {("perché", "hperché")}
+    with apri_report(str(report)) as f:
+        f.write(json.dumps(_voce("e")) + "\n")
+    assert leggi_report(str(report)) == {("perché", "hperché"), ("e", "he")}
@@ -0,0 +1,212 @@
+from types import SimpleNamespace
+
+import pytest
+
+import revisione
+from revisione import RETRY_BASE_DELAY, RETRY_MAX_DELAY, CircuitOpenError, RequestScheduler
+
+class Orologio:
+    """Sostituisce time.monotonic: il tempo avanza solo quando lo si chiede."""
+
+    def __init__(self):
+        self.adesso = 1000.0
+
+    def __call__(self):
+        return self.adesso
+
+    def avanza(self, secondi):
+        self.adesso += secondi
+
+@pytest.fixture
+def orologio(monkeypatch):
+    orologio = Orologio()
+    monkeypatch.setattr(revisione.time, "monotonic", orologio)
+    return orologio
+
+@pytest.fixture
+def scheduler(orologio):
+    return RequestScheduler(rate_per_minute=0, max_concurrency=4, failure_threshold=3, cooldown=30)
+
+@pytest.fixture
+def attese(monkeypatch, orologio):
+    """Sostituisce time.sleep: registra le attese dei ritentativi e fa avanzare l'orologio."""
+    attese = []
+
+    def sleep(secondi):
+        attese.append(secondi)
+        orologio.avanza(secondi)
+
+    monkeypatch.setattr(revisione.time, "sleep", sleep)
+    return attese
+
+class ErroreServer(Exception):
+    """Errore 5xx del provider: temporaneo, conta per il circuito."""
+
+    status_code = 503
+
+class ErroreLimite(Exception):
+    """429 del provider con gli header della risposta."""
+
+    status_code = 429
+
+    def __init__(self, headers):
+        super().__init__("Too Many Requests")
+        self.response = SimpleNamespace(headers=headers)
+
+def _dopo_errori(errori, risultato="ok"):
+    """Funzione che solleva, una chiamata alla volta, gli errori indicati e poi restituisce risultato."""
+    chiamate = []
+
+    def func():
+        chiamate.append(len(chiamate))
+        if len(chiamate) <= len(errori):
+            raise errori[len(chiamate) - 1]
+        return risultato
+
+    return func, chiamate
+
+def _errore():
+    return ErroreServer("Service Unavailable")
+
+def _fallisce(scheduler):
+    scheduler.acquire()
+    scheduler.release(_errore())
+
+def test_si_apre_dopo_errori_consecutivi(scheduler):
+    for _ in range(2):
+        _fallisce(scheduler)
+    assert scheduler.status()["stato"] == "chiuso"
+    _fallisce(scheduler)
+    stato = scheduler.status()
+    assert stato["stato"] == "aperto"
+    assert stato["riapertura"] == 30
+    with pytest.raises(CircuitOpenError):
+        scheduler.acquire()
+
+def test_un_successo_azzera_gli_errori(scheduler):
+    for _ in range(2):
+        _fallisce(scheduler)
+    scheduler.acquire()
+    scheduler.release()
+    for _ in range(2):
+        _fallisce(scheduler)
+    assert scheduler.status()["stato"] == "chiuso"
+
+def test_gli_errori_definitivi_non_aprono_il_circuito(scheduler):
+    for _ in range(5):
+        scheduler.acquire()
+        scheduler.release(ValueError("richiesta non valida"))
+    assert scheduler.status()["stato"] == "chiuso"
+
+def test_semiaperto_lascia_passare_una_sola_prova(scheduler, orologio):
+    for _ in range(3):
+        _fallisce(scheduler)
+    orologio.avanza(29)
+    with pytest.raises(CircuitOpenError):
+        scheduler.acquire()
+    orologio.avanza(1)
+    assert scheduler.status()["stato"] == "semiaperto"
+    scheduler.acquire()
+    with pytest.raises(CircuitOpenError):
+        scheduler.acquire()
+
+def test_prova_fallita_riapre(scheduler, orologio):
+    for _ in range(3):
+        _fallisce(scheduler)
+    orologio.avanza(30)
+    _fallisce(scheduler)
+    stato = scheduler.status()
+    assert stato["stato"] == "aperto"
+    assert stato["riapertura"] == 30
+    with pytest.raises(CircuitOpenError):
+        scheduler.acquire()
+
+def test_prova_riuscita_richiude(scheduler, orologio):
+    for _ in range(3):
+        _fallisce(scheduler)
+    orologio.avanza(30)
+    scheduler.acquire()
+    scheduler.release()
+    assert scheduler.status()["stato"] == "chiuso"
+    scheduler.acquire()
+    assert scheduler.status()["in_volo"] == 1
+
+@pytest.mark.parametrize("headers, attesa", [
+    ({"retry-after": "7"}, 7.0),
+    ({"retry-after-ms": "1500"}, 1.5),
+])
+def test_rispetta_retry_after(scheduler, attese, headers, attesa):
+    func, chiamate = _dopo_errori([ErroreLimite(headers)])
+    assert scheduler.call(func) == "ok"
+    assert len(chiamate) == 2
+    assert attese == [attesa]
+    assert scheduler.status()["ritentativi"] == 1
+
+def test_retry_after_sospende_le_altre_richieste(scheduler, orologio):
+    scheduler.acquire()
+    scheduler.release(ErroreLimite({"retry-after": "20"}))
+    assert scheduler.status()["pausa"] == 20
+    orologio.avanza(20)
+    assert scheduler.status()["pausa"] == 0
+    scheduler.acquire()
+
+def test_backoff_esponenziale_fino_al_limite_dei_tentativi(orologio, attese, monkeypatch):
+    # Il jitter restituisce sempre il massimo dell'intervallo
+    monkeypatch.setattr(revisione.random, "uniform", lambda a, b: b)
+    scheduler = RequestScheduler(rate_per_minute=0, max_concurrency=4, retries=3, failure_threshold=100)
+    errori = [ErroreServer("Service Unavailable") for _ in range(4)]
+    func, chiamate = _dopo_errori(errori)
+    with pytest.raises(ErroreServer) as rilanciato:
+        scheduler.call(func)
+    assert rilanciato.value is errori[-1]
+    assert len(chiamate) == 4
+    assert attese == [RETRY_BASE_DELAY, 2 * RETRY_BASE_DELAY, 4 * RETRY_BASE_DELAY]
+    stato = scheduler.status()
+    assert (stato["richieste"], stato["ritentativi"], stato["errori"], stato["in_volo"]) == (4, 3, 4, 0)
+
+def test_backoff_con_jitter(orologio, attese):
+    scheduler = RequestScheduler(rate_per_minute=0, max_concurrency=4, retries=5, failure_threshold=100)
+    func, _ = _dopo_errori([ErroreServer("Service Unavailable") for _ in range(5)])
+    assert scheduler.call(func) == "ok"
+    assert all(0 <= attesa <= min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** n) for n, attesa in enumerate(attese))
+
+def test_errori_definitivi_non_ritentati(scheduler, attese):
+    func, chiamate = _dopo_errori([ValueError("richiesta non valida")])
+    with pytest.raises(ValueError):
+        scheduler.call(func)
+    assert len(chiamate) == 1
+    assert attese == []
+    assert scheduler.status()["in_volo"] == 0
+
+def test_concorrenza_dimezzata_una_volta_per_ondata(orologio):
+    scheduler = RequestScheduler(rate_per_minute=0, max_concurrency=8, failure_threshold=100)
+    for _ in range(4):
+        scheduler.acquire()
+    orologio.avanza(1)
+    # Le richieste partite prima del dimezzamento non lo ripetono
+    for _ in range(4):
+        scheduler.release(_errore())
+    assert scheduler.status()["concorrenza"] == 4
+    orologio.avanza(1)
+    _fallisce(scheduler)
+    assert scheduler.status()["concorrenza"] == 2
+    orologio.avanza(1)
+    _fallisce(scheduler)
+    _fallisce(scheduler)
+    assert scheduler.status()["concorrenza"] == 1
+
+def test_concorrenza_ricresce_con_i_successi(orologio):
+    scheduler = RequestScheduler(rate_per_minute=0, max_concurrency=4, failure_threshold=100)
+    _fallisce(scheduler)
+    assert scheduler.status()["concorrenza"] == 2
+    # Cresce di uno ogni "limite" successi, senza superare max_concurrency
+    for attesa in (2, 3):
+        for _ in range(attesa):
+            assert scheduler.status()["concorrenza"] == attesa
+            scheduler.acquire()
+            scheduler.release()
+    assert scheduler.status()["concorrenza"] == 4
+    for _ in range(10):
+        scheduler.acquire()
+        scheduler.release()
+    assert scheduler.status()["concorrenza"] == 4
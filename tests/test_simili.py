@@ -0,0 +1,45 @@
+from revisione import IndiceSimili, content_hash
+
+TESTO = (
+    "Durante la serata il barman prepara i cocktail della casa davanti agli ospiti, spiegando "
+    "la scelta degli ingredienti, le dosi e la tecnica di miscelazione; alla fine del servizio "
+    "il locale propone una degustazione guidata con abbinamenti di stuzzichini preparati dalla "
+    "cucina e una breve presentazione dei distillati artigianali selezionati per la stagione, "
+    "raccontando la storia delle distillerie e dei produttori locali che li realizzano ogni anno"
+)
+
+def test_forma_canonica():
+    indice = IndiceSimili()
+    gruppo = indice.gruppo("Apertura alle 18:30, Via Roma 12!")
+    assert gruppo == content_hash("Apertura alle 18:30, Via Roma 12!")
+    assert indice.gruppo("apertura alle 21.00 via roma 7") == gruppo
+    assert indice.gruppo("  APERTURA   alle 9:15 - via Roma, 1 ") == gruppo
+    assert indice.gruppo("Chiusura alle 18:30, Via Roma 12!") != gruppo
+    assert indice.raggruppati == 2
+
+def test_blocchi_quasi_identici():
+    indice = IndiceSimili()
+    gruppo = indice.gruppo(TESTO)
+    assert indice.gruppo(TESTO.replace("serata", "notte")) == gruppo
+    assert indice.gruppo(TESTO.replace("ogni anno", "ogni stagione")) == gruppo
+    assert indice.raggruppati == 2
+
+def test_blocchi_diversi():
+    indice = IndiceSimili()
+    gruppo = indice.gruppo(TESTO)
+    parole = TESTO.split()
+    assert indice.gruppo(" ".join(parole[: len(parole) // 2])) != gruppo
+    assert indice.gruppo(" ".join(reversed(parole))) != gruppo
+    assert indice.raggruppati == 0
+
+def test_soglia():
+    variante = TESTO.replace("serata", "notte")
+    assert IndiceSimili(soglia=1).gruppo(TESTO) != IndiceSimili(soglia=1).gruppo(variante)
+    indice = IndiceSimili(soglia=1)
+    gruppo = indice.gruppo(TESTO)
+    assert indice.gruppo(variante) != gruppo
+    assert indice.gruppo(TESTO.upper()) == gruppo
+
+def test_blocchi_brevi():
+    indice = IndiceSimili()
+    assert indice.gruppo("Ciao a tutti") != indice.gruppo("Ciao a voi")